@@ -6,5 +6,6 @@ python manage.py collectstatic --noinput
 
 echo "Running migrations..."
 python manage.py migrate
+python manage.py createcachetable
 
 echo "Build completed!"
\ No newline at end of file
@@ -1,15 +1,23 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
-from .models import Photo, Video, UserProfile, Notification, StorageUpgradeRequest, Album, AlbumPhoto, AlbumVideo
+from .models import EXTRA_STORAGE_LIMIT, Photo, Video, UserProfile, Notification, StorageUpgradeRequest, Album, AlbumPhoto, AlbumVideo, StorageCleanupTask
+from django.shortcuts import render
+from django.urls import path
 from django.utils import timezone
+from .cache_versions import bump, profile_scope
+from .forecast import UPGRADE_HORIZON_DAYS, upgrade_candidates
 
 @admin.register(Photo)
 class PhotoAdmin(admin.ModelAdmin):
-    list_display = ('user', 'title', 'uploaded_at', 'file_size', 'get_file_size_mb')
-    list_filter = ('uploaded_at', 'user')
+    list_display = ('user', 'title', 'uploaded_at', 'file_size', 'get_file_size_mb', 'deleted_at')
+    list_filter = ('uploaded_at', 'deleted_at', 'user')
     search_fields = ('title', 'description', 'user__username')
     readonly_fields = ('uploaded_at', 'file_size')
+
+    def get_queryset(self, request):
+        # Include trashed items
+        return Photo.all_objects.all()
     
     def get_file_size_mb(self, obj):
         return f"{round(obj.file_size / (1024 * 1024), 2)} MB"
@@ -17,10 +25,14 @@ class PhotoAdmin(admin.ModelAdmin):
 
 @admin.register(Video)
 class VideoAdmin(admin.ModelAdmin):
-    list_display = ('user', 'title', 'uploaded_at', 'file_size', 'get_file_size_mb', 'duration')
-    list_filter = ('uploaded_at', 'user')
+    list_display = ('user', 'title', 'uploaded_at', 'file_size', 'get_file_size_mb', 'deleted_at', 'duration')
+    list_filter = ('uploaded_at', 'deleted_at', 'user')
     search_fields = ('title', 'description', 'user__username')
     readonly_fields = ('uploaded_at', 'file_size')
+
+    def get_queryset(self, request):
+        # Include trashed items
+        return Video.all_objects.all()
     
     def get_file_size_mb(self, obj):
         return f"{round(obj.file_size / (1024 * 1024), 2)} MB"
@@ -29,7 +41,8 @@ class VideoAdmin(admin.ModelAdmin):
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'phone_number', 'gmail', 'storage_used', 'storage_limit', 'get_storage_percentage', 'has_paid_for_extra_storage', 'upgrade_requested')
-    readonly_fields = ('storage_used',)
+    # The ledger columns move under concurrent uploads (adjust_storage_used, quota)
+    readonly_fields = ('storage_used', 'storage_reserved')
     list_filter = ('has_paid_for_extra_storage', 'upgrade_requested')
     actions = ['approve_upgrade', 'disapprove_upgrade']
     search_fields = ('user__username', 'phone_number', 'gmail')
@@ -38,13 +51,47 @@ class UserProfileAdmin(admin.ModelAdmin):
         return f"{obj.get_storage_percentage()}%"
     get_storage_percentage.short_description = 'Storage Used (%)'
 
+    def save_model(self, request, obj, form, change):
+        if change:
+            # Write only what the form changed, never a stale copy of the ledger columns
+            obj.save(update_fields=form.changed_data)
+        else:
+            super().save_model(request, obj, form, change)
+
+    def get_urls(self):
+        forecast = path('quota-forecast/', self.admin_site.admin_view(self.quota_forecast), name='storageapp_userprofile_quota_forecast')
+        return [forecast] + super().get_urls()
+
+    def quota_forecast(self, request):
+        """Users projected to fill their storage within the horizon: likely upgrade candidates"""
+        try:
+            horizon = int(request.GET.get('days', UPGRADE_HORIZON_DAYS))
+        except ValueError:
+            horizon = UPGRADE_HORIZON_DAYS
+        candidates = upgrade_candidates(horizon)
+        profiles = UserProfile.objects.select_related('user').in_bulk([user_id for user_id, *_ in candidates], field_name='user_id')
+        rows = [
+            {'profile': profiles[user_id], 'bytes_per_day': bytes_per_day, 'days_left': days_left, 'full_on': full_on}
+            for user_id, bytes_per_day, days_left, full_on in candidates
+        ]
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Quota forecast',
+            'horizon': horizon,
+            'rows': rows,
+        }
+        return render(request, 'admin/storageapp/userprofile/quota_forecast.html', context)
+
     def approve_upgrade(self, request, queryset):
-        updated = queryset.update(has_paid_for_extra_storage=True, upgrade_requested=False)
+        updated = queryset.update(has_paid_for_extra_storage=True, storage_limit=EXTRA_STORAGE_LIMIT, upgrade_requested=False)
+        bump(*(profile_scope(user_id) for user_id in queryset.values_list('user_id', flat=True)))
         self.message_user(request, f"{updated} user(s) have been approved for extra storage.")
     approve_upgrade.short_description = 'Approve selected upgrade requests'
 
     def disapprove_upgrade(self, request, queryset):
         updated = queryset.update(upgrade_requested=False)
+        bump(*(profile_scope(user_id) for user_id in queryset.values_list('user_id', flat=True)))
         for profile in queryset:
             Notification.objects.create(
                 user=profile.user,
@@ -67,43 +114,44 @@ class StorageUpgradeRequestAdmin(admin.ModelAdmin):
     actions = ['approve_request', 'deny_request']
 
     def approve_request(self, request, queryset):
+        approved = 0
         for req in queryset.filter(status='pending'):
             req.status = 'approved'
             req.processed_at = timezone.now()
             req.processed_by = request.user
             req.save()
-            # Grant storage
-            profile = UserProfile.objects.get(user=req.user)
-            profile.has_paid_for_extra_storage = True
-            profile.upgrade_requested = False
-            profile.save()
+            # Grant storage; an UPDATE, so the ledger columns are left to adjust_storage_used
+            UserProfile.objects.filter(user=req.user).update(has_paid_for_extra_storage=True, storage_limit=EXTRA_STORAGE_LIMIT, upgrade_requested=False)
+            bump(profile_scope(req.user_id))
             Notification.objects.create(user=req.user, message='Your storage upgrade request was approved!')
-        self.message_user(request, f"{queryset.filter(status='pending').count()} request(s) approved.")
+            approved += 1
+        self.message_user(request, f"{approved} request(s) approved.")
     approve_request.short_description = 'Approve selected storage upgrade requests'
 
     def deny_request(self, request, queryset):
+        denied = 0
         for req in queryset.filter(status='pending'):
             req.status = 'denied'
             req.processed_at = timezone.now()
             req.processed_by = request.user
             req.save()
             Notification.objects.create(user=req.user, message='Your storage upgrade request was denied.')
-        self.message_user(request, f"{queryset.filter(status='pending').count()} request(s) denied.")
+            denied += 1
+        self.message_user(request, f"{denied} request(s) denied.")
     deny_request.short_description = 'Deny selected storage upgrade requests'
 
 @admin.register(Album)
 class AlbumAdmin(admin.ModelAdmin):
-    list_display = ['name', 'user', 'created_at', 'photo_count', 'video_count']
+    list_display = ['name', 'user', 'created_at', 'photo_count', 'video_count', 'get_total_size_mb']
     list_filter = ['created_at', 'user']
     search_fields = ['name', 'user__username']
+    readonly_fields = ('photo_count', 'video_count', 'total_bytes')
+    list_select_related = ['user']
     
-    def photo_count(self, obj):
-        return obj.album_photos.count()
-    photo_count.short_description = 'Photos'
-    
-    def video_count(self, obj):
-        return obj.album_videos.count()
-    video_count.short_description = 'Videos'
+    def get_total_size_mb(self, obj):
+        return f"{round(obj.total_bytes / (1024 * 1024), 2)} MB"
+    get_total_size_mb.short_description = 'Size (MB)'
+    get_total_size_mb.admin_order_field = 'total_bytes'
 
 @admin.register(AlbumPhoto)
 class AlbumPhotoAdmin(admin.ModelAdmin):
@@ -116,3 +164,10 @@ class AlbumVideoAdmin(admin.ModelAdmin):
     list_display = ['album', 'video', 'order']
     list_filter = ['album', 'order']
     search_fields = ['album__name', 'video__title']
+
+@admin.register(StorageCleanupTask)
+class StorageCleanupTaskAdmin(admin.ModelAdmin):
+    list_display = ['storage_name', 'attempts', 'next_attempt_at', 'created_at', 'last_error']
+    list_filter = ['attempts']
+    search_fields = ['storage_name']
+    readonly_fields = ('created_at',)
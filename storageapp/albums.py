@@ -0,0 +1,103 @@
+"""Set-diff sync of album membership.
+
+Saving an album's contents loads the current AlbumPhoto/AlbumVideo rows
+once, validates the selected ids with one ``id__in`` query, then deletes
+removals in one statement, bulk-creates additions and bulk-updates only the
+rows whose position actually changed, so the query count stays flat however
+many items the album holds.
+"""
+from django.db import transaction
+from django.db.models import Max
+
+from .models import Album, AlbumPhoto, AlbumVideo, Photo, Video
+from .ordering import ORDER_GAP, spread_between
+
+ALBUM_ITEM_MODELS = {
+    'photo': (AlbumPhoto, Photo, 'photo_id'),
+    'video': (AlbumVideo, Video, 'video_id'),
+}
+
+
+def parse_ids(values):
+    """Integer ids from posted values, skipping junk and repeats but keeping their order"""
+    return list(dict.fromkeys(int(value) for value in values if str(value).isdigit()))
+
+
+def _slot_positions(wanted, current):
+    """Order values for `wanted` that leave existing rows untouched, or None if that is impossible.
+
+    Possible when the kept rows are already in the wanted relative order and
+    every run of new items fits into the gap between its kept neighbours.
+    """
+    kept = [current[media_id].order for media_id in wanted if media_id in current]
+    if any(a >= b for a, b in zip(kept, kept[1:])):
+        return None
+    positions = {}
+    before = None
+    pending = []
+    for media_id in wanted + [None]:
+        row = current.get(media_id) if media_id is not None else None
+        if media_id is not None and row is None:
+            pending.append(media_id)
+            continue
+        if pending:
+            values = spread_between(before, row, len(pending))
+            if values is None:
+                return None
+            positions.update(zip(pending, values))
+            pending = []
+        if row is not None:
+            positions[media_id] = row.order
+            before = row
+    return positions
+
+
+def sync_album_items(album, media_type, media_ids):
+    """Make `album` hold exactly the owner's photos or videos in `media_ids`, in that order.
+
+    Ids the album owner does not own are ignored. Returns the number of
+    items added, removed and repositioned.
+    """
+    through, media_model, field = ALBUM_ITEM_MODELS[media_type]
+    with transaction.atomic():
+        # Items of trashed media stay in the album untouched until the media is restored or purged
+        rows = through.objects.filter(album=album).active()
+        current = {getattr(row, field): row for row in rows.select_for_update().only('id', field, 'order')}
+        valid = set(media_model.objects.filter(id__in=media_ids, user_id=album.user_id).values_list('id', flat=True))
+        wanted = [media_id for media_id in dict.fromkeys(media_ids) if media_id in valid]
+
+        wanted_set = set(wanted)
+        removed = [row.pk for media_id, row in current.items() if media_id not in wanted_set]
+        if removed:
+            through.objects.filter(pk__in=removed).delete()
+        current = {media_id: row for media_id, row in current.items() if media_id in wanted_set}
+
+        positions = _slot_positions(wanted, current)
+        if positions is None:
+            positions = {media_id: index * ORDER_GAP for index, media_id in enumerate(wanted, start=1)}
+
+        additions = []
+        moved = []
+        for media_id in wanted:
+            row = current.get(media_id)
+            if row is None:
+                additions.append(through(album=album, order=positions[media_id], **{field: media_id}))
+            elif row.order != positions[media_id]:
+                row.order = positions[media_id]
+                moved.append(row)
+        if additions:
+            through.objects.bulk_create(additions)
+        if moved:
+            through.objects.bulk_update(moved, ['order'])
+    return len(additions), len(removed), len(moved)
+
+
+def add_to_albums(media, albums):
+    """Append a newly uploaded photo or video to the end of each of `albums` (a queryset or ids) its owner owns"""
+    through = media.album_item_model()
+    owned = Album.objects.filter(id__in=albums, user_id=media.user_id)
+    last_orders = owned.annotate(last=Max(f'{media.album_item_relation}__order')).values_list('id', 'last')
+    through.objects.bulk_create([
+        through(album_id=album_id, order=(last or 0) + ORDER_GAP, **{media.album_item_field: media})
+        for album_id, last in last_orders
+    ])
@@ -0,0 +1,129 @@
+"""Storage usage series for the analytics page, at a resolution fit for the range.
+
+StorageHistory holds one row per user and day. ``compact_storage_history``
+rolls those up into StorageRollup rows per week and month (usage at the end
+of the period) and can prune daily rows once they are older than any range
+drawn at daily resolution. A range is drawn at the finest resolution that
+stays within ``MAX_POINTS`` points, so even a multi-year chart is one
+indexed query for a few hundred rows.
+"""
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import StorageHistory, StorageRollup
+
+DAY = 'day'
+RANGES = {
+    '30d': ('Last 30 Days', timedelta(days=30)),
+    '1y': ('Last Year', timedelta(days=365)),
+    'all': ('All Time', None),
+}
+DEFAULT_RANGE = '30d'
+RESOLUTION_LABELS = {DAY: 'Daily', StorageRollup.WEEK: 'Weekly', StorageRollup.MONTH: 'Monthly'}
+MAX_POINTS = 400
+# Daily rows must outlive the longest range that is still drawn per day
+MIN_DAILY_RETENTION_DAYS = MAX_POINTS
+ROLLUP_WRITE_BATCH_SIZE = 5000
+
+
+def period_start(day, resolution):
+    """First day of the week (Monday) or month containing `day`"""
+    if resolution == StorageRollup.WEEK:
+        return day - timedelta(days=day.weekday())
+    if resolution == StorageRollup.MONTH:
+        return day.replace(day=1)
+    return day
+
+
+def resolution_for(start, end):
+    """The finest resolution drawing `start`..`end` in at most MAX_POINTS points"""
+    days = (end - start).days + 1
+    if days <= MAX_POINTS:
+        return DAY
+    if days // 7 + 1 <= MAX_POINTS:
+        return StorageRollup.WEEK
+    return StorageRollup.MONTH
+
+
+def first_recorded_day(user):
+    """The earliest day with any history for `user`, or None"""
+    candidates = [
+        StorageHistory.objects.filter(user=user).order_by('date').values_list('date', flat=True).first(),
+        StorageRollup.objects.filter(user=user, resolution=StorageRollup.MONTH)
+        .order_by('period_start').values_list('period_start', flat=True).first(),
+    ]
+    candidates = [day for day in candidates if day is not None]
+    return min(candidates) if candidates else None
+
+
+def storage_series(user, range_key=DEFAULT_RANGE, today=None):
+    """Usage points for `range_key` (see RANGES) as a JSON-ready dict"""
+    label, span = RANGES[range_key]
+    end = today or timezone.now().date()
+    start = end - span if span else (first_recorded_day(user) or end)
+    resolution = resolution_for(start, end)
+
+    if resolution == DAY:
+        rows = StorageHistory.objects.filter(user=user, date__range=(start, end)).order_by('date')
+        rows = rows.values_list('date', 'storage_used')
+    else:
+        rows = StorageRollup.objects.filter(
+            user=user, resolution=resolution, period_start__range=(period_start(start, resolution), end)
+        ).order_by('period_start').values_list('period_start', 'storage_used')
+
+    return {
+        'range': range_key,
+        'label': label,
+        'resolution': resolution,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'points': [
+            {'date': day.isoformat(), 'storage_mb': round(used / (1024 * 1024), 2)}
+            for day, used in rows
+        ],
+    }
+
+
+def _write_rollups(periods):
+    StorageRollup.objects.bulk_create(
+        [
+            StorageRollup(user_id=user_id, resolution=resolution, period_start=start, storage_used=used)
+            for (user_id, resolution, start), used in periods.items()
+        ],
+        batch_size=ROLLUP_WRITE_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['user', 'resolution', 'period_start'],
+        update_fields=['storage_used'],
+    )
+    return len(periods)
+
+
+def compact_history(since=None, keep_days=None):
+    """Roll daily history up into weeks and months; returns (rollups written, daily rows pruned).
+
+    Only periods overlapping `since` onwards are recomputed (all of them when
+    None). Daily rows older than `keep_days` are deleted afterwards, when given.
+    """
+    daily = StorageHistory.objects.order_by('user_id', 'date')
+    if since is not None:
+        # Start at the first day of the earliest period that contains `since`
+        daily = daily.filter(date__gte=min(period_start(since, StorageRollup.WEEK), period_start(since, StorageRollup.MONTH)))
+
+    written = 0
+    periods = {}  # (user_id, resolution, period_start) -> usage on the last day seen
+    for user_id, day, used in daily.values_list('user_id', 'date', 'storage_used').iterator(chunk_size=ROLLUP_WRITE_BATCH_SIZE):
+        for resolution in (StorageRollup.WEEK, StorageRollup.MONTH):
+            periods[(user_id, resolution, period_start(day, resolution))] = used
+        if len(periods) >= ROLLUP_WRITE_BATCH_SIZE:
+            # A period's rows are adjacent, so an early write is overwritten by the final value
+            written += _write_rollups(periods)
+            periods.clear()
+    if periods:
+        written += _write_rollups(periods)
+
+    pruned = 0
+    if keep_days is not None:
+        cutoff = timezone.now().date() - timedelta(days=keep_days)
+        pruned, _ = StorageHistory.objects.filter(date__lt=cutoff).delete()
+    return written, pruned
@@ -0,0 +1,136 @@
+"""Version stamps for HTTP conditional GET and versioned cache keys.
+
+Each scope (a user's media library, notifications or profile, an album)
+has a version held in the cache: the time of its last change, in
+nanoseconds. Code that changes a scope calls bump(). Views decorated with
+conditional_view() turn the versions into ETag / Last-Modified validators,
+answering a matching If-None-Match / If-Modified-Since with 304 before any
+query runs, and versioned_key() embeds them in cache keys so derived data
+never needs to be deleted; cached() wraps that read-through pattern.
+Models declare their scope with ``version_scope`` and bump it on every
+save, delete and bulk write (ContentVersionMixin / VersionedQuerySet in
+models). A version that has fallen out of the cache restarts at "now",
+which only costs one recomputation.
+"""
+import hashlib
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+DERIVED_CACHE_TTL = 60 * 60  # superseded keys simply age out
+
+
+def media_scope(user_id):
+    return f'media:{user_id}'
+
+
+def album_scope(album_id):
+    return f'album:{album_id}'
+
+
+def notifications_scope(user_id):
+    return f'notifications:{user_id}'
+
+
+def profile_scope(user_id):
+    return f'profile:{user_id}'
+
+
+def _key(scope):
+    return f'version:{scope}'
+
+
+def get_versions(*scopes):
+    """Current version of each scope, starting any unknown scope at the current time"""
+    keys = [_key(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in found}
+    if missing:
+        for key, version in missing.items():
+            cache.add(key, version, None)  # add() so a concurrent bump is not overwritten
+        found.update(cache.get_many(list(missing)))
+    return [found.get(key, missing.get(key)) for key in keys]
+
+
+def bump(*scopes):
+    """Mark `scopes` as changed once the current transaction commits"""
+    if not scopes:
+        return
+
+    def apply():
+        now = time.time_ns()
+        cache.set_many({_key(scope): now for scope in scopes}, None)
+
+    transaction.on_commit(apply)
+
+
+def scope_validators(*scopes):
+    """(version, last_modified) for a response built from `scopes`"""
+    versions = get_versions(*scopes)
+    last_modified = datetime.fromtimestamp(max(versions) // 1_000_000_000, tz=timezone.utc)
+    return ':'.join(str(version) for version in versions), last_modified
+
+
+def versioned_key(prefix, *scopes):
+    """Cache key for data derived from `scopes`; it changes whenever one of them is bumped"""
+    version = ':'.join(str(version) for version in get_versions(*scopes))
+    if len(scopes) > 4:
+        # e.g. one scope per album; keep the key within memcached's 250 characters
+        version = hashlib.md5(version.encode()).hexdigest()
+    return f'{prefix}:{version}'
+
+
+def cached(prefix, scopes, build, timeout=DERIVED_CACHE_TTL):
+    """`build()`'s result, cached under a key versioned by `scopes`"""
+    key = versioned_key(prefix, *scopes)
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, timeout)
+    return value
+
+
+def conditional_view(validators):
+    """Decorate a GET view so unchanged responses are answered with 304.
+
+    `validators(request, *args, **kwargs)` returns ``(version, last_modified)``
+    describing what the response would contain (last_modified may be None),
+    or None to always run the view. The ETag also covers the visitor and
+    their CSRF cookie, since rendered pages embed both. Requests with queued
+    messages always run the view: a 304 would leave the messages for a later
+    page, and the page showing them must not be revalidated as unchanged.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            # len() leaves the messages queued for the view to render
+            if request.method not in ('GET', 'HEAD') or len(messages.get_messages(request)):
+                return view(request, *args, **kwargs)
+            result = validators(request, *args, **kwargs)
+            if result is None:
+                return view(request, *args, **kwargs)
+            version, last_modified = result
+            viewer = f'{request.user.pk or 0}:{request.COOKIES.get(settings.CSRF_COOKIE_NAME, "")}'
+            etag = quote_etag(hashlib.md5(f'{viewer}|{version}'.encode()).hexdigest())
+            timestamp = int(last_modified.timestamp()) if last_modified else None
+
+            response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            response.headers.setdefault('ETag', etag)
+            if timestamp is not None:
+                response.headers.setdefault('Last-Modified', http_date(timestamp))
+            # Personal pages: browsers may keep them but must revalidate each time
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,226 @@
+"""Resumable chunked uploads for large videos.
+
+A client creates an UploadSession, then appends raw chunks at the offset the
+server reports, so a dropped connection only costs the chunk in flight. The
+bytes are spooled to ``settings.CHUNKED_UPLOAD_SPOOL_DIR`` and handed to the
+configured storage backend as a single file when the session is finalized.
+The declared size is reserved against the user's quota (see quota) for the
+life of the session.
+"""
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from .albums import add_to_albums
+from .dedup import save_media
+from .models import StorageReservation, UploadSession, Video
+from . import quota
+
+STREAM_READ_SIZE = 64 * 1024
+UNFINISHED = ('active', 'finalizing')
+
+
+class ChunkError(Exception):
+    """A chunk or finalize request that cannot be applied to the session"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def spool_path(session_id):
+    return os.path.join(settings.CHUNKED_UPLOAD_SPOOL_DIR, f'{session_id}.part')
+
+
+def create_session(user, filename, content_type, total_size, title='', description='', album_ids=()):
+    """Start a session holding `total_size` bytes of the user's quota; raises quota.QuotaExceeded"""
+    os.makedirs(settings.CHUNKED_UPLOAD_SPOOL_DIR, exist_ok=True)
+    expires_at = timezone.now() + timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS)
+    with transaction.atomic():
+        session = UploadSession.objects.create(
+            user=user,
+            filename=os.path.basename(filename)[:255],
+            content_type=content_type,
+            total_size=total_size,
+            title=title,
+            description=description,
+            album_ids=list(album_ids),
+            reservation=quota.reserve(user.pk, total_size, expires_at=expires_at),
+            expires_at=expires_at,
+        )
+    open(spool_path(session.pk), 'wb').close()
+    return session
+
+
+def _session(session_id, user, lock=False):
+    sessions = UploadSession.objects.select_for_update() if lock else UploadSession.objects
+    try:
+        return sessions.get(pk=session_id, user=user)
+    except UploadSession.DoesNotExist:
+        raise ChunkError('Upload session not found', status=404)
+
+
+def _check_chunk(session, offset, length):
+    if session.status != 'active' or session.is_expired():
+        raise ChunkError('Upload session is no longer active', status=410)
+    if offset != session.offset:
+        raise ChunkError(f'Expected offset {session.offset}', status=409)
+    if length <= 0 or length > settings.CHUNKED_UPLOAD_CHUNK_SIZE:
+        raise ChunkError(f'Chunks must be between 1 and {settings.CHUNKED_UPLOAD_CHUNK_SIZE} bytes')
+    if offset + length > session.total_size:
+        raise ChunkError('Chunk runs past the declared file size')
+
+
+def _receive(stream, length, directory, prefix):
+    """Read `length` bytes of `stream` into a new temporary file; returns its path"""
+    fd, path = tempfile.mkstemp(dir=directory, prefix=prefix, suffix='.chunk')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            remaining = length
+            while remaining:
+                data = stream.read(min(STREAM_READ_SIZE, remaining))
+                if not data:
+                    break
+                f.write(data)
+                remaining -= len(data)
+        if remaining:
+            # Connection dropped mid-chunk: the spool file never sees the partial chunk
+            raise ChunkError('Incomplete chunk received')
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def append_chunk(session_id, user, offset, stream, length):
+    """Write `length` bytes read from `stream` at `offset` and advance the session.
+
+    The body is received into a temporary file with no transaction open, so
+    a slow client holds no lock. Copying it into the spool file happens under
+    the session's row lock, so two clients resuming the same upload cannot
+    interleave their bytes.
+    """
+    _check_chunk(_session(session_id, user), offset, length)
+    chunk_path = _receive(stream, length, settings.CHUNKED_UPLOAD_SPOOL_DIR, f'{session_id}.')
+    try:
+        with transaction.atomic():
+            session = _session(session_id, user, lock=True)
+            # Another client may have written this range while the body was arriving
+            _check_chunk(session, offset, length)
+            try:
+                with open(spool_path(session.pk), 'r+b') as spool, open(chunk_path, 'rb') as chunk:
+                    spool.seek(offset)
+                    spool.truncate()
+                    shutil.copyfileobj(chunk, spool, STREAM_READ_SIZE)
+            except FileNotFoundError:
+                raise ChunkError('Upload session data is gone', status=410)
+
+            session.offset = offset + length
+            session.save(update_fields=['offset'])
+    finally:
+        os.remove(chunk_path)
+    return session
+
+
+def finalize_session(session_id, user):
+    """Turn a fully received session into a Video stored through the storage backend.
+
+    The session is claimed (status ``finalizing``) in one short transaction
+    and marked completed in another; the transfer to the storage backend in
+    between runs with no transaction or row lock held. Claiming extends the
+    session's expiry so collect_expired_sessions leaves it alone during the
+    transfer; a session collected anyway still yields its stored Video.
+    """
+    with transaction.atomic():
+        session = _session(session_id, user, lock=True)
+        if session.status == 'completed' and session.video_id:
+            return session.video  # finalize is idempotent for retrying clients
+        if session.status == 'finalizing':
+            raise ChunkError('Upload is already being finalized', status=409)
+        if session.offset != session.total_size:
+            raise ChunkError(f'Upload incomplete: {session.offset} of {session.total_size} bytes received', status=409)
+        session.status = 'finalizing'
+        session.expires_at = timezone.now() + timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS)
+        session.save(update_fields=['status', 'expires_at'])
+        held = session.reservation  # read now: the collector may delete the row during the transfer
+        if held:
+            StorageReservation.objects.filter(pk=held.pk).update(expires_at=session.expires_at)
+
+    path = spool_path(session.pk)
+    try:
+        with open(path, 'rb') as f:
+            video = Video(user=user, title=session.title, description=session.description)
+            save_media(video, 'video_file', File(f, name=session.filename))
+    except BaseException as e:
+        # Hand the session back so the client can retry
+        UploadSession.objects.filter(pk=session.pk, status='finalizing').update(status='active')
+        if isinstance(e, FileNotFoundError):
+            raise ChunkError('Upload session data is gone', status=410)
+        raise
+
+    with transaction.atomic():
+        # Conditional: the session may have been collected while the transfer ran.
+        # The Video is stored and charged either way, so it is kept and returned.
+        UploadSession.objects.filter(pk=session.pk, status='finalizing').update(
+            status='completed', video=video, reservation=None,
+        )
+        add_to_albums(video, session.album_ids)
+        if held:
+            quota.release(held)  # a no-op if the collector released it
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return video
+
+
+def collect_expired_sessions(now=None):
+    """Delete expired or long-finished sessions and any spool files left without a session.
+
+    Expired sessions include ones stuck in ``finalizing`` by a worker that
+    died mid-transfer. Returns the number of sessions removed.
+    """
+    now = now or timezone.now()
+    cutoff = now - timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS)
+    stale = UploadSession.objects.filter(status__in=UNFINISHED, expires_at__lt=now) | UploadSession.objects.filter(
+        status='completed', created_at__lt=cutoff
+    )
+    stale_ids = list(stale.values_list('pk', flat=True))
+    # Abandoned sessions give back the quota they were holding
+    for reservation in StorageReservation.objects.filter(pk__in=stale.values('reservation')):
+        quota.release(reservation)
+    for session_id in stale_ids:
+        try:
+            os.remove(spool_path(session_id))
+        except FileNotFoundError:
+            pass
+    removed, _ = UploadSession.objects.filter(pk__in=stale_ids).delete()
+
+    # Spool files whose session row is gone (e.g. user deleted mid-upload), and
+    # chunks a worker was receiving when it died
+    spool_dir = settings.CHUNKED_UPLOAD_SPOOL_DIR
+    if os.path.isdir(spool_dir):
+        with os.scandir(spool_dir) as it:
+            for entry in it:
+                if entry.stat().st_mtime >= cutoff.timestamp():
+                    continue
+                if entry.name.endswith('.chunk'):
+                    os.remove(entry.path)
+                    continue
+                if not entry.name.endswith('.part'):
+                    continue
+                session_id = entry.name[:-len('.part')]
+                try:
+                    exists = UploadSession.objects.filter(pk=session_id, status__in=UNFINISHED).exists()
+                except Exception:
+                    exists = False
+                if not exists:
+                    os.remove(entry.path)
+    return removed
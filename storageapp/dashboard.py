@@ -0,0 +1,71 @@
+"""Cached per-user figures for the dashboard.
+
+The counts, byte totals, unread notifications and profile fields come from
+one SELECT on UserProfile with a correlated aggregate subquery per figure.
+The result is cached under a key versioned by the user's media,
+notification and profile scopes (see cache_versions), so any change to
+those produces a new key instead of a stale read.
+"""
+from django.db import models
+from django.db.models import Count, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .cache_versions import cached, media_scope, notifications_scope, profile_scope
+from .models import BASE_STORAGE_LIMIT, EXTRA_STORAGE_LIMIT, Notification, Photo, UserProfile, Video
+
+
+def _aggregate(queryset, aggregate):
+    """Scalar subquery applying `aggregate` to the rows of `queryset` owned by the outer profile's user"""
+    rows = queryset.filter(user=OuterRef('user')).order_by().values('user')
+    value = Subquery(rows.annotate(value=aggregate).values('value'), output_field=models.BigIntegerField())
+    return Coalesce(value, Value(0), output_field=models.BigIntegerField())
+
+
+class DashboardSummary:
+    def __init__(self, profile, photo_count, photo_bytes, video_count, video_bytes, unread_notifications):
+        self.profile = profile
+        self.photo_count = photo_count
+        self.photo_bytes = photo_bytes
+        self.video_count = video_count
+        self.video_bytes = video_bytes
+        self.unread_notifications = unread_notifications
+
+    @property
+    def total_storage_mb(self):
+        return self.profile.get_storage_used_mb()
+
+    @classmethod
+    def compute(cls, user):
+        """Read the summary from the database in a single query"""
+        profiles = UserProfile.objects.filter(user=user).annotate(
+            photo_count=_aggregate(Photo.objects.all(), Count('id')),
+            photo_bytes=_aggregate(Photo.objects.all(), Sum('file_size')),
+            video_count=_aggregate(Video.objects.all(), Count('id')),
+            video_bytes=_aggregate(Video.objects.all(), Sum('file_size')),
+            unread_notifications=_aggregate(Notification.objects.filter(is_read=False), Count('id')),
+        )
+        profile = profiles.first()
+        if profile is None:
+            UserProfile.objects.get_or_create(user=user)
+            profile = profiles.first()
+
+        # Set correct storage limit based on payment status
+        storage_limit = EXTRA_STORAGE_LIMIT if profile.has_paid_for_extra_storage else BASE_STORAGE_LIMIT
+        if profile.storage_limit != storage_limit:
+            profile.storage_limit = storage_limit
+            profile.save(update_fields=['storage_limit'])
+
+        return cls(
+            profile,
+            profile.photo_count,
+            profile.photo_bytes,
+            profile.video_count,
+            profile.video_bytes,
+            profile.unread_notifications,
+        )
+
+    @classmethod
+    def for_user(cls, user):
+        """The user's summary, from the cache when nothing it depends on has changed"""
+        scopes = (media_scope(user.pk), notifications_scope(user.pk), profile_scope(user.pk))
+        return cached(f'dashboard:{user.pk}', scopes, lambda: cls.compute(user))
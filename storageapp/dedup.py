@@ -0,0 +1,105 @@
+"""Content-addressed deduplication of uploaded media.
+
+Every distinct SHA-256 is stored once as a MediaBlob; Photo/Video rows with
+the same content_hash share its storage name. References are counted on the
+rows' save/delete (see StorageLedgerMixin), and the file is removed when the
+last reference goes away.
+"""
+import hashlib
+
+from django.db import IntegrityError, transaction
+
+from .models import MediaBlob, Photo, StorageCleanupTask, Video
+from .ordering import first_position
+
+HASH_READ_SIZE = 1024 * 1024
+
+
+def compute_sha256(file):
+    """Hash a file object that did not come through the hashing upload handlers"""
+    digest = hashlib.sha256()
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    for chunk in file.chunks(HASH_READ_SIZE) if hasattr(file, 'chunks') else iter(lambda: file.read(HASH_READ_SIZE), b''):
+        digest.update(chunk)
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return digest.hexdigest()
+
+
+def _point_at_blob(field_file, blob):
+    field_file.name = blob.storage_name
+    field_file._committed = True
+
+
+def _place_first(instance):
+    """New uploads go ahead of the rest of the owner's library"""
+    instance.order = first_position(type(instance).objects.filter(user_id=instance.user_id))
+
+
+def _store(instance, field_name, uploaded_file):
+    """Write `uploaded_file` through the field's storage; returns the instance's new FieldFile"""
+    getattr(instance, field_name).save(uploaded_file.name, uploaded_file, save=False)
+    return getattr(instance, field_name)  # save() swapped in a new FieldFile
+
+
+def save_media(instance, field_name, uploaded_file, sha256=None):
+    """Save `instance` with `uploaded_file` in `field_name`, storing the bytes only if they are new.
+
+    New bytes are transferred to storage before the transaction opens, so no
+    lock is held for the length of an upload. Must be given an unsaved
+    Photo/Video. Returns the saved instance.
+    """
+    sha256 = sha256 or getattr(uploaded_file, 'sha256', None) or compute_sha256(uploaded_file)
+    field_file = getattr(instance, field_name)
+    stored = False
+    if not MediaBlob.objects.filter(sha256=sha256).exists():
+        field_file, stored = _store(instance, field_name, uploaded_file), True
+    created = False
+    with transaction.atomic():
+        # Locking the blob row keeps a concurrent release from deleting it under us
+        blob = MediaBlob.objects.select_for_update().filter(sha256=sha256).first()
+        if blob is None:
+            if not stored:
+                # Released since the check above, so the bytes are needed after all
+                field_file, stored = _store(instance, field_name, uploaded_file), True
+            try:
+                with transaction.atomic():
+                    blob = MediaBlob.objects.create(sha256=sha256, size=uploaded_file.size, storage_name=field_file.name)
+                created = True
+            except IntegrityError:
+                blob = MediaBlob.objects.select_for_update().get(sha256=sha256)
+        if stored and not created:
+            # Another upload of the same bytes won the race; keep theirs. Our copy is
+            # queued rather than deleted: content-addressed storage gives both uploads
+            # the same name, and the cleanup queue skips names a blob still uses.
+            StorageCleanupTask.enqueue([field_file.name])
+        _point_at_blob(field_file, blob)
+        instance.content_hash = sha256
+        instance.file_size = blob.size
+        _place_first(instance)
+        instance.save()
+    return instance
+
+
+def instant_upload(user, media_type, sha256, size, **fields):
+    """Create a Photo/Video from an existing blob without any transfer.
+
+    Only blobs the user already references are eligible, so knowing a hash
+    is never enough to obtain someone else's file. Returns the new instance,
+    or None when the client has to upload the bytes.
+    """
+    model, field_name = (Photo, 'image') if media_type == 'photo' else (Video, 'video_file')
+    owned = Photo.objects.filter(user=user, content_hash=sha256).exists() or \
+        Video.objects.filter(user=user, content_hash=sha256).exists()
+    if not owned:
+        return None
+    with transaction.atomic():
+        blob = MediaBlob.objects.select_for_update().filter(sha256=sha256, size=size).first()
+        if blob is None:
+            return None
+        instance = model(user=user, content_hash=sha256, file_size=blob.size, **fields)
+        _point_at_blob(getattr(instance, field_name), blob)
+        _place_first(instance)
+        instance.save()
+    return instance
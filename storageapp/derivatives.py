@@ -0,0 +1,87 @@
+"""Fixed-size thumbnails generated with Pillow when a photo is ingested."""
+import logging
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from .cache_versions import bump, media_scope
+from .models import PhotoDerivative, StorageCleanupTask
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_SIZES = (1024, 512, 256)  # largest first, each step resizes the previous one
+DERIVATIVE_FORMATS = {
+    PhotoDerivative.WEBP: {'format': 'WEBP', 'quality': 80, 'method': 4},
+    PhotoDerivative.JPEG: {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True},
+}
+
+
+def _encode(image, fmt):
+    buffer = BytesIO()
+    image.save(buffer, **DERIVATIVE_FORMATS[fmt])
+    return buffer.getvalue()
+
+
+def generate_photo_derivatives(photo, replace=False):
+    """Create the WebP/JPEG thumbnails for a saved photo.
+
+    Returns the list of created PhotoDerivative rows. Failures are logged and
+    swallowed so a bad image never breaks the upload itself; the templates fall
+    back to the original when no derivative exists.
+    """
+    if not photo.image:
+        return []
+    if replace:
+        with transaction.atomic():
+            StorageCleanupTask.enqueue(photo.derivatives.values_list('file', flat=True))
+            photo.derivatives.all().delete()
+    elif photo.derivatives.exists():
+        return []
+
+    try:
+        with photo.image.open('rb') as f:
+            image = Image.open(f)
+            image.draft('RGB', (DERIVATIVE_SIZES[0], DERIVATIVE_SIZES[0]))  # fast JPEG downscale on decode
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('RGB')
+    except Exception:
+        logger.exception('Could not open photo %s for thumbnailing', photo.pk)
+        return []
+
+    derivatives = []
+    for size in DERIVATIVE_SIZES:
+        saved = []
+        try:
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            for fmt in DERIVATIVE_FORMATS:
+                data = _encode(image, fmt)
+                derivative = PhotoDerivative(
+                    photo=photo,
+                    size=size,
+                    format=fmt,
+                    width=image.width,
+                    height=image.height,
+                    file_size=len(data),
+                )
+                extension = 'jpg' if fmt == PhotoDerivative.JPEG else fmt
+                derivative.file.save(f'{photo.pk}_{size}.{extension}', ContentFile(data), save=False)
+                saved.append(derivative)
+        except Exception:
+            logger.exception('Could not generate %spx thumbnails for photo %s', size, photo.pk)
+            StorageCleanupTask.enqueue(derivative.file.name for derivative in saved)
+            continue
+        derivatives += saved
+
+    if not derivatives:
+        return []
+    try:
+        with transaction.atomic():
+            PhotoDerivative.objects.bulk_create(derivatives)
+            bump(media_scope(photo.user_id))  # thumbnail URLs in the listings change
+    except Exception:
+        logger.exception('Could not record thumbnails for photo %s', photo.pk)
+        StorageCleanupTask.enqueue(derivative.file.name for derivative in derivatives)
+        return []
+    return derivatives
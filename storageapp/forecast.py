@@ -0,0 +1,154 @@
+"""When will each user run out of storage?
+
+Usage over the last ``FORECAST_WINDOW_DAYS`` days (StorageHistory, with
+today's live storage_used as the final day) is loaded into a users x days
+matrix and a trend line is fitted to every row at once: weighted least
+squares, refined by a few Huber reweighting passes so a single bulk upload
+or purge does not dominate the slope. The projected day a user reaches
+their storage_limit follows from that slope and their current usage. One
+NumPy pass covers any number of users; there is no per-user Python loop.
+History rows are read from a chunked database cursor straight into
+structured arrays and scattered into the matrix a chunk at a time, so the
+rows are never held as one list of Python tuples.
+"""
+from datetime import timedelta
+
+import numpy as np
+from django.db import connections
+from django.utils import timezone
+
+from .models import StorageHistory, UserProfile
+
+FORECAST_WINDOW_DAYS = 30
+MIN_OBSERVED_DAYS = 7  # fewer points than this give no forecast
+ROBUST_ITERATIONS = 2
+HUBER_K = 1.345  # in units of the residuals' robust standard deviation
+UPGRADE_HORIZON_DAYS = 90
+
+HISTORY_FETCH_SIZE = 20000
+HISTORY_DTYPE = np.dtype([('user_id', np.int64), ('date', 'datetime64[D]'), ('storage_used', np.float64)])
+
+
+def _history_chunks(history):
+    """`history`'s (user_id, date, storage_used) rows as structured arrays of up to HISTORY_FETCH_SIZE rows"""
+    query = history.order_by().values_list('user_id', 'date', 'storage_used').query
+    sql, params = query.get_compiler(using=history.db).as_sql()
+    # Server-side where the backend supports it, like QuerySet.iterator()
+    with connections[history.db].chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        while rows := cursor.fetchmany(HISTORY_FETCH_SIZE):
+            # Dates arrive as date objects or ISO strings depending on the backend; both parse
+            yield np.fromiter(rows, dtype=HISTORY_DTYPE, count=len(rows))
+
+
+def load_usage(user_ids=None, days=FORECAST_WINDOW_DAYS, today=None):
+    """(user ids, usage matrix, limits): one row per profile, NaN where no history exists"""
+    today = today or timezone.now().date()
+    start = today - timedelta(days=days - 1)
+    profiles = UserProfile.objects.order_by('user_id')
+    history = StorageHistory.objects.filter(date__gte=start, date__lt=today)
+    if user_ids is not None:
+        profiles = profiles.filter(user_id__in=user_ids)
+        history = history.filter(user_id__in=user_ids)
+
+    profile_rows = np.array(list(profiles.values_list('user_id', 'storage_used', 'storage_limit')), dtype=np.int64).reshape(-1, 3)
+    ids = profile_rows[:, 0]
+    usage = np.full((len(ids), days), np.nan)
+    usage[:, -1] = profile_rows[:, 1]  # today is the live value
+
+    if len(ids):
+        for chunk in _history_chunks(history):
+            rows = np.searchsorted(ids, chunk['user_id']).clip(max=len(ids) - 1)
+            known = ids[rows] == chunk['user_id']
+            day_col = (chunk['date'] - np.datetime64(start, 'D')).astype(np.int64)
+            usage[rows[known], day_col[known]] = chunk['storage_used'][known]
+    return ids, usage, profile_rows[:, 2].astype(np.float64)
+
+
+def _weighted_line(x, y, weights):
+    # Closed-form weighted least squares; the x sums are matrix-vector products
+    weighted_y = weights * y
+    total, sum_x, sum_xx = weights.sum(axis=1), weights @ x, weights @ (x * x)
+    sum_y, sum_xy = weighted_y.sum(axis=1), weighted_y @ x
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (total * sum_xy - sum_x * sum_y) / (total * sum_xx - sum_x * sum_x)
+        slope = np.nan_to_num(slope, nan=0.0, posinf=0.0, neginf=0.0)
+        intercept = (sum_y - slope * sum_x) / total
+    return slope, intercept
+
+
+def _robust_scale(residuals, observed):
+    """Per-row median absolute residual over the observed days, scaled to a standard deviation"""
+    # Sorting with missing days pushed to the end is much faster than nanmedian
+    ordered = np.sort(np.where(observed, residuals, np.inf), axis=1)
+    counts = observed.sum(axis=1)
+    rows = np.arange(len(ordered))
+    low = ordered[rows, np.maximum((counts - 1) // 2, 0)]
+    high = ordered[rows, np.maximum(counts // 2, 0).clip(max=ordered.shape[1] - 1)]
+    return np.where(counts > 0, 1.4826 * (low + high) / 2, 0.0)
+
+
+def fit_trend(usage, iterations=ROBUST_ITERATIONS):
+    """Robust (Huber) line through every row of `usage`; returns (slope per day, intercept) arrays"""
+    x = np.arange(usage.shape[1], dtype=np.float64)
+    observed = ~np.isnan(usage)
+    y = np.where(observed, usage, 0.0)
+    weights = observed.astype(np.float64)
+    slope, intercept = _weighted_line(x, y, weights)
+    for _ in range(iterations):
+        residuals = y - intercept[:, None]
+        residuals -= slope[:, None] * x
+        np.abs(residuals, out=residuals)
+        cutoff = HUBER_K * _robust_scale(residuals, observed)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.minimum(1.0, cutoff[:, None] / residuals)
+        weights[cutoff <= 0] = 1.0  # an exact fit has nothing to down-weight
+        weights *= observed
+        slope, intercept = _weighted_line(x, y, weights)
+    return slope, intercept
+
+
+def project(usage, limits):
+    """(slope in bytes/day, days until the limit is reached) per row.
+
+    Days are 0 for users already at their limit, inf when usage is flat or
+    shrinking, and NaN when there are fewer than MIN_OBSERVED_DAYS points.
+    """
+    slope, _ = fit_trend(usage)
+    remaining = limits - usage[:, -1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_left = np.where(slope > 0, remaining / slope, np.inf)
+    days_left = np.where(remaining <= 0, 0.0, days_left)
+    enough = (~np.isnan(usage)).sum(axis=1) >= MIN_OBSERVED_DAYS
+    return slope, np.where(enough, days_left, np.nan)
+
+
+def forecast_for_user(user, today=None):
+    """{'bytes_per_day', 'days_left', 'full_on'} for `user`, or None without enough history"""
+    today = today or timezone.now().date()
+    ids, usage, limits = load_usage(user_ids=[user.pk], today=today)
+    if not len(ids):
+        return None
+    slope, days_left = project(usage, limits)
+    if np.isnan(days_left[0]):
+        return None
+    full_on = today + timedelta(days=int(np.ceil(days_left[0]))) if np.isfinite(days_left[0]) else None
+    return {'bytes_per_day': float(slope[0]), 'days_left': float(days_left[0]), 'full_on': full_on}
+
+
+def upgrade_candidates(horizon_days=UPGRADE_HORIZON_DAYS, today=None):
+    """Users projected to reach their limit within `horizon_days`, soonest first.
+
+    Returns a list of (user_id, bytes per day, days left, projected date).
+    """
+    today = today or timezone.now().date()
+    ids, usage, limits = load_usage(today=today)
+    if not len(ids):
+        return []
+    slope, days_left = project(usage, limits)
+    soon = np.flatnonzero(days_left <= horizon_days)  # NaN and inf compare False
+    soon = soon[np.argsort(days_left[soon], kind='stable')]
+    return [
+        (int(ids[i]), float(slope[i]), float(days_left[i]), today + timedelta(days=int(np.ceil(days_left[i]))))
+        for i in soon
+    ]
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from storageapp.chunked_upload import collect_expired_sessions
+from storageapp.quota import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = 'Delete abandoned resumable upload sessions and their spooled chunks, and release lapsed quota reservations'
+
+    def handle(self, *args, **options):
+        removed = collect_expired_sessions()
+        released = release_expired_reservations()
+        self.stdout.write(
+            self.style.SUCCESS(f'Removed {removed} expired upload session(s) and released {released} quota reservation(s)')
+        )
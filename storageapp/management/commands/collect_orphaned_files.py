@@ -0,0 +1,86 @@
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from storageapp.orphans import STORAGE_ROOTS, build_reference_filter, delete_orphans, find_orphans
+
+
+class Command(BaseCommand):
+    help = 'Find (and delete) stored files that no photo, video, derivative, album cover or blob refers to'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report the orphaned files'
+        )
+        parser.add_argument(
+            '--grace-hours',
+            type=int,
+            default=24,
+            help='Leave files modified within this many hours alone (default: 24)'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Number of parallel storage deletes (default: 4)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Orphans re-checked against the database and deleted per batch (default: 500)'
+        )
+        parser.add_argument(
+            '--prefix',
+            action='append',
+            dest='roots',
+            help=f'Storage directory to scan; repeatable (default: the shard directories of the local backend, else {", ".join(STORAGE_ROOTS)})'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        cutoff = timezone.now() - timedelta(hours=options['grace_hours'])
+        # The sharded local backend knows its own top-level directories
+        roots = options['roots'] or getattr(default_storage, 'storage_roots', STORAGE_ROOTS)
+
+        bloom, references = build_reference_filter()
+        stats = {}
+        orphans = 0
+        deleted = 0
+        batch = []
+
+        def flush():
+            nonlocal deleted
+            removed, failures = delete_orphans(default_storage, batch, workers=options['workers'])
+            deleted += removed
+            for name, error in failures:
+                self.stderr.write(f'Could not delete {name}: {error}')
+            batch.clear()
+
+        for name in find_orphans(default_storage, bloom, cutoff, roots=roots, stats=stats):
+            orphans += 1
+            if dry_run:
+                self.stdout.write(name)
+                continue
+            batch.append(name)
+            if len(batch) >= options['batch_size']:
+                flush()
+        if batch:
+            flush()
+
+        summary = (
+            f"Scanned {stats['scanned']} file(s) against {references} reference(s). "
+            f"Found {orphans} orphan(s) older than {options['grace_hours']} hour(s)"
+        )
+        if stats['recent'] or stats['unknown_age']:
+            summary += f" (kept {stats['recent']} recent and {stats['unknown_age']} of unknown age)"
+        summary += '.' if dry_run else f'. Deleted {deleted}.'
+        self.stdout.write(self.style.SUCCESS(summary))
+        if stats['unknown_age']:
+            self.stderr.write(self.style.WARNING(
+                f"Kept {stats['unknown_age']} unreferenced file(s) whose age the storage backend cannot report; "
+                'orphans on such a backend are never deleted.'
+            ))
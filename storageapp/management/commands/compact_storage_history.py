@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from storageapp.analytics import MIN_DAILY_RETENTION_DAYS, compact_history
+
+
+class Command(BaseCommand):
+    help = 'Roll daily storage history up into weekly and monthly series, optionally pruning old daily rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=62,
+            help='Recompute the periods covering this many recent days; 0 recomputes everything (default: 62)'
+        )
+        parser.add_argument(
+            '--keep-days',
+            type=int,
+            help=f'Delete daily rows older than this many days (at least {MIN_DAILY_RETENTION_DAYS}; default: keep all)'
+        )
+
+    def handle(self, *args, **options):
+        keep_days = options['keep_days']
+        if keep_days is not None and keep_days < MIN_DAILY_RETENTION_DAYS:
+            raise CommandError(f'--keep-days must be at least {MIN_DAILY_RETENTION_DAYS} so daily charts keep their data')
+        since = timezone.now().date() - timedelta(days=options['days']) if options['days'] else None
+
+        written, pruned = compact_history(since=since, keep_days=keep_days)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} rollup(s) and pruned {pruned} daily row(s)'))
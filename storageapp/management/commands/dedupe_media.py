@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from storageapp.dedup import compute_sha256
+from storageapp.models import MediaBlob, Photo, StorageCleanupTask, Video
+
+
+class Command(BaseCommand):
+    help = 'Hash media uploaded before deduplication and collapse identical files into shared blobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many duplicate files would be removed'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        hashed = 0
+        duplicates = 0
+        seen = set()  # only used by --dry-run, which records no blobs
+
+        for model, field_name in ((Photo, 'image'), (Video, 'video_file')):
+            rows = model.objects.filter(content_hash='').exclude(**{field_name: ''}).order_by('id')
+            for instance in rows.iterator(chunk_size=100):
+                field_file = getattr(instance, field_name)
+                try:
+                    with field_file.storage.open(field_file.name, 'rb') as f:
+                        sha256 = compute_sha256(f)
+                except Exception as e:
+                    self.stderr.write(f'Skipping {model.__name__} {instance.pk}: {e}')
+                    continue
+                hashed += 1
+                if dry_run:
+                    if sha256 in seen or MediaBlob.objects.filter(sha256=sha256).exists():
+                        duplicates += 1
+                    seen.add(sha256)
+                    continue
+
+                with transaction.atomic():
+                    blob, created = MediaBlob.objects.select_for_update().get_or_create(
+                        sha256=sha256,
+                        defaults={'size': instance.file_size, 'storage_name': field_file.name},
+                    )
+                    MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+                    model.objects.filter(pk=instance.pk).update(content_hash=sha256, **{field_name: blob.storage_name})
+                    if not created and blob.storage_name != field_file.name:
+                        duplicates += 1
+                        StorageCleanupTask.enqueue([field_file.name])
+
+        verb = 'Would remove' if dry_run else 'Removed'
+        self.stdout.write(
+            self.style.SUCCESS(f'Hashed {hashed} file(s). {verb} {duplicates} duplicate file(s).')
+        )
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from storageapp.derivatives import generate_photo_derivatives
+from storageapp.models import Photo
+
+
+class Command(BaseCommand):
+    help = 'Generate grid thumbnails for photos that do not have any yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--replace',
+            action='store_true',
+            help='Regenerate thumbnails even for photos that already have them'
+        )
+
+    def handle(self, *args, **options):
+        photos = Photo.objects.select_related('user').order_by('id')
+        if not options['replace']:
+            photos = photos.filter(derivatives__isnull=True)
+
+        processed = 0
+        for photo in photos.iterator(chunk_size=200):
+            if generate_photo_derivatives(photo, replace=options['replace']):
+                processed += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Generated thumbnails for {processed} photo(s)')
+        )
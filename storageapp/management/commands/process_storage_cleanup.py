@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from storageapp.storage_cleanup import CLEANUP_BATCH_SIZE, process_cleanup_queue
+
+
+class Command(BaseCommand):
+    help = 'Delete queued files of removed media from the storage backend, retrying earlier failures'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=CLEANUP_BATCH_SIZE,
+            help='Number of files to claim per batch'
+        )
+
+    def handle(self, *args, **options):
+        deleted, skipped, failed = process_cleanup_queue(batch_size=options['batch_size'])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Deleted {deleted} file(s). Skipped {skipped} still in use. {failed} failed and will be retried.'
+            )
+        )
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from storageapp.trash import PURGE_BATCH_SIZE, purge_expired
+
+
+class Command(BaseCommand):
+    help = 'Permanently delete trashed photos and videos past their retention period or emptied by their owner'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=PURGE_BATCH_SIZE,
+            help='Number of items deleted per transaction'
+        )
+
+    def handle(self, *args, **options):
+        purged = purge_expired(batch_size=options['batch_size'])
+        self.stdout.write(
+            self.style.SUCCESS(f'Purged {purged} trashed item(s)')
+        )
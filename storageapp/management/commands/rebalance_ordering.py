@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from storageapp.models import Album, AlbumPhoto, AlbumVideo, Photo, Video
+from storageapp.ordering import ALBUM_ITEM_ORDERING, MEDIA_ORDERING, rebalance
+
+
+class Command(BaseCommand):
+    help = 'Re-space drag-and-drop order values for libraries and albums whose gaps have run low'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Re-space every scope, not only those with crowded order values'
+        )
+
+    def handle(self, *args, **options):
+        force = options['force']
+        scopes = 0
+        rows = 0
+
+        for user_id in Photo.objects.order_by().values_list('user_id', flat=True).distinct():
+            written = rebalance(Photo.objects.filter(user_id=user_id), MEDIA_ORDERING, force=force)
+            scopes += bool(written)
+            rows += written
+        for user_id in Video.objects.order_by().values_list('user_id', flat=True).distinct():
+            written = rebalance(Video.objects.filter(user_id=user_id), MEDIA_ORDERING, force=force)
+            scopes += bool(written)
+            rows += written
+        for album_id in Album.objects.order_by('id').values_list('id', flat=True).iterator():
+            for model in (AlbumPhoto, AlbumVideo):
+                written = rebalance(model.objects.filter(album_id=album_id), ALBUM_ITEM_ORDERING, force=force)
+                scopes += bool(written)
+                rows += written
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Re-spaced {rows} row(s) across {scopes} list(s)')
+        )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from storageapp.models import Album
+
+
+class Command(BaseCommand):
+    help = 'Recompute album photo/video counts and byte totals from their items'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--album',
+            type=int,
+            action='append',
+            dest='album_ids',
+            help='Only rebuild the album with this id (may be repeated)'
+        )
+
+    def handle(self, *args, **options):
+        updated = Album.rebuild_counters(album_ids=options['album_ids'])
+        self.stdout.write(
+            self.style.SUCCESS(f'Rebuilt counters for {updated} album(s)')
+        )
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from storageapp.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = 'Recompute UserProfile.storage_used from photo and video sizes for all users'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            action='append',
+            dest='usernames',
+            help='Only reconcile the given username (may be repeated)'
+        )
+
+    def handle(self, *args, **options):
+        usernames = options['usernames']
+
+        # Make sure every user has a profile row to hold the total
+        users_without_profile = User.objects.filter(profile__isnull=True)
+        if usernames:
+            users_without_profile = users_without_profile.filter(username__in=usernames)
+        created = UserProfile.objects.bulk_create(
+            [UserProfile(user=user) for user in users_without_profile]
+        )
+        if created:
+            self.stdout.write(f'Created {len(created)} missing profile(s)')
+
+        user_ids = None
+        if usernames:
+            user_ids = list(User.objects.filter(username__in=usernames).values_list('id', flat=True))
+
+        updated = UserProfile.recalculate_storage_used(user_ids=user_ids)
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Reconciled storage usage for {updated} profile(s)')
+        )
@@ -0,0 +1,28 @@
+# Seed the incremental storage ledger from existing media rows
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def reconcile_storage_used(apps, schema_editor):
+    UserProfile = apps.get_model('storageapp', 'UserProfile')
+    Photo = apps.get_model('storageapp', 'Photo')
+    Video = apps.get_model('storageapp', 'Video')
+    zero = Value(0, output_field=models.BigIntegerField())
+    photo_totals = Photo.objects.filter(user=OuterRef('user')).order_by().values('user').annotate(total=Sum('file_size')).values('total')
+    video_totals = Video.objects.filter(user=OuterRef('user')).order_by().values('user').annotate(total=Sum('file_size')).values('total')
+    UserProfile.objects.update(
+        storage_used=Coalesce(Subquery(photo_totals), zero) + Coalesce(Subquery(video_totals), zero)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0019_alter_photo_options_alter_video_options_photo_order_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(reconcile_storage_used, migrations.RunPython.noop),
+    ]
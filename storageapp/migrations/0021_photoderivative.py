@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-18 14:56
+
+import django.db.models.deletion
+import storageapp.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0020_reconcile_storage_used'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoDerivative',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveIntegerField()),
+                ('format', models.CharField(choices=[('jpeg', 'JPEG'), ('webp', 'WebP')], max_length=4)),
+                ('file', models.ImageField(upload_to=storageapp.models.derivative_media_path)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('file_size', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('photo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='derivatives', to='storageapp.photo')),
+            ],
+            options={
+                'ordering': ['size'],
+                'unique_together': {('photo', 'size', 'format')},
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-18 14:57
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0021_photoderivative'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['user', 'order', '-uploaded_at', '-id'], name='photo_user_order_idx'),
+        ),
+    ]
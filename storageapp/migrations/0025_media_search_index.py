@@ -0,0 +1,81 @@
+# Generated by Django 5.1.7 on 2026-10-18 15:03
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+# Photos take even FTS5 rowids (id * 2) and videos odd ones (id * 2 + 1)
+SQLITE_FTS_TABLE = (
+    "CREATE VIRTUAL TABLE storageapp_media_fts USING fts5("
+    "user_id UNINDEXED, title, description, tokenize='porter unicode61')"
+)
+SQLITE_FTS_TRIGGERS = [
+    trigger.format(table=table, offset=offset)
+    for table, offset in (('storageapp_photo', 0), ('storageapp_video', 1))
+    for trigger in (
+        "CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+        "INSERT INTO storageapp_media_fts(rowid, user_id, title, description) "
+        "VALUES (new.id * 2 + {offset}, new.user_id, new.title, new.description); END",
+        "CREATE TRIGGER {table}_fts_update AFTER UPDATE OF user_id, title, description ON {table} BEGIN "
+        "UPDATE storageapp_media_fts SET user_id = new.user_id, title = new.title, description = new.description "
+        "WHERE rowid = new.id * 2 + {offset}; END",
+        "CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+        "DELETE FROM storageapp_media_fts WHERE rowid = old.id * 2 + {offset}; END",
+    )
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for table in ('storageapp_photo', 'storageapp_video'):
+            schema_editor.execute(
+                f"UPDATE {table} SET search_vector = "
+                "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+            )
+            schema_editor.execute(f"CREATE INDEX {table}_search_gin ON {table} USING gin (search_vector)")
+    elif vendor == 'sqlite':
+        schema_editor.execute(SQLITE_FTS_TABLE)
+        for trigger in SQLITE_FTS_TRIGGERS:
+            schema_editor.execute(trigger)
+        schema_editor.execute(
+            "INSERT INTO storageapp_media_fts(rowid, user_id, title, description) "
+            "SELECT id * 2, user_id, title, description FROM storageapp_photo"
+        )
+        schema_editor.execute(
+            "INSERT INTO storageapp_media_fts(rowid, user_id, title, description) "
+            "SELECT id * 2 + 1, user_id, title, description FROM storageapp_video"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        for table in ('storageapp_photo', 'storageapp_video'):
+            schema_editor.execute(f"DROP INDEX IF EXISTS {table}_search_gin")
+    elif vendor == 'sqlite':
+        for table in ('storageapp_photo', 'storageapp_video'):
+            for suffix in ('insert', 'update', 'delete'):
+                schema_editor.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{suffix}")
+        schema_editor.execute("DROP TABLE IF EXISTS storageapp_media_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0024_media_blob_dedup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
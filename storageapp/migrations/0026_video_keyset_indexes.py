@@ -0,0 +1,31 @@
+# Generated by Django 5.1.7 on 2026-10-18 15:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0025_media_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(fields=['user', 'order', '-uploaded_at', '-id'], name='video_user_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(fields=['user', 'uploaded_at', 'id'], name='video_user_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(fields=['user', 'file_size', 'id'], name='video_user_size_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(fields=['user', 'title', 'id'], name='video_user_title_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.1.7 on 2026-10-18 15:07
+
+from django.db import migrations, models
+
+ORDER_GAP = 1 << 16  # ordering.ORDER_GAP at the time of this migration
+
+
+def spread_orders(apps, schema_editor):
+    """Re-number every scope's rows ORDER_GAP apart, keeping the order users see"""
+    scopes = [
+        ('Photo', 'user_id', ('user_id', 'order', '-uploaded_at', '-id')),
+        ('Video', 'user_id', ('user_id', 'order', '-uploaded_at', '-id')),
+        ('AlbumPhoto', 'album_id', ('album_id', 'order', 'id')),
+        ('AlbumVideo', 'album_id', ('album_id', 'order', 'id')),
+    ]
+    for model_name, scope_field, ordering in scopes:
+        model = apps.get_model('storageapp', model_name)
+        batch = []
+        scope = position = None
+        for row in model.objects.order_by(*ordering).only('id', scope_field, 'order').iterator(chunk_size=2000):
+            if getattr(row, scope_field) != scope:
+                scope, position = getattr(row, scope_field), 0
+            position += 1
+            row.order = position * ORDER_GAP
+            batch.append(row)
+            if len(batch) >= 1000:
+                model.objects.bulk_update(batch, ['order'])
+                batch = []
+        model.objects.bulk_update(batch, ['order'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0026_video_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='albumphoto',
+            name='order',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='albumvideo',
+            name='order',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='photo',
+            name='order',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='video',
+            name='order',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(spread_orders, migrations.RunPython.noop),
+    ]
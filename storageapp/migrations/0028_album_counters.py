@@ -0,0 +1,46 @@
+# Generated by Django 5.1.7 on 2026-10-18 15:11
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def seed_album_counters(apps, schema_editor):
+    Album = apps.get_model('storageapp', 'Album')
+    AlbumPhoto = apps.get_model('storageapp', 'AlbumPhoto')
+    AlbumVideo = apps.get_model('storageapp', 'AlbumVideo')
+    zero = Value(0, output_field=models.BigIntegerField())
+    photos = AlbumPhoto.objects.filter(album=OuterRef('pk')).order_by().values('album')
+    videos = AlbumVideo.objects.filter(album=OuterRef('pk')).order_by().values('album')
+    Album.objects.update(
+        photo_count=Coalesce(Subquery(photos.annotate(n=Count('id')).values('n')), zero),
+        video_count=Coalesce(Subquery(videos.annotate(n=Count('id')).values('n')), zero),
+        total_bytes=Coalesce(Subquery(photos.annotate(total=Sum('photo__file_size')).values('total')), zero)
+        + Coalesce(Subquery(videos.annotate(total=Sum('video__file_size')).values('total')), zero),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0027_sparse_ordering'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='photo_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='total_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='video_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(seed_album_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.7 on 2026-10-18 15:18
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0028_album_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageCleanupTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('storage_name', models.CharField(max_length=255, unique=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['next_attempt_at', 'id'], name='storage_cleanup_due_idx')],
+            },
+        ),
+    ]
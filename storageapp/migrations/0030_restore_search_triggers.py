@@ -0,0 +1,38 @@
+from importlib import import_module
+
+from django.db import migrations
+
+# SQLite rebuilds a table to alter a column (0027_sparse_ordering did so for
+# storageapp_photo/storageapp_video), which silently drops the FTS5 triggers
+# created in 0025_media_search_index. Recreate them and re-sync the index.
+search_index = import_module('storageapp.migrations.0025_media_search_index')
+
+
+def restore_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for table in ('storageapp_photo', 'storageapp_video'):
+        for suffix in ('insert', 'update', 'delete'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{suffix}")
+    for trigger in search_index.SQLITE_FTS_TRIGGERS:
+        schema_editor.execute(trigger)
+    schema_editor.execute("DELETE FROM storageapp_media_fts")
+    schema_editor.execute(
+        "INSERT INTO storageapp_media_fts(rowid, user_id, title, description) "
+        "SELECT id * 2, user_id, title, description FROM storageapp_photo"
+    )
+    schema_editor.execute(
+        "INSERT INTO storageapp_media_fts(rowid, user_id, title, description) "
+        "SELECT id * 2 + 1, user_id, title, description FROM storageapp_video"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0029_storage_cleanup_queue'),
+    ]
+
+    operations = [
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
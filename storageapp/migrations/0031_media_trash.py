@@ -0,0 +1,110 @@
+# Generated by Django 5.1.7 on 2026-10-18 15:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+# Keep trashed media out of the SQLite FTS5 search table (see 0025_media_search_index)
+SQLITE_FTS_TRASH_TRIGGERS = [
+    trigger.format(table=table, offset=offset)
+    for table, offset in (('storageapp_photo', 0), ('storageapp_video', 1))
+    for trigger in (
+        "CREATE TRIGGER {table}_fts_trash AFTER UPDATE OF deleted_at ON {table} "
+        "WHEN old.deleted_at IS NULL AND new.deleted_at IS NOT NULL BEGIN "
+        "DELETE FROM storageapp_media_fts WHERE rowid = new.id * 2 + {offset}; END",
+        "CREATE TRIGGER {table}_fts_restore AFTER UPDATE OF deleted_at ON {table} "
+        "WHEN old.deleted_at IS NOT NULL AND new.deleted_at IS NULL BEGIN "
+        "INSERT INTO storageapp_media_fts(rowid, user_id, title, description) "
+        "VALUES (new.id * 2 + {offset}, new.user_id, new.title, new.description); END",
+    )
+]
+
+
+def create_trash_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for trigger in SQLITE_FTS_TRASH_TRIGGERS:
+            schema_editor.execute(trigger)
+
+
+def drop_trash_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for table in ('storageapp_photo', 'storageapp_video'):
+            for suffix in ('trash', 'restore'):
+                schema_editor.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{suffix}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0030_restore_search_triggers'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='photo',
+            name='photo_user_order_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='video',
+            name='video_user_order_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='video',
+            name='video_user_uploaded_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='video',
+            name='video_user_size_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='video',
+            name='video_user_title_idx',
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['user', 'order', '-uploaded_at', '-id'], name='photo_user_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['user', '-deleted_at'], name='photo_trash_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['deleted_at', 'id'], name='photo_trash_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['user', 'order', '-uploaded_at', '-id'], name='video_user_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['user', 'uploaded_at', 'id'], name='video_user_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['user', 'file_size', 'id'], name='video_user_size_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['user', 'title', 'id'], name='video_user_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['user', '-deleted_at'], name='video_trash_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='video',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['deleted_at', 'id'], name='video_trash_expiry_idx'),
+        ),
+        migrations.RunPython(create_trash_triggers, drop_trash_triggers),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.7 on 2026-10-18 15:36
+
+import django.db.models.deletion
+import storageapp.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0032_storage_events'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('week', 'Week'), ('month', 'Month')], max_length=5)),
+                ('period_start', models.DateField()),
+                ('storage_used', models.BigIntegerField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='storage_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['period_start'],
+                'constraints': [models.UniqueConstraint(fields=('user', 'resolution', 'period_start'), name='storage_rollup_period_uniq')],
+            },
+            bases=(storageapp.models.ContentVersionMixin, models.Model),
+        ),
+    ]
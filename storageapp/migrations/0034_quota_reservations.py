@@ -0,0 +1,49 @@
+# Generated by Django 5.1.7 on 2026-10-18 15:42
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def sync_storage_limits(apps, schema_editor):
+    # Uploads are now checked against storage_limit, which only the dashboard used to keep current
+    UserProfile = apps.get_model('storageapp', 'UserProfile')
+    UserProfile.objects.filter(has_paid_for_extra_storage=False).update(storage_limit=5368709120)
+    UserProfile.objects.filter(has_paid_for_extra_storage=True).update(storage_limit=107374182400)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0033_storage_rollups'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='storage_reserved',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='StorageReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nbytes', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires_at', models.DateTimeField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='storage_reservations', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='reservation',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='storageapp.storagereservation'),
+        ),
+        migrations.AddIndex(
+            model_name='storagereservation',
+            index=models.Index(fields=['expires_at'], name='storage_reservation_exp_idx'),
+        ),
+        migrations.RunPython(sync_storage_limits, migrations.RunPython.noop),
+    ]
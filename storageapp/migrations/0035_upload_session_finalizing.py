@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storageapp', '0034_quota_reservations'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='status',
+            field=models.CharField(choices=[('active', 'Active'), ('finalizing', 'Finalizing'), ('completed', 'Completed')], default='active', max_length=10),
+        ),
+    ]
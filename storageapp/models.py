@@ -1,10 +1,15 @@
-from django.db import models
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.utils import timezone
+from collections import Counter
 import os
 import uuid
 from django.conf import settings
 from django.urls import reverse
+from .cache_versions import album_scope, bump, media_scope, notifications_scope, profile_scope
 
 def user_media_path(instance, filename):
     """Generate file path for user media files"""
@@ -15,67 +20,498 @@ def user_media_path(instance, filename):
         # Fallback for when user is not set yet
         return f'uploads/{instance.__class__.__name__.lower()}s/{filename}'
 
-class Album(models.Model):
+# Partial index conditions for Photo/Video
+ACTIVE = models.Q(deleted_at__isnull=True)
+TRASHED = models.Q(deleted_at__isnull=False)
+
+BASE_STORAGE_LIMIT = 5368709120  # 5GB
+EXTRA_STORAGE_LIMIT = 107374182400  # 100GB
+
+class VersionedQuerySet(models.QuerySet):
+    """Bump the cache_versions scopes of every row a bulk write touches (see ContentVersionMixin)"""
+
+    def _version_scopes(self, rows=None):
+        field, scope = self.model.version_scope
+        rows = self if rows is None else rows
+        return [scope(value) for value in rows.order_by().values_list(field, flat=True).distinct()]
+
+    def update(self, **kwargs):
+        scopes = self._version_scopes()
+        result = super().update(**kwargs)
+        bump(*scopes)
+        return result
+
+    def delete(self):
+        scopes = self._version_scopes()
+        result = super().delete()
+        bump(*scopes)
+        return result
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        result = super().bulk_create(objs, *args, **kwargs)
+        field, scope = self.model.version_scope
+        bump(*{scope(getattr(obj, field)) for obj in objs})
+        return result
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        result = super().bulk_update(objs, fields, *args, **kwargs)
+        # Rows are often loaded with only() the updated fields, so read the scopes in one query
+        bump(*self._version_scopes(self.model._base_manager.filter(pk__in=[obj.pk for obj in objs])))
+        return result
+
+class MediaQuerySet(VersionedQuerySet):
+    def active(self):
+        return self.filter(deleted_at__isnull=True)
+
+    def trashed(self):
+        return self.filter(deleted_at__isnull=False)
+
+    def trash(self):
+        """Move media to the trash in one UPDATE; returns the number of rows trashed.
+
+        Trashed media keeps its files, album memberships and storage charge
+        until it is purged, but drops out of album counters and shares.
+        """
+        active = self.active()
+        item_model = self.model.album_item_model()
+        with transaction.atomic():
+            album_totals = item_model.objects.filter(**{f'{self.model.album_item_field}__in': active.values('pk')}).album_totals()
+            self.model.invalidate_shares(active.values('pk'))
+            trashed = active.update(deleted_at=timezone.now())
+            Album.release_items(item_model, album_totals)
+        return trashed
+
+    def restore(self):
+        """Take media out of the trash in one UPDATE; returns the number of rows restored"""
+        trashed = self.trashed()
+        item_model = self.model.album_item_model()
+        with transaction.atomic():
+            ids = list(trashed.values_list('pk', flat=True))
+            restored = self.model.all_objects.filter(pk__in=ids).update(deleted_at=None)
+            # album_totals() only counts active media, so read it after the update
+            album_totals = item_model.objects.filter(**{f'{self.model.album_item_field}__in': ids}).album_totals()
+            Album.add_items(item_model, album_totals)
+        return restored
+
+    def delete(self):
+        """Bulk delete media and release the freed bytes from each owner's storage ledger"""
+        with transaction.atomic():
+            totals = list(
+                self.order_by().values('user_id').annotate(total=Sum('file_size'))
+            )
+            hashes = list(self.exclude(content_hash='').values_list('content_hash', flat=True))
+            storage_names = self.model.owned_storage_names(self)
+            album_totals = self.model.album_item_model().objects.filter(
+                **{f'{self.model.album_item_field}__in': self.values('pk')}
+            ).album_totals()
+            self.model.invalidate_shares(self.values('pk'))
+            result = super().delete()
+            for row in totals:
+                UserProfile.adjust_storage_used(row['user_id'], -(row['total'] or 0))
+            StorageCleanupTask.enqueue(storage_names)
+            MediaBlob.release(hashes)
+            Album.release_items(self.model.album_item_model(), album_totals)
+        return result
+
+
+class ActiveMediaManager(models.Manager.from_queryset(MediaQuerySet)):
+    """Default media manager: hides trashed rows (``all_objects`` includes them)"""
+
+    def get_queryset(self):
+        return super().get_queryset().active()
+
+
+class StorageLedgerMixin:
+    """Keep UserProfile.storage_used and MediaBlob reference counts in step with saved/deleted media"""
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the size the ledger has already been charged for this row
+        instance._ledger_file_size = instance.__dict__.get('file_size')
+        return instance
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        previous_size = 0 if adding else getattr(self, '_ledger_file_size', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if previous_size is not None:
+                UserProfile.adjust_storage_used(self.user_id, self.file_size - previous_size)
+            if adding and self.content_hash:
+                MediaBlob.objects.filter(sha256=self.content_hash).update(ref_count=F('ref_count') + 1)
+        self._ledger_file_size = self.file_size
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            # Album rows go with the media through the cascade, which bypasses their own hooks
+            album_totals = self.album_item_model().objects.filter(**{self.album_item_field: self}).album_totals()
+            self.invalidate_shares([self.pk])
+            storage_names = self.owned_storage_names(type(self)._base_manager.filter(pk=self.pk))
+            result = super().delete(*args, **kwargs)
+            UserProfile.adjust_storage_used(self.user_id, -self.file_size)
+            StorageCleanupTask.enqueue(storage_names)
+            MediaBlob.release([self.content_hash])
+            Album.release_items(self.album_item_model(), album_totals)
+        return result
+
+    @classmethod
+    def album_item_model(cls):
+        """The AlbumPhoto/AlbumVideo model linking this media type to albums"""
+        return cls._meta.get_field(cls.album_item_relation).related_model
+
+    @classmethod
+    def owned_storage_names(cls, rows):
+        """Names of the stored files that go away with `rows`.
+
+        Covers the original of every row not sharing a MediaBlob (shared
+        files are released by reference count) plus per-row files such as
+        thumbnails and derivatives.
+        """
+        names = list(rows.filter(content_hash='').values_list(cls.media_file_field, flat=True))
+        for lookup in cls.owned_file_lookups:
+            names += rows.values_list(lookup, flat=True)
+        return [name for name in names if name]
+
+    @classmethod
+    def invalidate_shares(cls, media_ids):
+        """Drop cached public share pages for the given media (e.g. before deleting them)"""
+        from .share_cache import invalidate_shares
+        share_model = cls._meta.get_field('shares').related_model
+        tokens = share_model.objects.filter(**{f'{cls.album_item_field}__in': media_ids}).values_list('share_token', flat=True)
+        invalidate_shares(cls.album_item_field, list(tokens))
+
+class ContentVersionMixin:
+    """Bump the row's cache_versions scope whenever it is saved or deleted.
+
+    Models set ``version_scope`` to a (field name, scope function) pair, e.g.
+    ``('user_id', media_scope)``; VersionedQuerySet covers their bulk writes.
+    """
+
+    def version_scopes(self):
+        field, scope = self.version_scope
+        return [scope(getattr(self, field))]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump(*self.version_scopes())
+
+    def delete(self, *args, **kwargs):
+        scopes = self.version_scopes()  # before the pk is cleared
+        result = super().delete(*args, **kwargs)
+        bump(*scopes)
+        return result
+
+class SearchIndexMixin:
+    """Keep the weighted title/description search_vector current on PostgreSQL.
+
+    SQLite indexes the same columns through FTS5 triggers (see storageapp.search).
+    """
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if connection.vendor == 'postgresql' and (update_fields is None or {'title', 'description'} & set(update_fields)):
+            type(self)._base_manager.filter(pk=self.pk).update(
+                search_vector=SearchVector('title', weight='A', config='english')
+                + SearchVector('description', weight='B', config='english')
+            )
+
+class MediaBlob(models.Model):
+    """One stored copy of some media bytes, shared by every Photo/Video with the same content hash"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    storage_name = models.CharField(max_length=255)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.ref_count} refs)"
+
+    @classmethod
+    def release(cls, hashes):
+        """Drop one reference per entry in `hashes`; unreferenced blobs are deleted along with their file"""
+        counts = Counter(h for h in hashes if h)
+        if not counts:
+            return
+        for sha256, references in counts.items():
+            cls.objects.filter(sha256=sha256).update(ref_count=F('ref_count') - references)
+        unreferenced = cls.objects.filter(sha256__in=counts, ref_count__lte=0)
+        storage_names = list(unreferenced.values_list('storage_name', flat=True))
+        unreferenced.delete()
+        StorageCleanupTask.enqueue(storage_names)
+
+class StorageCleanupTask(models.Model):
+    """A stored file waiting to be removed from the storage backend (see storageapp.storage_cleanup)"""
+    storage_name = models.CharField(max_length=255, unique=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at', 'id'], name='storage_cleanup_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.storage_name} ({self.attempts} attempts)"
+
+    @classmethod
+    def enqueue(cls, storage_names):
+        """Queue files for deletion as part of the current transaction, so rows and files go together"""
+        tasks = [cls(storage_name=name) for name in dict.fromkeys(storage_names) if name]
+        if tasks:
+            cls.objects.bulk_create(tasks, ignore_conflicts=True, batch_size=1000)
+
+class Album(ContentVersionMixin, models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='albums')
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
     cover_image = models.ImageField(upload_to='album_covers/', blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized from AlbumPhoto/AlbumVideo rows; rebuild with `manage.py rebuild_album_counters`
+    photo_count = models.IntegerField(default=0)
+    video_count = models.IntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+
+    objects = VersionedQuerySet.as_manager()
+    version_scope = ('pk', album_scope)
 
     def __str__(self):
         return f"{self.name} ({self.user})"
 
-class AlbumPhoto(models.Model):
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if not adding:
+            from .share_cache import invalidate_album_shares
+            invalidate_album_shares([self.pk])
+
+    def delete(self, *args, **kwargs):
+        # Tokens must be read before the cascade removes the shares
+        from .share_cache import invalidate_album_shares
+        invalidate_album_shares([self.pk])
+        return super().delete(*args, **kwargs)
+
+    @classmethod
+    def adjust_counters(cls, album_id, size=0, **counts):
+        """Atomically add to an album's byte total and item counts, e.g. photo_count=1 (negative to remove)"""
+        updates = {field: F(field) + delta for field, delta in counts.items() if delta}
+        if size:
+            updates['total_bytes'] = F('total_bytes') + size
+        if updates:
+            # The plain manager skips VersionedQuerySet's scope lookup; the bump below covers it
+            cls._base_manager.filter(pk=album_id).update(**updates)
+            from .share_cache import invalidate_album_shares
+            invalidate_album_shares([album_id])
+            bump(album_scope(album_id))
+
+    @classmethod
+    def release_items(cls, item_model, album_totals):
+        """Apply AlbumItemQuerySet.album_totals() rows for items of `item_model` that were removed"""
+        for row in album_totals:
+            cls.adjust_counters(row['album_id'], size=-(row['size'] or 0), **{item_model.counter_field: -row['items']})
+
+    @classmethod
+    def add_items(cls, item_model, album_totals):
+        """Apply AlbumItemQuerySet.album_totals() rows for items of `item_model` that were added back"""
+        for row in album_totals:
+            cls.adjust_counters(row['album_id'], size=row['size'] or 0, **{item_model.counter_field: row['items']})
+
+    @classmethod
+    def rebuild_counters(cls, album_ids=None):
+        """Recompute the denormalized counters from the album item rows in a single UPDATE statement"""
+        zero = Value(0, output_field=models.BigIntegerField())
+        photos = AlbumPhoto.objects.filter(album=OuterRef('pk'), photo__deleted_at__isnull=True).order_by().values('album')
+        videos = AlbumVideo.objects.filter(album=OuterRef('pk'), video__deleted_at__isnull=True).order_by().values('album')
+        albums = cls.objects.all()
+        if album_ids is not None:
+            albums = albums.filter(pk__in=album_ids)
+        return albums.update(
+            photo_count=Coalesce(Subquery(photos.annotate(n=Count('id')).values('n')), zero),
+            video_count=Coalesce(Subquery(videos.annotate(n=Count('id')).values('n')), zero),
+            total_bytes=Coalesce(Subquery(photos.annotate(total=Sum('photo__file_size')).values('total')), zero)
+            + Coalesce(Subquery(videos.annotate(total=Sum('video__file_size')).values('total')), zero),
+        )
+
+class AlbumItemQuerySet(VersionedQuerySet):
+    def active(self):
+        """Items whose media is not in the trash"""
+        return self.filter(**{f'{self.model.media_field}__deleted_at__isnull': True})
+
+    def album_totals(self):
+        """Item count and media bytes per album for the rows in this queryset whose media is not trashed"""
+        return list(
+            self.active().order_by().values('album_id').annotate(
+                items=Count('id'), size=Sum(f'{self.model.media_field}__file_size')
+            )
+        )
+
+    def delete(self):
+        """Bulk delete album items and take them off their albums' counters"""
+        with transaction.atomic():
+            totals = self.album_totals()
+            result = super().delete()
+            Album.release_items(self.model, totals)
+        return result
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """Bulk insert album items and add them to their albums' counters"""
+        objs = list(objs)
+        media_field = self.model.media_field
+        with transaction.atomic():
+            result = super().bulk_create(objs, *args, **kwargs)
+            media_model = self.model._meta.get_field(media_field).related_model
+            sizes = dict(media_model.objects.filter(
+                pk__in={getattr(obj, f'{media_field}_id') for obj in objs}
+            ).values_list('pk', 'file_size'))
+            added = Counter()
+            added_bytes = Counter()
+            for obj in objs:
+                if getattr(obj, f'{media_field}_id') not in sizes:
+                    continue  # trashed media is not counted
+                added[obj.album_id] += 1
+                added_bytes[obj.album_id] += sizes.get(getattr(obj, f'{media_field}_id'), 0)
+            for album_id, items in added.items():
+                Album.adjust_counters(album_id, size=added_bytes[album_id], **{self.model.counter_field: items})
+        return result
+
+class AlbumCounterMixin:
+    """Keep the owning Album's counters in step with saved/deleted album items"""
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            media = getattr(self, self.media_field)
+            if adding and media.deleted_at is None:
+                Album.adjust_counters(self.album_id, size=media.file_size, **{self.counter_field: 1})
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            media = getattr(self, self.media_field)
+            if media.deleted_at is None:
+                Album.adjust_counters(self.album_id, size=-media.file_size, **{self.counter_field: -1})
+        return result
+
+class AlbumPhoto(AlbumCounterMixin, ContentVersionMixin, models.Model):
     album = models.ForeignKey(Album, on_delete=models.CASCADE, related_name='album_photos')
     photo = models.ForeignKey('Photo', on_delete=models.CASCADE, related_name='album_photos')
-    order = models.PositiveIntegerField(default=0)
+    order = models.BigIntegerField(default=0)  # sparse; see ordering.py
+
+    objects = AlbumItemQuerySet.as_manager()
+    version_scope = ('album_id', album_scope)
+    media_field = 'photo'
+    counter_field = 'photo_count'
     
     class Meta:
         ordering = ['order']
         unique_together = ['album', 'photo']
 
-class AlbumVideo(models.Model):
+class AlbumVideo(AlbumCounterMixin, ContentVersionMixin, models.Model):
     album = models.ForeignKey(Album, on_delete=models.CASCADE, related_name='album_videos')
     video = models.ForeignKey('Video', on_delete=models.CASCADE, related_name='album_videos')
-    order = models.PositiveIntegerField(default=0)
+    order = models.BigIntegerField(default=0)  # sparse; see ordering.py
+
+    objects = AlbumItemQuerySet.as_manager()
+    version_scope = ('album_id', album_scope)
+    media_field = 'video'
+    counter_field = 'video_count'
     
     class Meta:
         ordering = ['order']
         unique_together = ['album', 'video']
 
-class Photo(models.Model):
+class Photo(StorageLedgerMixin, ContentVersionMixin, SearchIndexMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='photos')
     title = models.CharField(max_length=200, blank=True)
     description = models.TextField(blank=True)
     image = models.ImageField(upload_to=user_media_path)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)  # SHA-256 of the image bytes
     uploaded_at = models.DateTimeField(default=timezone.now)
     file_size = models.BigIntegerField(default=0)
-    order = models.PositiveIntegerField(default=0)
+    order = models.BigIntegerField(default=0)  # sparse; see ordering.py
+    deleted_at = models.DateTimeField(null=True, blank=True)  # set while the item is in the trash
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ActiveMediaManager()
+    all_objects = MediaQuerySet.as_manager()
+    version_scope = ('user_id', media_scope)
+    album_item_relation = 'album_photos'
+    album_item_field = 'photo'
+    media_file_field = 'image'
+    owned_file_lookups = ('derivatives__file',)
     
     def save(self, *args, **kwargs):
-        if self.image:
+        # Only measure new uploads; committed files would cost a storage round-trip
+        if self.image and (not self.image._committed or not self.file_size):
             self.file_size = self.image.size
         super().save(*args, **kwargs)
     
     def __str__(self):
         return f"{self.user.username} - {self.title or self.image.name}"
+
+    def get_derivative(self, size=512, format='jpeg'):
+        """Smallest derivative at least `size` px wide in `format`, else the largest one available"""
+        # Iterate .all() so prefetch_related('derivatives') avoids a query per photo
+        candidates = [d for d in self.derivatives.all() if d.format == format]
+        if not candidates:
+            return None
+        large_enough = [d for d in candidates if d.size >= size]
+        if large_enough:
+            return min(large_enough, key=lambda d: d.size)
+        return max(candidates, key=lambda d: d.size)
+
+    @property
+    def thumbnail_url(self):
+        """JPEG grid thumbnail, falling back to the original image"""
+        derivative = self.get_derivative(format=PhotoDerivative.JPEG)
+        return derivative.file.url if derivative else self.image.url
+
+    @property
+    def thumbnail_webp_url(self):
+        derivative = self.get_derivative(format=PhotoDerivative.WEBP)
+        return derivative.file.url if derivative else None
     
     class Meta:
         ordering = ['order', '-uploaded_at']
+        indexes = [
+            # Keyset pagination sort key for photos/photos_ajax; partial, so trashed rows cost nothing
+            models.Index(fields=['user', 'order', '-uploaded_at', '-id'], name='photo_user_order_idx', condition=ACTIVE),
+            # Trash page and purge_trash
+            models.Index(fields=['user', '-deleted_at'], name='photo_trash_idx', condition=TRASHED),
+            models.Index(fields=['deleted_at', 'id'], name='photo_trash_expiry_idx', condition=TRASHED),
+        ]
 
-class Video(models.Model):
+class Video(StorageLedgerMixin, ContentVersionMixin, SearchIndexMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='videos')
     title = models.CharField(max_length=200, blank=True)
     description = models.TextField(blank=True)
     video_file = models.FileField(upload_to=user_media_path)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)  # SHA-256 of the video bytes
     thumbnail = models.ImageField(upload_to=user_media_path, blank=True, null=True)
     uploaded_at = models.DateTimeField(default=timezone.now)
     file_size = models.BigIntegerField(default=0)
     duration = models.DurationField(blank=True, null=True)
-    order = models.PositiveIntegerField(default=0)
+    order = models.BigIntegerField(default=0)  # sparse; see ordering.py
+    deleted_at = models.DateTimeField(null=True, blank=True)  # set while the item is in the trash
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ActiveMediaManager()
+    all_objects = MediaQuerySet.as_manager()
+    version_scope = ('user_id', media_scope)
+    album_item_relation = 'album_videos'
+    album_item_field = 'video'
+    media_file_field = 'video_file'
+    owned_file_lookups = ('thumbnail',)
     
     def save(self, *args, **kwargs):
-        if self.video_file:
+        # Only measure new uploads; committed files would cost a storage round-trip
+        if self.video_file and (not self.video_file._committed or not self.file_size):
             self.file_size = self.video_file.size
         super().save(*args, **kwargs)
     
@@ -84,6 +520,43 @@ class Video(models.Model):
     
     class Meta:
         ordering = ['order', '-uploaded_at']
+        indexes = [
+            # Keyset pagination sort keys for the videos_ajax sort modes; partial, so trashed rows cost nothing
+            models.Index(fields=['user', 'order', '-uploaded_at', '-id'], name='video_user_order_idx', condition=ACTIVE),
+            models.Index(fields=['user', 'uploaded_at', 'id'], name='video_user_uploaded_idx', condition=ACTIVE),
+            models.Index(fields=['user', 'file_size', 'id'], name='video_user_size_idx', condition=ACTIVE),
+            models.Index(fields=['user', 'title', 'id'], name='video_user_title_idx', condition=ACTIVE),
+            # Trash page and purge_trash
+            models.Index(fields=['user', '-deleted_at'], name='video_trash_idx', condition=TRASHED),
+            models.Index(fields=['deleted_at', 'id'], name='video_trash_expiry_idx', condition=TRASHED),
+        ]
+
+def derivative_media_path(instance, filename):
+    """Generate file path for photo derivatives, next to the owner's media"""
+    return f'users/{instance.photo.user.username}/thumbnails/{filename}'
+
+class PhotoDerivative(models.Model):
+    JPEG = 'jpeg'
+    WEBP = 'webp'
+    FORMAT_CHOICES = [
+        (JPEG, 'JPEG'),
+        (WEBP, 'WebP'),
+    ]
+    photo = models.ForeignKey(Photo, on_delete=models.CASCADE, related_name='derivatives')
+    size = models.PositiveIntegerField()  # bounding box edge in px
+    format = models.CharField(max_length=4, choices=FORMAT_CHOICES)
+    file = models.ImageField(upload_to=derivative_media_path)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    file_size = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['size']
+        unique_together = ['photo', 'size', 'format']
+
+    def __str__(self):
+        return f"{self.photo} - {self.size}px {self.format}"
 
 class SharedPhoto(models.Model):
     photo = models.ForeignKey(Photo, on_delete=models.CASCADE, related_name='shares')
@@ -139,14 +612,17 @@ class SharedAlbum(models.Model):
             return timezone.now() > self.expires_at
         return False
 
-class UserProfile(models.Model):
+class UserProfile(ContentVersionMixin, models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     storage_used = models.BigIntegerField(default=0)  # in bytes
-    storage_limit = models.BigIntegerField(default=5368709120)  # 5GB default limit
+    storage_limit = models.BigIntegerField(default=BASE_STORAGE_LIMIT)
+    storage_reserved = models.BigIntegerField(default=0)  # held by uploads in progress (see quota)
     has_paid_for_extra_storage = models.BooleanField(default=False)
     upgrade_requested = models.BooleanField(default=False)
     phone_number = models.CharField(max_length=15, blank=True)
     gmail = models.EmailField(max_length=254, blank=True)
+
+    version_scope = ('user_id', profile_scope)
     
     def __str__(self):
         return f"{self.user.username}'s profile"
@@ -160,12 +636,76 @@ class UserProfile(models.Model):
     def get_storage_percentage(self):
         return round((self.storage_used / self.storage_limit) * 100, 2)
 
-class Notification(models.Model):
+    @classmethod
+    def adjust_storage_used(cls, user_id, delta):
+        """Atomically add delta bytes (negative to release) to a user's storage_used"""
+        if not delta:
+            return
+        updated = cls.objects.filter(user_id=user_id).update(storage_used=F('storage_used') + delta)
+        bump(profile_scope(user_id))
+        if updated:
+            StorageEvent.objects.create(user_id=user_id, delta=delta)
+        else:
+            # No profile yet: create one and seed it from the media rows themselves,
+            # which logs the seeded total as the event
+            cls.objects.get_or_create(user_id=user_id)
+            cls.recalculate_storage_used(user_ids=[user_id])
+
+    @classmethod
+    def reserve_storage(cls, user_id, nbytes):
+        """Atomically hold nbytes if they fit under the user's storage_limit; returns whether they did"""
+        # One conditional UPDATE: concurrent reservations serialize on the row, not a table lock
+        updated = cls.objects.filter(
+            user_id=user_id, storage_used__lte=F('storage_limit') - F('storage_reserved') - nbytes
+        ).update(storage_reserved=F('storage_reserved') + nbytes)
+        if not updated and not cls.objects.filter(user_id=user_id).exists():
+            cls.objects.get_or_create(user_id=user_id)
+            cls.recalculate_storage_used(user_ids=[user_id])
+            return cls.reserve_storage(user_id, nbytes)
+        return bool(updated)
+
+    @classmethod
+    def release_reserved_storage(cls, user_id, nbytes):
+        """Give back nbytes held by reserve_storage"""
+        cls.objects.filter(user_id=user_id).update(storage_reserved=F('storage_reserved') - nbytes)
+
+    @classmethod
+    def recalculate_storage_used(cls, user_ids=None):
+        """Recompute storage_used from Photo/Video rows in a single UPDATE statement.
+
+        Each profile whose total changes gets a StorageEvent for the difference,
+        so the event log keeps adding up to storage_used.
+        """
+        zero = Value(0, output_field=models.BigIntegerField())
+        # Trashed media still holds storage until it is purged
+        photo_totals = Photo.all_objects.filter(user=OuterRef('user')).order_by().values('user').annotate(total=Sum('file_size')).values('total')
+        video_totals = Video.all_objects.filter(user=OuterRef('user')).order_by().values('user').annotate(total=Sum('file_size')).values('total')
+        profiles = cls.objects.all()
+        if user_ids is not None:
+            profiles = profiles.filter(user_id__in=user_ids)
+        with transaction.atomic():
+            # Locked, so no adjustment lands between the old totals and the new ones
+            before = dict(profiles.select_for_update().values_list('user_id', 'storage_used'))
+            updated = profiles.update(
+                storage_used=Coalesce(Subquery(photo_totals), zero) + Coalesce(Subquery(video_totals), zero)
+            )
+            StorageEvent.objects.bulk_create([
+                StorageEvent(user_id=user_id, delta=used - before[user_id])
+                for user_id, used in profiles.values_list('user_id', 'storage_used')
+                if user_id in before and used != before[user_id]
+            ])
+        bump(*(profile_scope(user_id) for user_id in before))
+        return updated
+
+class Notification(ContentVersionMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
     message = models.TextField()
     created_at = models.DateTimeField(default=timezone.now)
     is_read = models.BooleanField(default=False)
 
+    objects = VersionedQuerySet.as_manager()
+    version_scope = ('user_id', notifications_scope)
+
     def __str__(self):
         return f"Notification for {self.user.username}: {self.message[:30]}..."
 
@@ -185,11 +725,101 @@ class StorageUpgradeRequest(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.status} ({self.created_at:%Y-%m-%d %H:%M})"
 
-class StorageHistory(models.Model):
+class StorageHistory(ContentVersionMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='storage_history')
     date = models.DateField()
     storage_used = models.BigIntegerField()
 
+    objects = VersionedQuerySet.as_manager()
+    version_scope = ('user_id', profile_scope)  # shown with the profile on the analytics page
+
     class Meta:
         unique_together = ('user', 'date')
         ordering = ['date']
+
+class StorageRollup(ContentVersionMixin, models.Model):
+    """Weekly/monthly compaction of StorageHistory: usage at the end of each period (see analytics)"""
+    WEEK = 'week'
+    MONTH = 'month'
+    RESOLUTION_CHOICES = [
+        (WEEK, 'Week'),
+        (MONTH, 'Month'),
+    ]
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='storage_rollups')
+    resolution = models.CharField(max_length=5, choices=RESOLUTION_CHOICES)
+    period_start = models.DateField()
+    storage_used = models.BigIntegerField()
+
+    objects = VersionedQuerySet.as_manager()
+    version_scope = ('user_id', profile_scope)
+
+    class Meta:
+        ordering = ['period_start']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'resolution', 'period_start'], name='storage_rollup_period_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} {self.resolution} of {self.period_start}: {self.storage_used} bytes"
+
+class StorageEvent(models.Model):
+    """Append-only log of changes to a user's storage_used, written by UserProfile.adjust_storage_used"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='storage_events')
+    delta = models.BigIntegerField()  # bytes; negative when storage is released
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='storage_event_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} {self.delta:+d} bytes at {self.created_at}"
+
+class StorageReservation(models.Model):
+    """Bytes held against a user's quota by an upload in progress (see storageapp.quota)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='storage_reservations')
+    nbytes = models.BigIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expires_at'], name='storage_reservation_exp_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} holds {self.nbytes} bytes until {self.expires_at}"
+
+class UploadSession(models.Model):
+    """A resumable video upload whose bytes are spooled locally until finalized"""
+    STATUS_CHOICES = [
+        ('active', 'Active'),
+        ('finalizing', 'Finalizing'),
+        ('completed', 'Completed'),
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    total_size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)  # bytes received so far
+    title = models.CharField(max_length=200, blank=True)
+    description = models.TextField(blank=True)
+    album_ids = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='active')
+    video = models.ForeignKey(Video, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    reservation = models.OneToOneField(StorageReservation, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='upload_session_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.filename} ({self.offset}/{self.total_size})"
+
+    def is_expired(self):
+        return timezone.now() > self.expires_at
@@ -0,0 +1,189 @@
+"""Sparse ordering for drag-and-drop reordering.
+
+``order`` values are spaced ``ORDER_GAP`` apart, so moving an item only
+rewrites that item's row: it takes the midpoint between its new neighbours
+(or one gap beyond the end it was dropped at; values may go negative).
+When two neighbours leave no room, only the run of rows following the drop
+point is spread out, up to the first row with enough space behind it. The
+``rebalance_ordering`` command re-spaces whole scopes in the background.
+A whole arrangement can also be applied at once with ``apply_order``. New
+uploads are placed one gap before the rest of their scope
+(``first_position``) so they never tie with each other.
+"""
+from django.db import transaction
+from django.db.models import Min
+
+from .pagination import _after
+
+ORDER_GAP = 1 << 16
+MIN_GAP = 1 << 6  # spacing a local re-spread must leave between rows
+
+MEDIA_ORDERING = ('order', '-uploaded_at', '-id')
+ALBUM_ITEM_ORDERING = ('order', 'id')
+
+RESPREAD_BATCH_SIZE = 8
+MAX_BATCH_IDS = 1000  # fits between two rows ORDER_GAP apart
+
+
+def _sort_key(obj, ordering):
+    return [getattr(obj, field.lstrip('-')) for field in ordering]
+
+
+def _fields(ordering):
+    return ['pk'] + [field.lstrip('-') for field in ordering]
+
+
+def first_position(scope):
+    """Order value that puts a new row ahead of every row in `scope`"""
+    lowest = scope.aggregate(lowest=Min('order'))['lowest']
+    return 0 if lowest is None else lowest - ORDER_GAP
+
+
+def resolve_neighbours(scope, ordering, obj, prev_id=None, next_id=None, index=None, id_field='id'):
+    """Rows that will sit directly before and after `obj` once it is moved.
+
+    Clients send the ids of the items around the drop point; older clients
+    send the new list `index` instead, which costs an OFFSET query. Raises
+    the scope model's DoesNotExist if a neighbour is not in `scope`.
+    """
+    others = scope.exclude(pk=obj.pk).only(*_fields(ordering))
+    if prev_id or next_id:
+        before = others.get(**{id_field: prev_id}) if prev_id else None
+        after = others.get(**{id_field: next_id}) if next_id else None
+        return before, after
+    if index is None:
+        raise ValueError('A neighbour id or list index is required')
+    index = max(int(index), 0)
+    rows = list(others.order_by(*ordering)[max(index - 1, 0):index + 1])
+    if index == 0:
+        return None, (rows[0] if rows else None)
+    return rows[0] if rows else None, (rows[1] if len(rows) > 1 else None)
+
+
+def _open_gap(following, ordering, before, count):
+    """Rows after `before` that must shift to make room for `count` rows, and the spacing to use.
+
+    Walks `following` in growing batches up to the first row that leaves at
+    least ``MIN_GAP`` per row placed below it.
+    """
+    low = before.order
+    window = []
+    cursor = before
+    batch_size = RESPREAD_BATCH_SIZE
+    while True:
+        rows = list(following.filter(_after(ordering, _sort_key(cursor, ordering)))[:batch_size])
+        for row in rows:
+            # The new rows plus the window so far must fit below this row
+            if row.order - low >= (len(window) + count + 1) * MIN_GAP:
+                return window, (row.order - low) // (len(window) + count + 1)
+            window.append(row)
+        if len(rows) < batch_size:
+            return window, ORDER_GAP
+        cursor = rows[-1]
+        batch_size *= 2
+
+
+def _respread(scope, ordering, obj, before):
+    """Spread `obj` and the rows just after `before` evenly until there is room for all of them"""
+    following = scope.exclude(pk=obj.pk).only(*_fields(ordering)).order_by(*ordering)
+    window, step = _open_gap(following, ordering, before, 1)
+    for position, row in enumerate([obj] + window, start=1):
+        row.order = before.order + step * position
+    scope.model.objects.bulk_update([obj] + window, ['order'])
+    return len(window) + 1
+
+
+def move_item(scope, ordering, obj, before=None, after=None):
+    """Place `obj` between the rows `before` and `after` within `scope`; returns the number of rows written"""
+    with transaction.atomic():
+        if before is None and after is None:
+            return 0
+        if before is None:
+            position = after.order - ORDER_GAP
+        elif after is None:
+            position = before.order + ORDER_GAP
+        elif after.order - before.order > 1:
+            position = (before.order + after.order) // 2
+        else:
+            return _respread(scope, ordering, obj, before)
+        obj.order = position
+        return scope.filter(pk=obj.pk).update(order=position)
+
+
+def rebalance(scope, ordering, force=False, batch_size=1000):
+    """Re-space every row in `scope` ``ORDER_GAP`` apart, keeping the current order.
+
+    Unless `force` is set, scopes whose rows are all at least ``MIN_GAP``
+    apart are left alone. Returns the number of rows written.
+    """
+    rows = list(scope.only(*_fields(ordering)).order_by(*ordering))
+    if not force and all(b.order - a.order >= MIN_GAP for a, b in zip(rows, rows[1:])):
+        return 0
+    changed = []
+    for position, row in enumerate(rows, start=1):
+        if row.order != position * ORDER_GAP:
+            row.order = position * ORDER_GAP
+            changed.append(row)
+    with transaction.atomic():
+        scope.model.objects.bulk_update(changed, ['order'], batch_size=batch_size)
+    return len(changed)
+
+
+def _reversed(ordering):
+    return [field[1:] if field.startswith('-') else f'-{field}' for field in ordering]
+
+
+def spread_between(before, after, count):
+    """`count` increasing order values strictly between two rows (either may be None)"""
+    if before is None and after is None:
+        return [position * ORDER_GAP for position in range(1, count + 1)]
+    if before is None:
+        return [after.order - (count - index) * ORDER_GAP for index in range(count)]
+    if after is None:
+        return [before.order + position * ORDER_GAP for position in range(1, count + 1)]
+    step = (after.order - before.order) // (count + 1)
+    if step < 1:
+        return None
+    return [before.order + position * step for position in range(1, count + 1)]
+
+
+def apply_order(scope, ordering, ids, id_field='id'):
+    """Lay out the rows with `ids` in the given order, where the earliest of them sits now.
+
+    Other rows keep their relative order; any that sat between the listed
+    rows end up after them. Ownership is checked with one query and the new
+    values are written with one bulk_update, which also re-spaces the rows
+    just after the listed ones when the neighbours leave too little room. Returns ``[(id, order), ...]``
+    and raises ValueError for repeated ids or ids outside `scope`.
+    """
+    if len(set(ids)) != len(ids):
+        raise ValueError('Each item may only be listed once')
+    if len(ids) > MAX_BATCH_IDS:
+        raise ValueError(f'At most {MAX_BATCH_IDS} items can be reordered at once')
+    if not ids:
+        return []
+    with transaction.atomic():
+        listed = list(
+            scope.filter(**{f'{id_field}__in': ids}).select_for_update()
+            .only(id_field, *_fields(ordering)).order_by(*ordering)
+        )
+        if len(listed) != len(ids):
+            raise ValueError('Some items were not found')
+
+        others = scope.exclude(**{f'{id_field}__in': ids}).only(*_fields(ordering))
+        first_key = _sort_key(listed[0], ordering)
+        after = others.filter(_after(ordering, first_key)).order_by(*ordering).first()
+        before = others.exclude(_after(ordering, first_key)).order_by(*_reversed(ordering)).first()
+
+        rows = {getattr(row, id_field): row for row in listed}
+        ordered = [rows[item_id] for item_id in ids]
+        values = spread_between(before, after, len(ids))
+        window = []
+        if values is None:
+            # No integer room between the neighbours: shift the rows that follow, as a single move does
+            window, step = _open_gap(others.order_by(*ordering), ordering, before, len(ids))
+            values = [before.order + step * position for position in range(1, len(ids) + len(window) + 1)]
+        for row, value in zip(ordered + window, values):
+            row.order = value
+        scope.model.objects.bulk_update(ordered + window, ['order'])
+    return [(item_id, row.order) for item_id, row in zip(ids, ordered)]
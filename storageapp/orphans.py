@@ -0,0 +1,150 @@
+"""Find stored files that no database row refers to.
+
+Failed uploads, interrupted deletes and removed albums can leave files in
+storage that nothing points at. The referenced names (media originals and
+posters, derivatives, album covers, blobs and queued cleanups) are streamed
+from the database into a Bloom filter, so memory stays flat however many
+rows there are, and the storage listing is streamed past it. Backends that
+can list files with their ages (``list_files``) are read that way, one
+listing per root; others are walked directory by directory. A Bloom filter
+has no false negatives, so every name it rejects is unreferenced; the rare
+false positive only means an orphan survives until the next run. Candidates
+are re-checked against the database in chunks right before deletion, and
+files younger than the grace period are never touched, which covers uploads
+still in flight. Files whose age cannot be read at all are kept and
+counted, and the command reports them.
+"""
+import hashlib
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from .models import Album, MediaBlob, Photo, PhotoDerivative, StorageCleanupTask, Video
+
+STORAGE_ROOTS = ('users', 'uploads', 'album_covers')
+BLOOM_ERROR_RATE = 0.001
+REFERENCE_CHUNK_SIZE = 5000
+
+
+def reference_sources():
+    """(queryset, field) pairs whose values are storage names that must be kept"""
+    return (
+        (Photo.all_objects.all(), 'image'),
+        (Video.all_objects.all(), 'video_file'),
+        (Video.all_objects.all(), 'thumbnail'),
+        (PhotoDerivative.objects.all(), 'file'),
+        (Album.objects.all(), 'cover_image'),
+        (MediaBlob.objects.all(), 'storage_name'),
+        # Queued names are removed by process_storage_cleanup
+        (StorageCleanupTask.objects.all(), 'storage_name'),
+    )
+
+
+class BloomFilter:
+    """Fixed-size set of strings with no false negatives and about `error_rate` false positives"""
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+def build_reference_filter(error_rate=BLOOM_ERROR_RATE):
+    """Bloom filter of every referenced storage name; returns (filter, number of references)"""
+    sources = reference_sources()
+    total = sum(queryset.count() for queryset, _ in sources)
+    bloom = BloomFilter(total, error_rate)
+    for queryset, field in sources:
+        for name in queryset.order_by().values_list(field, flat=True).iterator(chunk_size=REFERENCE_CHUNK_SIZE):
+            if name:
+                bloom.add(name)
+    return bloom, total
+
+
+def referenced_names(names):
+    """The subset of `names` that some row refers to, with one `IN` query per source"""
+    referenced = set()
+    for queryset, field in reference_sources():
+        referenced.update(queryset.filter(**{f'{field}__in': names}).values_list(field, flat=True))
+    return referenced
+
+
+def walk_storage(storage, root):
+    """Yield every file name below `root` in `storage`, one directory listing at a time"""
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            dirs, files = storage.listdir(directory)
+        except FileNotFoundError:
+            continue
+        for name in files:
+            yield f'{directory}/{name}'
+        pending.extend(f'{directory}/{name}' for name in dirs)
+
+
+def list_storage(storage, root):
+    """Yield (name, modified time or None) for every file below `root`"""
+    list_files = getattr(storage, 'list_files', None)
+    if list_files is not None:
+        yield from list_files(root)
+        return
+    for name in walk_storage(storage, root):
+        yield name, None
+
+
+def find_orphans(storage, bloom, cutoff, roots=STORAGE_ROOTS, stats=None):
+    """Yield unreferenced file names under `roots` last modified before `cutoff`.
+
+    `stats`, if given, is a dict that collects 'scanned', 'recent' and
+    'unknown_age' counts; files whose age cannot be read are kept.
+    """
+    stats = stats if stats is not None else {}
+    for key in ('scanned', 'recent', 'unknown_age'):
+        stats.setdefault(key, 0)
+    for root in roots:
+        for name, modified in list_storage(storage, root):
+            stats['scanned'] += 1
+            if name in bloom:
+                continue
+            if modified is None:
+                try:
+                    modified = storage.get_modified_time(name)
+                except (NotImplementedError, OSError):
+                    stats['unknown_age'] += 1
+                    continue
+            if modified >= cutoff:
+                stats['recent'] += 1
+                continue
+            yield name
+
+
+def delete_orphans(storage, names, workers=1):
+    """Delete `names` that are still unreferenced, `workers` at a time; returns (deleted, failures)"""
+    referenced = referenced_names(names)
+    names = [name for name in names if name not in referenced]
+    failures = []
+
+    def delete(name):
+        try:
+            storage.delete(name)
+        except Exception as e:
+            failures.append((name, e))
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        list(executor.map(delete, names))
+    return len(names) - len(failures), failures
@@ -0,0 +1,89 @@
+"""Keyset (cursor) pagination for the infinite-scroll endpoints.
+
+Instead of ``COUNT(*)`` + ``OFFSET`` the client sends back an opaque cursor
+holding the sort key of the last row it received, and the next page is a
+plain ``WHERE (sort key) > cursor ORDER BY ... LIMIT n`` that an index can
+answer directly, however deep the user has scrolled.
+"""
+import base64
+import json
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def _ordering_fields(ordering):
+    return [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+
+
+def encode_cursor(obj, ordering):
+    """Opaque cursor for the row `obj` under `ordering`"""
+    values = []
+    for name, _ in _ordering_fields(ordering):
+        field = obj._meta.get_field(name)
+        values.append(field.value_to_string(obj))
+    payload = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor, model, ordering):
+    """Turn a cursor back into typed sort-key values, raising InvalidCursor if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor('Malformed cursor')
+    fields = _ordering_fields(ordering)
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise InvalidCursor('Cursor does not match the requested ordering')
+    try:
+        return [model._meta.get_field(name).to_python(value) for (name, _), value in zip(fields, values)]
+    except Exception:
+        raise InvalidCursor('Cursor holds invalid values')
+
+
+def _after(ordering, values):
+    """Q selecting rows strictly after `values` in `ordering` (row-value comparison spelled out)"""
+    condition = Q()
+    equal = Q()
+    for (name, descending), value in zip(_ordering_fields(ordering), values):
+        lookup = 'lt' if descending else 'gt'
+        condition |= equal & Q(**{f'{name}__{lookup}': value})
+        equal &= Q(**{name: value})
+    return condition
+
+
+def keyset_paginate(queryset, ordering, cursor=None, per_page=12):
+    """Return a KeysetPage of `per_page` rows following `cursor`.
+
+    `ordering` must end in a unique field (normally ``id``/``-id``) so the
+    sort key is total and no row is skipped or repeated between pages.
+    """
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        values = decode_cursor(cursor, queryset.model, ordering)
+        queryset = queryset.filter(_after(ordering, values))
+    rows = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1], ordering)
+    return KeysetPage(rows, next_cursor)
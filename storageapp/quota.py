@@ -0,0 +1,71 @@
+"""Storage quota reservations for uploads.
+
+An upload reserves its size before any bytes are stored, with a single
+conditional UPDATE on the user's profile that succeeds only while
+storage_used + storage_reserved + size <= storage_limit. Parallel uploads
+each take their share of the remaining space or are refused, so together
+they cannot overshoot the limit; nothing is locked beyond that one row for
+the length of the statement. Once the media row is saved its bytes are
+charged to storage_used as usual (UserProfile.adjust_storage_used) and the
+reservation is released; a failed upload just releases it.
+
+Every reservation is also a StorageReservation row. Releasing deletes the
+row first and only gives the bytes back if it was still there, so a
+reservation is never released twice, and reservations left behind by a
+worker that died mid-upload lapse at ``expires_at`` and are reclaimed by
+``release_expired_reservations``.
+"""
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import StorageReservation, UserProfile
+
+RESERVATION_TTL = timedelta(hours=1)
+
+
+class QuotaExceeded(Exception):
+    """The upload does not fit in the user's remaining storage"""
+
+
+def reserve(user_id, nbytes, expires_at=None):
+    """Hold `nbytes` of `user_id`'s quota; raises QuotaExceeded when they do not fit"""
+    if nbytes < 0:
+        raise ValueError('Cannot reserve a negative number of bytes')
+    with transaction.atomic():
+        if not UserProfile.reserve_storage(user_id, nbytes):
+            raise QuotaExceeded('Not enough storage left for this upload.')
+        return StorageReservation.objects.create(
+            user_id=user_id, nbytes=nbytes, expires_at=expires_at or timezone.now() + RESERVATION_TTL,
+        )
+
+
+def release(held):
+    """Give a reservation's bytes back to the user's quota; returns False if it was already released"""
+    with transaction.atomic():
+        deleted, _ = StorageReservation.objects.filter(pk=held.pk).delete()
+        if deleted:
+            UserProfile.release_reserved_storage(held.user_id, held.nbytes)
+    return bool(deleted)
+
+
+@contextmanager
+def reservation(user_id, nbytes):
+    """Hold `nbytes` while the block stores an upload, releasing them however it ends"""
+    held = reserve(user_id, nbytes)
+    try:
+        yield held
+    finally:
+        release(held)
+
+
+def release_expired_reservations(now=None):
+    """Release reservations whose upload never finished; returns how many were released"""
+    now = now or timezone.now()
+    expired = StorageReservation.objects.filter(expires_at__lt=now).values_list('pk', 'user_id', 'nbytes')
+    return sum(
+        release(StorageReservation(pk=pk, user_id=user_id, nbytes=nbytes))
+        for pk, user_id, nbytes in expired
+    )
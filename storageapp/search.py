@@ -0,0 +1,133 @@
+"""Ranked full-text search over a user's photos and videos.
+
+PostgreSQL uses the ``search_vector`` columns (weighted title/description
+tsvectors kept current on save, GIN indexed). SQLite uses the FTS5 shadow
+table ``storageapp_media_fts`` maintained by triggers, where each row's
+rowid encodes the media kind and id. Other databases fall back to the old
+``icontains`` filter. Results from both tables are merged into one ranked,
+paginated list without counting the full result set.
+"""
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, Q, Value, CharField
+
+from .models import Photo, Video
+
+FTS_TABLE = 'storageapp_media_fts'
+SEARCH_PER_PAGE = 24
+
+
+class SearchResult:
+    def __init__(self, kind, item, rank):
+        self.kind = kind
+        self.item = item
+        self.rank = rank
+
+
+class SearchResults:
+    def __init__(self, results, page, has_next):
+        self.results = results
+        self.number = page
+        self._has_next = has_next
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+
+def _postgres_hits(user, query, kinds, offset, limit):
+    search_query = SearchQuery(query, search_type='websearch', config='english')
+    querysets = []
+    for kind, model in (('photo', Photo), ('video', Video)):
+        if kind in kinds:
+            querysets.append(
+                model.objects.filter(user=user, search_vector=search_query)
+                .annotate(kind=Value(kind, output_field=CharField()), rank=SearchRank(F('search_vector'), search_query))
+                .values_list('kind', 'id', 'rank')
+                .order_by()
+            )
+    hits = querysets[0]
+    if len(querysets) > 1:
+        hits = hits.union(querysets[1], all=True)
+    return list(hits.order_by('-rank', 'kind', '-id')[offset:offset + limit])
+
+
+def _fts5_match_expression(query):
+    """Quote each word (prefix-matched) so user input can never be parsed as FTS5 syntax"""
+    words = re.findall(r'\w+', query)
+    return ' '.join('"%s"*' % word.replace('"', '""') for word in words)
+
+
+def _sqlite_hits(user, query, kinds, offset, limit):
+    expression = _fts5_match_expression(query)
+    if not expression:
+        return []
+    kind_filter = ''
+    if kinds == {'photo'}:
+        kind_filter = 'AND rowid %% 2 = 0'
+    elif kinds == {'video'}:
+        kind_filter = 'AND rowid %% 2 = 1'
+    with connection.cursor() as cursor:
+        # bm25() is lower-is-better; weights follow column order (user_id, title, description)
+        cursor.execute(
+            f'SELECT rowid, bm25({FTS_TABLE}, 0.0, 2.0, 1.0) AS score FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s AND user_id = %s {kind_filter} '
+            'ORDER BY score, rowid DESC LIMIT %s OFFSET %s',
+            [expression, user.id, limit, offset],
+        )
+        return [('video' if rowid % 2 else 'photo', rowid // 2, -score) for rowid, score in cursor.fetchall()]
+
+
+def _fallback_hits(user, query, kinds, offset, limit):
+    """Unranked substring match for databases without a full-text backend"""
+    hits = []
+    text_filter = Q(title__icontains=query) | Q(description__icontains=query)
+    for kind, model in (('photo', Photo), ('video', Video)):
+        if kind in kinds:
+            ids = model.objects.filter(text_filter, user=user).order_by('-uploaded_at', '-id').values_list('id', flat=True)
+            hits.extend((kind, media_id, 0.0) for media_id in ids[:offset + limit])
+    return hits[offset:offset + limit]
+
+
+def search_media(user, query, media_type='all', page=1, per_page=SEARCH_PER_PAGE):
+    """Return a SearchResults page of the user's media matching `query`, best matches first"""
+    kinds = {'photos': {'photo'}, 'videos': {'video'}}.get(media_type, {'photo', 'video'})
+    offset = (page - 1) * per_page
+    if connection.vendor == 'postgresql':
+        hits = _postgres_hits(user, query, kinds, offset, per_page + 1)
+    elif connection.vendor == 'sqlite':
+        hits = _sqlite_hits(user, query, kinds, offset, per_page + 1)
+    else:
+        hits = _fallback_hits(user, query, kinds, offset, per_page + 1)
+
+    has_next = len(hits) > per_page
+    hits = hits[:per_page]
+    photo_ids = [media_id for kind, media_id, _ in hits if kind == 'photo']
+    video_ids = [media_id for kind, media_id, _ in hits if kind == 'video']
+    items = {}
+    if photo_ids:
+        items.update((('photo', p.id), p) for p in Photo.objects.filter(id__in=photo_ids, user=user).prefetch_related('derivatives'))
+    if video_ids:
+        items.update((('video', v.id), v) for v in Video.objects.filter(id__in=video_ids, user=user))
+    results = [
+        SearchResult(kind, items[(kind, media_id)], rank)
+        for kind, media_id, rank in hits if (kind, media_id) in items
+    ]
+    return SearchResults(results, page, has_next)
+
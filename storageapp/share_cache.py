@@ -0,0 +1,125 @@
+"""Cache of resolved public share links.
+
+shared_photo, shared_video and shared_album are unauthenticated, so a link
+that spreads can hit them very often. Each token is resolved once into
+plain metadata (URLs, titles and, for albums, the ordered contents) and
+cached under the token for ``settings.SHARE_CACHE_TTL`` seconds, or until
+the share expires if that comes first. Unsharing, re-sharing, album edits
+and changes to album contents delete the affected entries once the
+change commits.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Photo, SharedAlbum, SharedPhoto, SharedVideo, Video
+
+SHARE_MODELS = {
+    'photo': SharedPhoto,
+    'video': SharedVideo,
+    'album': SharedAlbum,
+}
+
+
+def _cache_key(kind, token):
+    return f'share:{kind}:{token}'
+
+
+def _photo_payload(photo):
+    return {
+        'title': photo.title,
+        'description': photo.description,
+        'image_url': photo.image.url,
+        'thumbnail_url': photo.thumbnail_url,
+        'thumbnail_webp_url': photo.thumbnail_webp_url,
+        'owner': photo.user.username,
+        'uploaded_at': photo.uploaded_at,
+    }
+
+
+def _video_payload(video):
+    return {
+        'title': video.title,
+        'video_url': video.video_file.url,
+        'poster_url': video.thumbnail.url if video.thumbnail else None,
+        'owner': video.user.username,
+        'uploaded_at': video.uploaded_at,
+    }
+
+
+def _album_payload(album):
+    photos = (
+        Photo.objects.filter(album_photos__album=album).select_related('user')
+        .order_by('album_photos__order', 'album_photos__id').prefetch_related('derivatives')
+    )
+    videos = Video.objects.filter(album_videos__album=album).select_related('user').order_by('album_videos__order', 'album_videos__id')
+    return {
+        'album': {
+            'name': album.name,
+            'description': album.description,
+            'owner': album.user.username,
+        },
+        'photos': [_photo_payload(photo) for photo in photos],
+        'videos': [_video_payload(video) for video in videos],
+    }
+
+
+def _resolve(kind, token):
+    """Build the payload for an active share from the database, or None if there is no such share"""
+    shares = SHARE_MODELS[kind].objects.select_related(f'{kind}__user').filter(share_token=token, is_active=True)
+    if kind != 'album':
+        shares = shares.filter(**{f'{kind}__deleted_at__isnull': True})  # trashed media is not shared
+    shared = shares.first()
+    if shared is None:
+        return None
+    if shared.is_expired():
+        return {'expired': True}
+    if kind == 'photo':
+        payload = {'photo': _photo_payload(shared.photo)}
+    elif kind == 'video':
+        payload = {'video': _video_payload(shared.video)}
+    else:
+        payload = _album_payload(shared.album)
+    payload['expires_at'] = shared.expires_at
+    # Content fingerprint, used as the pages' ETag version
+    payload['etag'] = hashlib.md5(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+    return payload
+
+
+def resolve_share(kind, token):
+    """Payload for the share `token` of `kind` ('photo', 'video' or 'album').
+
+    Returns None for unknown or revoked tokens and ``{'expired': True}`` for
+    expired ones; otherwise a dict of template-ready metadata plus an
+    ``etag`` fingerprint of it.
+    """
+    key = _cache_key(kind, token)
+    payload = cache.get(key)
+    if payload is None:
+        payload = _resolve(kind, token)
+        if payload is None:
+            return None
+        timeout = settings.SHARE_CACHE_TTL
+        if payload.get('expires_at'):
+            timeout = min(timeout, max(int((payload['expires_at'] - timezone.now()).total_seconds()), 1))
+        cache.set(key, payload, timeout)
+    elif payload.get('expires_at') and timezone.now() > payload['expires_at']:
+        return {'expired': True}
+    return payload
+
+
+def invalidate_shares(kind, tokens):
+    """Drop cached payloads for `tokens` once the current transaction commits"""
+    keys = [_cache_key(kind, token) for token in tokens]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_album_shares(album_ids):
+    """Drop cached payloads for every active share of the given albums"""
+    tokens = SharedAlbum.objects.filter(album_id__in=album_ids, is_active=True).values_list('share_token', flat=True)
+    invalidate_shares('album', list(tokens))
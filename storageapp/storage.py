@@ -0,0 +1,354 @@
+"""Media storage backends.
+
+ShardedFileSystemStorage (``MEDIA_STORAGE=local``, see settings) stores
+every file as ``ab/cd/<sha256><ext>``, named after the SHA-256 of its
+bytes, so no directory ever holds more than a small share of the library
+and identical bytes are written once. The name the model's ``upload_to``
+asks for only contributes its extension. Files are written to a temporary
+file in the target directory and renamed into place, so readers never see
+a partial file. Deletes still go through the reference checks in
+storage_cleanup, which keep a file that another row shares.
+
+CloudinaryMediaStorage (``MEDIA_STORAGE=cloudinary``) is the Cloudinary
+backend plus the upload times it does not expose: ``list_files`` reads a
+whole prefix through the Admin API, 500 resources per call, with each
+resource's ``created_at``, which is what the orphan collector ages files
+by. Cloudinary resources are replaced rather than modified, so the upload
+time is also the modification time. Opened files stream from the delivery
+URL as they are read instead of being downloaded into memory first.
+
+ReadThroughCacheStorage (``MEDIA_CACHE_DIR``) wraps either backend and
+keeps recently opened files on local disk, least recently used first out
+once ``max_bytes`` is exceeded, so exports and derivative generation do
+not download the same original again. A cached copy is used only while its
+size matches the backend's (``validate``, checked at most once every
+``validate_ttl`` seconds per file so hits stay local), concurrent opens of the same
+name in a process share one download, and fills are renamed into place
+like the sharded writes.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import cloudinary.api
+import requests
+from cloudinary_storage.storage import MediaCloudinaryStorage
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+
+HASH_READ_SIZE = 1024 * 1024
+CLOUDINARY_PAGE_SIZE = 500  # the Admin API maximum
+SHARD_NAME = re.compile(r'^[0-9a-f]{2}$')
+SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+# mkstemp() creates files 0600; finished files get the usual 0666 & ~umask
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _write_atomic(directory, path, chunks, mode):
+    """Write `chunks` to `path` through a temporary file in `directory`; returns the bytes written"""
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                written += len(chunk)
+        os.chmod(temp_path, mode)
+        # Atomic on POSIX: concurrent writers of the same bytes just replace each other
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return written
+
+
+def content_sha256(content):
+    """SHA-256 of `content`, reusing the digest the hashing upload handlers attached"""
+    sha256 = getattr(content, 'sha256', None)
+    if isinstance(sha256, str) and SHA256.match(sha256):
+        return sha256
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks(HASH_READ_SIZE):
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def sharded_name(sha256, filename):
+    """Storage name for content with digest `sha256` uploaded as `filename`"""
+    extension = os.path.splitext(filename)[1].lower()
+    return f'{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}'
+
+
+class ShardedFileSystemStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # _save() picks the final name from the content, and equal content is equal bytes
+        return name
+
+    def _save(self, name, content):
+        name = sharded_name(content_sha256(content), name)
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            try:
+                # A new row is about to use this file: restart the orphan collector's grace period
+                os.utime(full_path)
+                return name
+            except FileNotFoundError:
+                pass  # collected in the meantime; write it again
+
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, mode=self.directory_permissions_mode or 0o777, exist_ok=True)
+        mode = self.file_permissions_mode if self.file_permissions_mode is not None else 0o666 & ~_UMASK
+        content.seek(0)
+        _write_atomic(directory, full_path, content.chunks(), mode)
+        return name
+
+    @property
+    def storage_roots(self):
+        """Top-level shard directories, for the orphan collector"""
+        try:
+            dirs, _ = self.listdir('')
+        except FileNotFoundError:
+            return ()
+        return tuple(sorted(d for d in dirs if SHARD_NAME.match(d)))
+
+
+class StreamedResponseFile(File):
+    """Read-only File over a streamed HTTP response; closing it releases the connection"""
+
+    def __init__(self, response, name, mode='rb'):
+        response.raw.decode_content = True  # undo any Content-Encoding, as response.content would
+        super().__init__(response.raw, name=name)
+        self.mode = mode
+        self._response = response
+        length = response.headers.get('Content-Length')
+        if length is not None and 'Content-Encoding' not in response.headers:
+            self.size = int(length)
+
+    def chunks(self, chunk_size=None):
+        return self._response.iter_content(chunk_size or self.DEFAULT_CHUNK_SIZE)
+
+    def close(self):
+        self._response.close()
+
+
+class CloudinaryMediaStorage(MediaCloudinaryStorage):
+    """Cloudinary media storage that can tell when each file was uploaded"""
+
+    def _open(self, name, mode='rb'):
+        # The parent reads response.content, holding the whole file in memory
+        response = requests.get(self._get_url(name), stream=True)
+        if response.status_code == 404:
+            response.close()
+            raise FileNotFoundError(name)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        return StreamedResponseFile(response, name, mode)
+
+    def list_files(self, root):
+        """Yield (name, upload time) for every file of this storage below `root`"""
+        options = {
+            'type': 'upload',
+            'prefix': self._normalize_path(root),
+            'resource_type': self.RESOURCE_TYPE,
+            'max_results': CLOUDINARY_PAGE_SIZE,
+            'tags': True,
+        }
+        while True:
+            response = cloudinary.api.resources(**options)
+            for resource in response['resources']:
+                # Same filter as listdir(): only files this storage uploaded
+                if self.TAG in resource.get('tags', ()):
+                    yield resource['public_id'], parse_datetime(resource['created_at'])
+            if not response.get('next_cursor'):
+                return
+            options['next_cursor'] = response['next_cursor']
+
+    def get_modified_time(self, name):
+        resource = cloudinary.api.resource(name, resource_type=self._get_resource_type(name))
+        return parse_datetime(resource['created_at'])
+
+    get_created_time = get_modified_time
+
+
+class ReadThroughCacheStorage(Storage):
+    """Wrap the storage at dotted path `backend`, caching opened files under `location`"""
+
+    def __init__(self, backend, location, max_bytes, validate=True, validate_ttl=300, backend_options=None):
+        self.backend = import_string(backend)(**(backend_options or {}))
+        self.location = os.path.abspath(location)
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.validate_ttl = validate_ttl
+        self._verified = {}  # cache path -> monotonic time its size last matched the backend's
+        self._used = None  # bytes on disk, counted on first fill
+        self._lock = threading.Lock()
+        self._fetching = {}  # cache path -> [lock, waiters]
+
+    def _cache_path(self, name):
+        digest = hashlib.sha256(name.encode()).hexdigest()
+        return os.path.join(self.location, digest[:2], digest)
+
+    @contextmanager
+    def _single_flight(self, path):
+        """Let one thread at a time fill `path`; the rest wait and then find it cached"""
+        with self._lock:
+            entry = self._fetching.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._fetching[path]
+
+    def _cached(self, name, path):
+        """True when `path` holds a usable copy of `name`"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+        verified = self._verified.get(path)
+        if self.validate and (verified is None or time.monotonic() - verified >= self.validate_ttl):
+            remote_size = self.backend.size(name)  # None when the backend cannot tell
+            if remote_size is not None and size != remote_size:
+                return False
+            self._verified[path] = time.monotonic()
+        try:
+            os.utime(path)  # mtime is the recency the eviction goes by
+        except FileNotFoundError:  # evicted since the size check
+            return False
+        return True
+
+    def _fill(self, name, path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            stale = os.path.getsize(path)  # a copy that no longer matches, replaced below
+        except OSError:
+            stale = 0
+        with self.backend.open(name, 'rb') as source:
+            written = _write_atomic(directory, path, source.chunks(), 0o600)
+        self._verified[path] = time.monotonic()
+        self._account(written - stale)
+
+    def _entries(self):
+        """(mtime, size, path) of every cached file"""
+        for shard in os.scandir(self.location):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith('.tmp-'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                yield stat.st_mtime, stat.st_size, entry.path
+
+    def _account(self, added):
+        with self._lock:
+            if self._used is None:
+                self._used = sum(size for _, size, _ in self._entries())
+            else:
+                self._used += added
+            if self._used > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache is back under 90% of its budget"""
+        entries = sorted(self._entries())
+        used = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._verified.pop(path, None)
+            used -= size
+        self._used = used
+
+    def _evict_name(self, name):
+        path = self._cache_path(name)
+        self._verified.pop(path, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _open(self, name, mode='rb'):
+        if 'b' not in mode or any(flag in mode for flag in 'wa+'):
+            return self.backend.open(name, mode)
+        path = self._cache_path(name)
+        if not self._cached(name, path):
+            with self._single_flight(path):
+                if not self._cached(name, path):
+                    self._fill(name, path)
+        try:
+            return File(open(path, mode), name=name)
+        except FileNotFoundError:
+            # Evicted between the fill and the open; read this one straight through
+            return self.backend.open(name, mode)
+
+    def save(self, name, content, max_length=None):
+        name = self.backend.save(name, content, max_length=max_length)
+        self._evict_name(name)
+        return name
+
+    def delete(self, name):
+        self._evict_name(name)
+        self.backend.delete(name)
+
+    def exists(self, name):
+        return self.backend.exists(name)
+
+    def listdir(self, path):
+        return self.backend.listdir(path)
+
+    def size(self, name):
+        return self.backend.size(name)
+
+    def url(self, name):
+        return self.backend.url(name)
+
+    def path(self, name):
+        return self.backend.path(name)
+
+    def generate_filename(self, filename):
+        return self.backend.generate_filename(filename)
+
+    def get_available_name(self, name, max_length=None):
+        return self.backend.get_available_name(name, max_length=max_length)
+
+    def get_accessed_time(self, name):
+        return self.backend.get_accessed_time(name)
+
+    def get_created_time(self, name):
+        return self.backend.get_created_time(name)
+
+    def get_modified_time(self, name):
+        return self.backend.get_modified_time(name)
+
+    def __getattr__(self, attr):
+        # Backend extras, such as the sharded backend's storage_roots
+        if attr == 'backend':
+            raise AttributeError(attr)
+        return getattr(self.backend, attr)
@@ -0,0 +1,87 @@
+"""Where a user's storage goes: by type, by album and by upload month.
+
+Each table is read once. Photos and videos are grouped by upload month,
+with conditional aggregates that split live bytes from bytes still held in
+the trash; the type totals are sums of those month rows. Derivatives are
+grouped the same way by their photo's upload month, and albums come from
+their denormalized counters. The result is cached under the user's media
+and album versions (see cache_versions), so it is rebuilt only after
+something it shows has changed.
+"""
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+
+from .cache_versions import album_scope, cached, media_scope
+from .models import ACTIVE, TRASHED, Album, Photo, PhotoDerivative, Video
+
+
+def _media_months(model, user):
+    """One GROUP BY over `user`'s `model` rows: count and live/trashed bytes per upload month"""
+    return (
+        model.all_objects.filter(user=user).annotate(month=TruncMonth('uploaded_at')).order_by().values('month')
+        .annotate(
+            count=Count('id', filter=ACTIVE),
+            bytes=Sum('file_size', filter=ACTIVE, default=0),
+            trashed_count=Count('id', filter=TRASHED),
+            trashed_bytes=Sum('file_size', filter=TRASHED, default=0),
+        )
+    )
+
+
+def compute_breakdown(user):
+    """The breakdown for `user`, read from the database in one query per table"""
+    months = {}
+
+    def month(key):
+        return months.setdefault(key.date(), {
+            'month': key.date().isoformat(), 'photo_bytes': 0, 'video_bytes': 0, 'thumbnail_bytes': 0, 'trashed_bytes': 0,
+        })
+
+    types = {
+        'photos': {'count': 0, 'bytes': 0},
+        'videos': {'count': 0, 'bytes': 0},
+        'thumbnails': {'count': 0, 'bytes': 0},
+        'trash': {'count': 0, 'bytes': 0},
+        'album_covers': {'count': 0, 'bytes': None},  # not sized in the database
+    }
+    for model, kind in ((Photo, 'photos'), (Video, 'videos')):
+        for row in _media_months(model, user):
+            types[kind]['count'] += row['count']
+            types[kind]['bytes'] += row['bytes']
+            types['trash']['count'] += row['trashed_count']
+            types['trash']['bytes'] += row['trashed_bytes']
+            entry = month(row['month'])
+            entry['photo_bytes' if kind == 'photos' else 'video_bytes'] += row['bytes']
+            entry['trashed_bytes'] += row['trashed_bytes']
+
+    derivatives = (
+        PhotoDerivative.objects.filter(photo__user=user)
+        .annotate(month=TruncMonth('photo__uploaded_at')).order_by().values('month')
+        .annotate(count=Count('id'), bytes=Sum('file_size', default=0))
+    )
+    for row in derivatives:
+        types['thumbnails']['count'] += row['count']
+        types['thumbnails']['bytes'] += row['bytes']
+        month(row['month'])['thumbnail_bytes'] += row['bytes']
+
+    albums = list(
+        Album.objects.filter(user=user).order_by('-total_bytes', 'name')
+        .values('id', 'name', 'photo_count', 'video_count', 'total_bytes', 'cover_image')
+    )
+    for album in albums:
+        if album.pop('cover_image'):
+            types['album_covers']['count'] += 1
+
+    return {
+        'types': types,
+        'albums': albums,
+        'months': [months[key] for key in sorted(months, reverse=True)],
+        'total_bytes': sum(facet['bytes'] for facet in types.values() if facet['bytes']),
+    }
+
+
+def storage_breakdown(user):
+    """`user`'s breakdown, from the cache unless their media or albums changed since"""
+    album_ids = Album.objects.filter(user=user).order_by('id').values_list('id', flat=True)
+    scopes = [media_scope(user.pk)] + [album_scope(album_id) for album_id in album_ids]
+    return cached(f'storage_breakdown:{user.pk}', scopes, lambda: compute_breakdown(user))
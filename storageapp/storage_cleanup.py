@@ -0,0 +1,98 @@
+"""Durable removal of stored files left behind by deleted media.
+
+Deleting Photo/Video rows (and releasing their MediaBlobs) only records the
+storage names in StorageCleanupTask, inside the same transaction, so the
+request never waits on the storage backend and a crash cannot lose a file.
+The ``process_storage_cleanup`` command drains the queue in batches through
+the configured storage backend. Names that something still references are
+dropped without touching the file; failed deletes are retried with
+exponential backoff until ``MAX_ATTEMPTS`` is reached. A worker claims a
+batch by pushing its ``next_attempt_at`` out by ``CLAIM_LEASE`` in a short
+transaction and calls the backend with no transaction open, so a slow
+backend holds no row locks; a worker that dies mid-batch leaves its tasks
+to be picked up again once the lease runs out.
+"""
+import logging
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Album, MediaBlob, Photo, PhotoDerivative, StorageCleanupTask, Video
+
+logger = logging.getLogger(__name__)
+
+CLEANUP_BATCH_SIZE = 100
+MAX_ATTEMPTS = 8
+RETRY_BASE_DELAY = timedelta(minutes=1)  # doubled after every failed attempt
+CLAIM_LEASE = timedelta(minutes=10)  # how long a claimed batch is hidden from other workers
+
+
+def _referenced(names):
+    """The subset of `names` still used by a blob, media row (trashed or not), derivative or album cover"""
+    # Content-addressed storage gives equal bytes one name, whatever uploaded them
+    referenced = set(MediaBlob.objects.filter(storage_name__in=names).values_list('storage_name', flat=True))
+    referenced.update(Photo.all_objects.filter(image__in=names).values_list('image', flat=True))
+    referenced.update(Video.all_objects.filter(video_file__in=names).values_list('video_file', flat=True))
+    referenced.update(Video.all_objects.filter(thumbnail__in=names).values_list('thumbnail', flat=True))
+    referenced.update(PhotoDerivative.objects.filter(file__in=names).values_list('file', flat=True))
+    referenced.update(Album.objects.filter(cover_image__in=names).values_list('cover_image', flat=True))
+    return referenced
+
+
+def due_tasks(now=None):
+    return StorageCleanupTask.objects.filter(
+        next_attempt_at__lte=now or timezone.now(), attempts__lt=MAX_ATTEMPTS
+    ).order_by('next_attempt_at', 'id')
+
+
+def process_batch(batch_size=CLEANUP_BATCH_SIZE, storage=None):
+    """Work through one batch of due tasks; returns (deleted, skipped, failed) counts"""
+    storage = storage or default_storage
+    now = timezone.now()
+    with transaction.atomic():
+        # skip_locked lets several workers claim batches side by side; the lease
+        # keeps the claim once the row locks are released
+        tasks = list(due_tasks(now).select_for_update(skip_locked=True)[:batch_size])
+        if not tasks:
+            return 0, 0, 0
+        StorageCleanupTask.objects.filter(pk__in=[task.pk for task in tasks]).update(next_attempt_at=now + CLAIM_LEASE)
+
+    referenced = _referenced([task.storage_name for task in tasks])
+    done = []
+    failed = []
+    skipped = 0
+    for task in tasks:
+        if task.storage_name in referenced:
+            skipped += 1
+            done.append(task.pk)
+            continue
+        try:
+            storage.delete(task.storage_name)
+        except Exception as e:
+            logger.warning('Could not delete %s from storage: %s', task.storage_name, e)
+            task.attempts += 1
+            task.last_error = str(e)
+            task.next_attempt_at = now + RETRY_BASE_DELAY * (2 ** (task.attempts - 1))
+            failed.append(task)
+        else:
+            done.append(task.pk)
+
+    with transaction.atomic():
+        StorageCleanupTask.objects.filter(pk__in=done).delete()
+        if failed:
+            StorageCleanupTask.objects.bulk_update(failed, ['attempts', 'last_error', 'next_attempt_at'])
+    return len(done) - skipped, skipped, len(failed)
+
+
+def process_cleanup_queue(batch_size=CLEANUP_BATCH_SIZE, storage=None):
+    """Drain every task that is currently due; returns (deleted, skipped, failed) totals"""
+    totals = [0, 0, 0]
+    while True:
+        counts = process_batch(batch_size, storage)
+        for index, count in enumerate(counts):
+            totals[index] += count
+        if sum(counts) < batch_size:
+            break
+    return tuple(totals)
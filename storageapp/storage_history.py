@@ -0,0 +1,103 @@
+"""Daily storage history rebuilt from the StorageEvent log.
+
+Every change to a user's storage_used is logged as a StorageEvent (see
+UserProfile.adjust_storage_used). A day's total is worked out backwards from
+the current storage_used: the usage at the end of day D is the current usage
+minus every change logged after D. Uploads of surviving media from before
+the log existed stand in for the events that were never written, so the
+series reaches back past the log's start; media uploaded before then and
+since purged has no upload left to subtract and counts from the start of
+the series. All of a batch of users' changes come from one grouped query,
+and their rows are upserted with bulk_create.
+"""
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.recorder import MigrationRecorder
+from django.db.models import Min, Sum
+from django.db.models.functions import TruncDate
+
+from .models import Photo, StorageEvent, StorageHistory, UserProfile, Video
+
+HISTORY_USER_BATCH_SIZE = 500
+HISTORY_WRITE_BATCH_SIZE = 5000
+EVENT_LOG_MIGRATION = '0032_storage_events'
+
+
+def log_started_at():
+    """When StorageEvent logging began: the time its migration was applied"""
+    recorder = MigrationRecorder(connections[DEFAULT_DB_ALIAS])
+    applied = recorder.migration_qs.filter(app='storageapp', name=EVENT_LOG_MIGRATION).values_list('applied', flat=True).first()
+    if applied is None:
+        applied = StorageEvent.objects.aggregate(first=Min('created_at'))['first']
+    return applied
+
+
+def _daily_uploads(model, user_ids, before):
+    return (
+        model.all_objects.filter(user_id__in=user_ids, uploaded_at__lt=before)
+        .annotate(day=TruncDate('uploaded_at')).order_by()
+        .values('user_id', 'day').annotate(total=Sum('file_size'))
+    )
+
+
+def daily_changes(user_ids, log_start=None):
+    """{user_id: {date: bytes added that day}} for `user_ids`, in a single query.
+
+    Uploads from before `log_start` (see log_started_at) stand in for the
+    events that were never logged; later uploads are logged events already.
+    """
+    events = (
+        StorageEvent.objects.filter(user_id__in=user_ids)
+        .annotate(day=TruncDate('created_at')).order_by()
+        .values('user_id', 'day').annotate(total=Sum('delta'))
+    )
+    changes = {}
+    rows = events
+    if log_start is not None:
+        rows = events.union(_daily_uploads(Photo, user_ids, log_start), _daily_uploads(Video, user_ids, log_start), all=True)
+    for row in rows:
+        days = changes.setdefault(row['user_id'], {})
+        days[row['day']] = days.get(row['day'], 0) + row['total']
+    return changes
+
+
+def history_rows(user_id, current, changes, start_date, end_date):
+    """StorageHistory rows for `user_id` from `start_date` to `end_date`, newest first"""
+    # Usage at the end of end_date: undo everything that happened after it
+    used = current - sum(total for day, total in changes.items() if day > end_date)
+    day = end_date
+    while day >= start_date:
+        yield StorageHistory(user_id=user_id, date=day, storage_used=max(used, 0))
+        used -= changes.get(day, 0)
+        day -= timedelta(days=1)
+
+
+def rebuild_history(start_date, end_date, user_ids=None, batch_size=HISTORY_USER_BATCH_SIZE):
+    """Write every user's daily totals from `start_date` to `end_date`; returns the number of rows"""
+    users = User.objects.order_by('pk')
+    if user_ids is not None:
+        users = users.filter(pk__in=user_ids)
+    user_ids = list(users.values_list('pk', flat=True))
+    log_start = log_started_at()
+
+    written = 0
+    for index in range(0, len(user_ids), batch_size):
+        batch = user_ids[index:index + batch_size]
+        current = dict(UserProfile.objects.filter(user_id__in=batch).values_list('user_id', 'storage_used'))
+        changes = daily_changes(batch, log_start)
+        rows = [
+            row
+            for user_id in batch
+            for row in history_rows(user_id, current.get(user_id, 0), changes.get(user_id, {}), start_date, end_date)
+        ]
+        StorageHistory.objects.bulk_create(
+            rows,
+            batch_size=HISTORY_WRITE_BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['user', 'date'],
+            update_fields=['storage_used'],
+        )
+        written += len(rows)
+    return written
@@ -1,3 +1,1590 @@
-from django.test import TestCase
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import numpy as np
+import requests
+from urllib3 import HTTPResponse
+from PIL import Image
+
+from . import analytics, cache_versions, chunked_upload, derivatives, quota, search, storage_breakdown, views, zipstream
+from .albums import add_to_albums, sync_album_items
+from .cache_versions import album_scope, media_scope, notifications_scope
+from .dashboard import DashboardSummary
+from .dedup import instant_upload, save_media
+from .forecast import fit_trend, forecast_for_user, load_usage
+from .ordering import MEDIA_ORDERING, ORDER_GAP, apply_order
+from .pagination import InvalidCursor, keyset_paginate
+from .models import EXTRA_STORAGE_LIMIT, Album, AlbumPhoto, AlbumVideo, MediaBlob, Notification, Photo, PhotoDerivative, SharedAlbum, StorageCleanupTask, StorageEvent, StorageHistory, StorageReservation, StorageRollup, StorageUpgradeRequest, UploadSession, UserProfile, Video
+from .orphans import BloomFilter, build_reference_filter, find_orphans
+from .storage import CloudinaryMediaStorage, ReadThroughCacheStorage, ShardedFileSystemStorage
+from . import storage_cleanup
+from .storage_cleanup import process_cleanup_queue
+from .storage_history import rebuild_history
+from . import trash as trash_media
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+def png_bytes(width=800, height=600, color=(200, 10, 10)):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@override_settings(
+    MEDIA_ROOT=MEDIA_ROOT,
+    STORAGES={**settings.STORAGES, 'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'}},
+    CHUNKED_UPLOAD_SPOOL_DIR=os.path.join(MEDIA_ROOT, 'spool'),
+)
+class MediaTestCase(TestCase):
+    """Stores media on the local filesystem in a throwaway directory"""
+
+    def make_user(self, username='alice'):
+        return User.objects.create_user(username, password='pw')
+
+    def add_photo(self, user, data, name='photo.jpg', **fields):
+        return save_media(Photo(user=user, **fields), 'image', ContentFile(data, name=name))
+
+    def add_video(self, user, data, name='video.mp4', **fields):
+        return save_media(Video(user=user, **fields), 'video_file', ContentFile(data, name=name))
+
+    def storage_used(self, user):
+        return UserProfile.objects.get(user=user).storage_used
+
+
+class StorageLedgerTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+
+    def assertLedgerMatchesMedia(self):
+        used = self.storage_used(self.user)
+        UserProfile.recalculate_storage_used(user_ids=[self.user.pk])
+        self.assertEqual(self.storage_used(self.user), used)
+
+    def test_uploads_are_charged(self):
+        self.add_photo(self.user, b'a' * 100)
+        self.add_video(self.user, b'b' * 250)
+        self.assertEqual(self.storage_used(self.user), 350)
+        self.assertLedgerMatchesMedia()
+
+    def test_trash_and_restore_keep_the_charge(self):
+        photo = self.add_photo(self.user, b'a' * 100)
+        self.add_photo(self.user, b'c' * 40)
+        Photo.objects.filter(pk=photo.pk).trash()
+        self.assertEqual(self.storage_used(self.user), 140)
+        Photo.all_objects.filter(pk=photo.pk).restore()
+        self.assertEqual(self.storage_used(self.user), 140)
+        self.assertLedgerMatchesMedia()
+
+    def test_purge_releases_the_charge(self):
+        photo = self.add_photo(self.user, b'a' * 100)
+        video = self.add_video(self.user, b'b' * 250)
+        self.add_photo(self.user, b'c' * 40)
+        Photo.objects.filter(pk=photo.pk).trash()
+        Video.objects.filter(pk=video.pk).trash()
+        trash_media.empty_trash(self.user)
+        self.assertEqual(trash_media.purge_expired(batch_size=1), 2)
+        self.assertEqual(self.storage_used(self.user), 40)
+        self.assertFalse(Photo.all_objects.filter(pk=photo.pk).exists())
+        self.assertLedgerMatchesMedia()
+
+    def test_single_and_bulk_delete_release_the_charge(self):
+        first = self.add_photo(self.user, b'a' * 100)
+        self.add_photo(self.user, b'c' * 40)
+        self.add_video(self.user, b'b' * 250)
+        first.delete()
+        self.assertEqual(self.storage_used(self.user), 290)
+        Video.all_objects.filter(user=self.user).delete()
+        self.assertEqual(self.storage_used(self.user), 40)
+        self.assertLedgerMatchesMedia()
+
+    def test_duplicate_upload_is_charged_per_copy(self):
+        self.add_photo(self.user, b'a' * 100)
+        self.add_photo(self.user, b'a' * 100, name='copy.jpg')
+        self.assertEqual(self.storage_used(self.user), 200)
+        self.assertLedgerMatchesMedia()
+
+
+class DashboardSummaryTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.add_photo(self.user, b'a' * 100)
+        trashed = self.add_photo(self.user, b'b' * 40)
+        Photo.objects.filter(pk=trashed.pk).trash()
+        self.add_video(self.user, b'v' * 250)
+        self.add_photo(self.make_user('bob'), b'bob' * 10)
+        Notification.objects.create(user=self.user, message='hello')
+        Notification.objects.create(user=self.user, message='read', is_read=True)
+
+    def figures(self, summary):
+        return summary.photo_count, summary.photo_bytes, summary.video_count, summary.video_bytes, summary.unread_notifications
+
+    def test_summary_is_one_query(self):
+        with self.assertNumQueries(1):
+            summary = DashboardSummary.compute(self.user)
+        self.assertEqual(self.figures(summary), (1, 100, 1, 250, 1))
+        self.assertEqual(summary.profile.storage_used, 390)  # trashed media is still charged
+
+    def test_cached_until_something_it_shows_changes(self):
+        with mock.patch.object(DashboardSummary, 'compute', wraps=DashboardSummary.compute) as computed:
+            DashboardSummary.for_user(self.user)
+            DashboardSummary.for_user(self.user)
+        self.assertEqual(computed.call_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_photo(self.user, b'c' * 10)
+        self.assertEqual(self.figures(DashboardSummary.for_user(self.user))[:2], (2, 110))
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.filter(user=self.user).update(is_read=True)
+        self.assertEqual(DashboardSummary.for_user(self.user).unread_notifications, 0)
+        profile = UserProfile.objects.get(user=self.user)
+        profile.has_paid_for_extra_storage = True
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.save(update_fields=['has_paid_for_extra_storage'])
+        self.assertEqual(DashboardSummary.for_user(self.user).profile.storage_limit, EXTRA_STORAGE_LIMIT)
+
+    def test_dashboard_page(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/dashboard/')
+        self.assertEqual((response.context['photo_count'], response.context['video_count']), (1, 1))
+        self.assertEqual(response.context['unread_notifications'], 1)
+
+
+class PhotoDerivativeTests(MediaTestCase):
+    def setUp(self):
+        self.photo = self.add_photo(self.make_user(), png_bytes(), name='photo.png')
+
+    def test_generates_every_size_and_format(self):
+        created = derivatives.generate_photo_derivatives(self.photo)
+        self.assertEqual(len(created), len(derivatives.DERIVATIVE_SIZES) * len(derivatives.DERIVATIVE_FORMATS))
+        self.assertEqual(self.photo.get_derivative(256).width, 256)
+
+    def test_storage_failure_falls_back_to_the_original(self):
+        with mock.patch.object(FileSystemStorage, '_save', side_effect=OSError('disk full')), \
+                self.assertLogs('storageapp.derivatives', 'ERROR'):
+            self.assertEqual(derivatives.generate_photo_derivatives(self.photo), [])
+        self.assertFalse(PhotoDerivative.objects.exists())
+        self.assertEqual(self.photo.thumbnail_url, self.photo.image.url)
+
+    def test_failed_size_is_skipped_and_its_files_queued_for_removal(self):
+        encode = derivatives._encode
+
+        def fail_small_jpeg(image, fmt):
+            if max(image.size) <= 256 and fmt == PhotoDerivative.JPEG:
+                raise OSError('encoder crashed')
+            return encode(image, fmt)
+
+        with mock.patch.object(derivatives, '_encode', side_effect=fail_small_jpeg), \
+                self.assertLogs('storageapp.derivatives', 'ERROR'):
+            created = derivatives.generate_photo_derivatives(self.photo)
+        self.assertEqual(sorted({d.size for d in created}), [512, 1024])
+        self.assertEqual(PhotoDerivative.objects.filter(photo=self.photo).count(), len(created))
+        # The 256px WebP was stored before the JPEG failed, and must not be left behind
+        queued = list(StorageCleanupTask.objects.values_list('storage_name', flat=True))
+        self.assertEqual(len(queued), 1)
+        self.assertTrue(queued[0].endswith('_256.webp'))
+
+
+class KeysetPaginationTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        for i in range(7):
+            self.add_photo(self.user, b'photo %d' % i, title=f'p{i}')
+        # Every row ties on the leading sort keys, so only the id tiebreak orders them
+        Photo.objects.update(order=0, uploaded_at=timezone.now())
+
+    def walk(self, per_page, between_pages=None):
+        ids, cursor = [], None
+        while True:
+            page = keyset_paginate(Photo.objects.filter(user=self.user), MEDIA_ORDERING, cursor=cursor, per_page=per_page)
+            ids += [photo.pk for photo in page]
+            if not page.has_next():
+                return ids
+            cursor = page.next_cursor
+            if between_pages:
+                between_pages()
+
+    def test_pages_cover_tied_rows_exactly_once(self):
+        expected = list(Photo.objects.filter(user=self.user).order_by(*MEDIA_ORDERING).values_list('pk', flat=True))
+        for per_page in (1, 2, 3, 7, 8):
+            self.assertEqual(self.walk(per_page), expected)
+
+    def test_rows_added_between_pages_do_not_shift_later_pages(self):
+        expected = list(Photo.objects.filter(user=self.user).order_by(*MEDIA_ORDERING).values_list('pk', flat=True))
+        tied = Photo.objects.first()
+
+        def add_tied_photo():
+            self.add_photo(self.user, b'late %d' % Photo.objects.count(), uploaded_at=tied.uploaded_at)
+            Photo.objects.filter(order__lt=0).update(order=0)
+
+        ids = self.walk(3, between_pages=add_tied_photo)
+        self.assertEqual(len(ids), len(set(ids)))
+        # Newer rows sort first (-id), so none of them lands on a later page
+        self.assertEqual(ids, expected)
+
+    def test_ajax_cursor_walk(self):
+        self.client.force_login(self.user)
+        seen, cursor = [], ''
+        while True:
+            data = self.client.get('/photos/ajax/', {'cursor': cursor}).json()
+            seen += [photo['id'] for photo in data['photos']]
+            if not data['has_next']:
+                break
+            cursor = data['next_cursor']
+        self.assertEqual(sorted(seen), sorted(Photo.objects.values_list('pk', flat=True)))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_tampered_cursor_is_rejected(self):
+        with self.assertRaises(InvalidCursor):
+            keyset_paginate(Photo.objects.all(), MEDIA_ORDERING, cursor='not-a-cursor')
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/photos/ajax/', {'cursor': 'WyJ4Il0'}).status_code, 400)
+
+
+def read_zip(chunks):
+    archive = zipfile.ZipFile(BytesIO(b''.join(chunks)))
+    return {info.filename: archive.read(info) for info in archive.infolist()}
+
+
+def zip_entry(name, data, size=None):
+    return zipstream.ZipEntry(name, open=lambda: BytesIO(data), size=len(data) if size is None else size)
+
+
+class SearchTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.beach = self.add_photo(self.user, b'beach', title='Sunset at the beach', description='Warm evening')
+        self.hike = self.add_video(self.user, b'hike', title='Mountain hike', description='We stopped at a beach on the way')
+        self.add_photo(self.make_user('bob'), b'bob', title='Beach volleyball')
+
+    def found(self, query, **kwargs):
+        return [(result.kind, result.item.pk) for result in search.search_media(self.user, query, **kwargs)]
+
+    def test_matches_are_ranked_and_scoped_to_the_user(self):
+        self.assertEqual(self.found('beach'), [('photo', self.beach.pk), ('video', self.hike.pk)])  # title outranks description
+        self.assertEqual(self.found('sun'), [('photo', self.beach.pk)])  # words match as prefixes
+        self.assertEqual(self.found('beach', media_type='videos'), [('video', self.hike.pk)])
+        self.assertEqual(self.found('volleyball'), [])
+        self.assertEqual(self.found('beach" NEAR( *'), [])  # operators are words, not FTS syntax
+        self.assertEqual(self.found('"beach*'), self.found('beach'))
+
+    def test_index_follows_edits_trash_and_deletes(self):
+        self.beach.title = 'Harbour at dusk'
+        self.beach.save()
+        self.assertEqual(self.found('sunset'), [])
+        self.assertEqual(self.found('harbour'), [('photo', self.beach.pk)])
+
+        Photo.objects.filter(pk=self.beach.pk).trash()
+        self.assertEqual(self.found('harbour'), [])
+        Photo.all_objects.filter(pk=self.beach.pk).restore()
+        self.assertEqual(self.found('harbour'), [('photo', self.beach.pk)])
+
+        self.hike.delete()
+        self.assertEqual(self.found('mountain'), [])
+
+    def test_cached_results_are_refreshed_by_an_edit(self):
+        self.client.force_login(self.user)
+        self.assertContains(self.client.get('/search/?q=sunset'), 'Sunset at the beach')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.beach.title = 'Sunset over the harbour'
+            self.beach.save()
+        response = self.client.get('/search/?q=sunset')
+        self.assertContains(response, 'Sunset over the harbour')
+        self.assertNotContains(response, 'Sunset at the beach')
+
+
+class StreamZipTests(MediaTestCase):
+    def test_round_trip(self):
+        files = {'a.jpg': b'first' * 1000, 'b.mp4': b'', 'caf\u00e9.png': bytes(range(256)) * 50}
+        entries = [zip_entry(name, data) for name, data in files.items()]
+        self.assertEqual(read_zip(zipstream.stream_zip(entries, chunk_size=333)), files)
+
+    def test_duplicate_names_are_renamed(self):
+        entries = [zip_entry('IMG.jpg', b'1'), zip_entry('IMG.jpg', b'2'), zip_entry('IMG', b'3'), zip_entry('IMG', b'4')]
+        self.assertEqual(
+            read_zip(zipstream.stream_zip(entries)),
+            {'IMG.jpg': b'1', 'IMG (1).jpg': b'2', 'IMG': b'3', 'IMG (1)': b'4'},
+        )
+
+    def test_unreadable_entries_are_skipped(self):
+        def broken():
+            raise OSError('gone from storage')
+
+        entries = [zip_entry('ok.jpg', b'data'), zipstream.ZipEntry('missing.jpg', open=broken)]
+        with self.assertLogs('storageapp.zipstream', 'ERROR'):
+            self.assertEqual(read_zip(zipstream.stream_zip(entries)), {'ok.jpg': b'data'})
+
+    def test_zip64_entry_headers(self):
+        # A size hint past 4GB switches the entry to ZIP64 headers and descriptor
+        chunks = list(zipstream.stream_zip([zip_entry('big.mp4', b'video' * 100, size=zipstream.ZIP32_LIMIT), zip_entry('small.jpg', b'x')]))
+        archive = zipfile.ZipFile(BytesIO(b''.join(chunks)))
+        self.assertEqual(archive.read('big.mp4'), b'video' * 100)
+        self.assertEqual(archive.read('small.jpg'), b'x')
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(chunks[0][4:6], zipstream.VERSION_ZIP64.to_bytes(2, 'little'))
+
+    def test_zip64_end_of_central_directory(self):
+        count = zipstream.ZIP32_ENTRY_LIMIT + 2
+        entries = (zip_entry(f'{i}.jpg', b'%d' % i) for i in range(count))
+        data = b''.join(zipstream.stream_zip(entries))
+        self.assertIn(b'PK\x06\x06', data)
+        archive = zipfile.ZipFile(BytesIO(data))
+        self.assertEqual(len(archive.infolist()), count)
+        self.assertEqual(archive.read(f'{count - 1}.jpg'), b'%d' % (count - 1))
+
+    def test_download_photos_view(self):
+        user = self.make_user()
+        photos = [self.add_photo(user, b'photo %d' % i, name=f'{i}.jpg') for i in range(3)]
+        self.client.force_login(user)
+        response = self.client.post('/photos/download/', {'photo_ids': [photo.pk for photo in photos]})
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        contents = read_zip(response.streaming_content)
+        self.assertEqual(sorted(contents.values()), [b'photo 0', b'photo 1', b'photo 2'])
+
+
+class DedupRaceTests(MediaTestCase):
+    def race(self, storage_class):
+        """Upload bytes that a second upload stores and records while the first is still being stored"""
+        user = self.make_user()
+        data = b'the same bytes'
+        store = storage_class._save
+        theirs = []
+
+        def store_then_lose_the_race(storage, name, content):
+            stored = store(storage, name, content)
+            if not theirs:
+                theirs.append(None)
+                theirs[0] = self.add_photo(user, data, name='theirs.jpg')
+            return stored
+
+        with mock.patch.object(storage_class, '_save', store_then_lose_the_race):
+            ours = self.add_photo(user, data, name='ours.jpg')
+        return ours, theirs[0]
+
+    @override_settings(STORAGES={**settings.STORAGES, 'default': {'BACKEND': 'storageapp.storage.ShardedFileSystemStorage'}})
+    def test_losing_upload_keeps_the_shared_content_addressed_file(self):
+        ours, theirs = self.race(ShardedFileSystemStorage)
+        ours.refresh_from_db()
+        self.assertEqual(ours.image.name, theirs.image.name)
+        self.assertEqual(MediaBlob.objects.get().ref_count, 2)
+        self.assertEqual(process_cleanup_queue(), (0, 1, 0))  # queued, then skipped as still referenced
+        self.assertTrue(default_storage.exists(ours.image.name))
+        self.assertEqual(ours.image.read(), b'the same bytes')
+
+    def test_losing_upload_copy_is_removed_by_the_cleanup_queue(self):
+        store = FileSystemStorage._save
+        names = []
+        with mock.patch.object(FileSystemStorage, '_save', lambda storage, name, content: names.append(store(storage, name, content)) or names[-1]):
+            ours, theirs = self.race(FileSystemStorage)
+        ours.refresh_from_db()
+        self.assertEqual(ours.image.name, theirs.image.name)
+        losing_copy = next(name for name in names if name != theirs.image.name)
+        self.assertTrue(default_storage.exists(losing_copy))
+        self.assertEqual(process_cleanup_queue(), (1, 0, 0))
+        self.assertFalse(default_storage.exists(losing_copy))
+        self.assertTrue(default_storage.exists(theirs.image.name))
+
+
+class ShardedStorageTests(MediaTestCase):
+    def setUp(self):
+        self.storage = ShardedFileSystemStorage(location=tempfile.mkdtemp(dir=MEDIA_ROOT))
+
+    def test_equal_bytes_share_one_content_addressed_name(self):
+        first = self.storage.save('users/a/photos/x.JPG', ContentFile(b'bytes'))
+        second = self.storage.save('users/b/photos/y.jpg', ContentFile(b'bytes'))
+        self.assertEqual(first, second)
+        self.assertRegex(first, r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertNotEqual(self.storage.save('z.jpg', ContentFile(b'other bytes')), first)
+
+    def test_reupload_restarts_the_orphan_grace_period(self):
+        name = self.storage.save('old.jpg', ContentFile(b'orphaned bytes'))
+        long_ago = time.time() - 30 * 86400
+        os.utime(self.storage.path(name), (long_ago, long_ago))
+        cutoff = timezone.now() - timedelta(days=1)
+        root = name.split('/')[0]
+        self.assertEqual(list(find_orphans(self.storage, BloomFilter(1), cutoff, roots=[root])), [name])
+
+        self.assertEqual(self.storage.save('new.jpg', ContentFile(b'orphaned bytes')), name)
+        stats = {}
+        self.assertEqual(list(find_orphans(self.storage, BloomFilter(1), cutoff, roots=[root], stats=stats)), [])
+        self.assertEqual(stats['recent'], 1)
+
+
+class ChunkedUploadTests(MediaTestCase):
+    data = bytes(range(256)) * 40
+
+    def setUp(self):
+        shutil.rmtree(settings.CHUNKED_UPLOAD_SPOOL_DIR, ignore_errors=True)
+        self.user = self.make_user()
+        self.client.force_login(self.user)
+
+    def start(self, size=None):
+        response = self.client.post('/upload/video/sessions/', {
+            'filename': 'clip.mp4', 'content_type': 'video/mp4', 'size': len(self.data) if size is None else size,
+        })
+        self.assertEqual(response.status_code, 201)
+        return response.json()['upload_id']
+
+    def send(self, upload_id, offset, body):
+        return self.client.post(
+            f'/upload/video/sessions/{upload_id}/chunk/', data=body,
+            content_type='application/octet-stream', HTTP_X_UPLOAD_OFFSET=str(offset),
+        )
+
+    def finalize(self, upload_id):
+        return self.client.post(f'/upload/video/sessions/{upload_id}/finalize/')
+
+    def spool_files(self):
+        return sorted(os.listdir(settings.CHUNKED_UPLOAD_SPOOL_DIR))
+
+    def test_resumable_upload(self):
+        upload_id = self.start()
+        self.assertEqual(self.send(upload_id, 0, self.data[:4000]).json()['offset'], 4000)
+        # A client resuming from a stale offset is told where the server is
+        response = self.send(upload_id, 1000, self.data[1000:5000])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get(f'/upload/video/sessions/{upload_id}/').json()['offset'], 4000)
+        self.send(upload_id, 4000, self.data[4000:])
+
+        response = self.finalize(upload_id)
+        self.assertTrue(response.json()['success'])
+        video = Video.objects.get(pk=response.json()['video_id'])
+        self.assertEqual(video.video_file.read(), self.data)
+        self.assertEqual(self.finalize(upload_id).json()['video_id'], video.pk)  # idempotent
+        self.assertEqual(self.spool_files(), [])
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual((profile.storage_used, profile.storage_reserved), (len(self.data), 0))
+
+    def test_incomplete_chunk_leaves_the_spool_untouched(self):
+        upload_id = self.start()
+        with self.assertRaises(chunked_upload.ChunkError):
+            chunked_upload.append_chunk(upload_id, self.user, 0, BytesIO(self.data[:100]), 500)
+        self.assertEqual(UploadSession.objects.get(pk=upload_id).offset, 0)
+        self.assertEqual(self.spool_files(), [f'{upload_id}.part'])
+        self.assertEqual(os.path.getsize(chunked_upload.spool_path(upload_id)), 0)
+
+    def test_transfer_runs_outside_any_transaction(self):
+        upload_id = self.start()
+        self.send(upload_id, 0, self.data)
+        open_blocks = len(connection.atomic_blocks)
+        save_media = chunked_upload.save_media
+        seen = {}
+
+        def checked_save_media(*args, **kwargs):
+            seen['atomic_blocks'] = len(connection.atomic_blocks)
+            seen['status'] = UploadSession.objects.get(pk=upload_id).status
+            seen['chunk'] = self.send(upload_id, len(self.data) - 1, b'x').status_code
+            seen['finalize'] = self.finalize(upload_id).status_code
+            return save_media(*args, **kwargs)
+
+        with mock.patch.object(chunked_upload, 'save_media', checked_save_media):
+            self.assertTrue(self.finalize(upload_id).json()['success'])
+        self.assertEqual(seen, {'atomic_blocks': open_blocks, 'status': 'finalizing', 'chunk': 410, 'finalize': 409})
+
+    def test_failed_transfer_can_be_retried(self):
+        upload_id = self.start()
+        self.send(upload_id, 0, self.data)
+        with mock.patch.object(chunked_upload, 'save_media', side_effect=OSError('storage unavailable')):
+            with self.assertRaises(OSError):
+                chunked_upload.finalize_session(upload_id, self.user)
+        self.assertEqual(UploadSession.objects.get(pk=upload_id).status, 'active')
+        self.assertFalse(Video.objects.exists())
+        self.assertTrue(self.finalize(upload_id).json()['success'])
+
+    def test_expired_sessions_are_collected_and_release_their_quota(self):
+        stuck = self.start()
+        self.send(stuck, 0, self.data)
+        UploadSession.objects.filter(pk=stuck).update(status='finalizing')
+        abandoned = self.start()
+        self.assertEqual(UserProfile.objects.get(user=self.user).storage_reserved, 2 * len(self.data))
+
+        later = timezone.now() + timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS + 1)
+        self.assertEqual(chunked_upload.collect_expired_sessions(now=later), 2)
+        self.assertFalse(UploadSession.objects.filter(pk__in=[stuck, abandoned]).exists())
+        self.assertEqual(self.spool_files(), [])
+        self.assertEqual(UserProfile.objects.get(user=self.user).storage_reserved, 0)
+        self.assertFalse(StorageReservation.objects.exists())
+
+
+    def test_collector_running_during_the_transfer(self):
+        upload_id = self.start()
+        self.send(upload_id, 0, self.data)
+        # Close to expiry when the client finalizes
+        UploadSession.objects.filter(pk=upload_id).update(expires_at=timezone.now() + timedelta(seconds=1))
+        save_media = chunked_upload.save_media
+        collected = []
+
+        def save_media_while_collecting(*args, **kwargs):
+            video = save_media(*args, **kwargs)
+            collected.append(chunked_upload.collect_expired_sessions(now=timezone.now() + timedelta(minutes=5)))
+            return video
+
+        with mock.patch.object(chunked_upload, 'save_media', save_media_while_collecting):
+            self.assertTrue(self.finalize(upload_id).json()['success'])
+        self.assertEqual(collected, [0])  # the claim extended the session
+        self.assertEqual(UploadSession.objects.get(pk=upload_id).status, 'completed')
+
+    def test_session_collected_during_the_transfer_keeps_its_video(self):
+        upload_id = self.start()
+        self.send(upload_id, 0, self.data)
+        save_media = chunked_upload.save_media
+        later = timezone.now() + timedelta(hours=2 * settings.CHUNKED_UPLOAD_EXPIRY_HOURS + 1)
+
+        def save_media_then_collect(*args, **kwargs):
+            video = save_media(*args, **kwargs)
+            self.assertEqual(chunked_upload.collect_expired_sessions(now=later), 1)
+            return video
+
+        with mock.patch.object(chunked_upload, 'save_media', save_media_then_collect):
+            video = chunked_upload.finalize_session(upload_id, self.user)
+        self.assertEqual(Video.objects.get().pk, video.pk)
+        self.assertFalse(UploadSession.objects.exists())
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual((profile.storage_used, profile.storage_reserved), (len(self.data), 0))
+
+
+class MediaBlobTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+
+    def blob(self):
+        return MediaBlob.objects.get()
+
+    def blob_for(self, data):
+        return MediaBlob.objects.get(sha256=hashlib.sha256(data).hexdigest())
+
+    def test_equal_bytes_are_stored_once_and_counted(self):
+        photo = self.add_photo(self.user, b'shared bytes')
+        copy = self.add_photo(self.user, b'shared bytes', name='copy.jpg')
+        video = self.add_video(self.user, b'shared bytes')
+        self.assertEqual(self.blob().ref_count, 3)
+        self.assertEqual({photo.image.name, copy.image.name, video.video_file.name}, {self.blob().storage_name})
+
+    def test_file_is_released_with_the_last_reference(self):
+        photo = self.add_photo(self.user, b'shared bytes')
+        copy = self.add_photo(self.user, b'shared bytes', name='copy.jpg')
+        name = self.blob().storage_name
+        photo.delete()
+        self.assertEqual(self.blob().ref_count, 1)
+        self.assertFalse(StorageCleanupTask.objects.filter(storage_name=name).exists())
+        copy.delete()
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertTrue(StorageCleanupTask.objects.filter(storage_name=name).exists())
+        process_cleanup_queue()
+        self.assertFalse(default_storage.exists(name))
+
+    def test_bulk_delete_releases_every_reference(self):
+        for i in range(3):
+            self.add_photo(self.user, b'shared bytes', name=f'{i}.jpg')
+        self.add_photo(self.user, b'other bytes')
+        Photo.all_objects.filter(image=self.blob_for(b'shared bytes').storage_name).delete()
+        self.assertEqual(list(MediaBlob.objects.values_list('ref_count', flat=True)), [1])
+
+    def test_trash_keeps_the_reference_until_purged(self):
+        photo = self.add_photo(self.user, b'shared bytes')
+        Photo.objects.filter(pk=photo.pk).trash()
+        self.assertEqual(self.blob().ref_count, 1)
+        trash_media.empty_trash(self.user)
+        trash_media.purge_expired()
+        self.assertFalse(MediaBlob.objects.exists())
+
+    def test_instant_upload_needs_an_owned_copy(self):
+        photo = self.add_photo(self.user, b'shared bytes')
+        sha256, size = photo.content_hash, photo.file_size
+        self.assertIsNone(instant_upload(self.make_user('mallory'), 'photo', sha256, size))
+        self.assertIsNone(instant_upload(self.user, 'photo', sha256, size + 1))
+        video = instant_upload(self.user, 'video', sha256, size, title='again')
+        self.assertEqual(video.video_file.name, photo.image.name)
+        self.assertEqual(self.blob().ref_count, 2)
+        self.assertEqual(self.storage_used(self.user), 2 * size)
+
+
+class StorageCleanupTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+
+    def stored(self, name, data=b'bytes'):
+        return default_storage.save(name, ContentFile(data))
+
+    def test_referenced_names_are_skipped(self):
+        photo = self.add_photo(self.user, png_bytes(), name='p.png')
+        trashed = self.add_photo(self.user, b'trashed bytes', name='t.jpg')
+        Photo.objects.filter(pk=trashed.pk).trash()
+        derivative = derivatives.generate_photo_derivatives(photo)[0]
+        cover = self.stored('album_covers/cover.jpg')
+        Album.objects.create(user=self.user, name='Trip', cover_image=cover)
+        orphan = self.stored('users/alice/photos/orphan.jpg')
+        kept = [photo.image.name, trashed.image.name, derivative.file.name, cover]
+
+        StorageCleanupTask.enqueue(kept + [orphan])
+        self.assertEqual(process_cleanup_queue(), (1, len(kept), 0))
+        self.assertFalse(StorageCleanupTask.objects.exists())
+        self.assertFalse(default_storage.exists(orphan))
+        for name in kept:
+            self.assertTrue(default_storage.exists(name), name)
+
+    def test_failed_deletes_back_off_and_give_up(self):
+        name = self.stored('users/alice/photos/stuck.jpg')
+        StorageCleanupTask.enqueue([name])
+        with mock.patch.object(FileSystemStorage, 'delete', side_effect=OSError('backend down')), \
+                self.assertLogs('storageapp.storage_cleanup', 'WARNING'):
+            self.assertEqual(process_cleanup_queue(), (0, 0, 1))
+            task = StorageCleanupTask.objects.get()
+            self.assertEqual(task.attempts, 1)
+            self.assertIn('backend down', task.last_error)
+            self.assertGreater(task.next_attempt_at, timezone.now())
+            self.assertEqual(process_cleanup_queue(), (0, 0, 0))  # not due yet
+
+            delays = []
+            for attempt in range(2, storage_cleanup.MAX_ATTEMPTS + 1):
+                StorageCleanupTask.objects.update(next_attempt_at=timezone.now())
+                started = timezone.now()
+                process_cleanup_queue()
+                delays.append(StorageCleanupTask.objects.get().next_attempt_at - started)
+            self.assertEqual(StorageCleanupTask.objects.get().attempts, storage_cleanup.MAX_ATTEMPTS)
+            self.assertTrue(all(later > earlier for earlier, later in zip(delays, delays[1:])))
+            StorageCleanupTask.objects.update(next_attempt_at=timezone.now())
+            self.assertEqual(process_cleanup_queue(), (0, 0, 0))  # given up
+        self.assertTrue(default_storage.exists(name))
+
+    def test_backend_deletes_run_outside_the_claim(self):
+        name = self.stored('users/alice/photos/slow.jpg')
+        StorageCleanupTask.enqueue([name])
+        open_blocks = len(connection.atomic_blocks)
+        delete = FileSystemStorage.delete
+        seen = {}
+
+        def checked_delete(storage, name):
+            seen['atomic_blocks'] = len(connection.atomic_blocks)
+            seen['other_worker'] = storage_cleanup.process_batch()  # the lease hides the claimed task
+            return delete(storage, name)
+
+        with mock.patch.object(FileSystemStorage, 'delete', checked_delete):
+            self.assertEqual(process_cleanup_queue(), (1, 0, 0))
+        self.assertEqual(seen, {'atomic_blocks': open_blocks, 'other_worker': (0, 0, 0)})
+        self.assertFalse(StorageCleanupTask.objects.exists())
+
+
+class TrashTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.client.force_login(self.user)
+        self.photos = [self.add_photo(self.user, b'photo %d' % i, title=f'p{i}') for i in range(3)]
+
+    def listed(self, **headers):
+        response = self.client.get('/photos/ajax/?cursor=', **headers)
+        return response, [photo['id'] for photo in response.json()['photos']] if response.status_code == 200 else None
+
+    def test_deleted_photos_leave_the_listing_until_restored(self):
+        response, _ = self.listed()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/photos/delete/', {'photo_ids': [self.photos[0].pk, self.photos[1].pk]})
+        response, ids = self.listed(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(ids, [self.photos[2].pk])
+        self.assertEqual(Photo.all_objects.trashed().count(), 2)
+
+        trash_page = self.client.get('/trash/')
+        self.assertEqual([photo.pk for photo in trash_page.context['photos']], [self.photos[1].pk, self.photos[0].pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/trash/restore/', {'photo_ids': [self.photos[0].pk]})
+        _, ids = self.listed()
+        self.assertEqual(sorted(ids), sorted([self.photos[0].pk, self.photos[2].pk]))
+
+    def test_restore_only_takes_back_the_users_own_unexpired_trash(self):
+        foreign = self.add_photo(self.make_user('bob'), b'bob')
+        Photo.all_objects.filter(pk__in=[foreign.pk, self.photos[0].pk, self.photos[1].pk]).trash()
+        expired = timezone.now() - timedelta(days=settings.TRASH_RETENTION_DAYS + 1)
+        Photo.all_objects.filter(pk=self.photos[1].pk).update(deleted_at=expired)
+        self.client.post('/trash/restore/', {'photo_ids': [foreign.pk, self.photos[0].pk, self.photos[1].pk]})
+        self.assertEqual(list(Photo.all_objects.trashed().order_by('pk').values_list('pk', flat=True)), sorted([foreign.pk, self.photos[1].pk]))
+
+    def test_purge_removes_only_expired_trash(self):
+        Photo.objects.filter(pk__in=[self.photos[0].pk, self.photos[1].pk]).trash()
+        expired = timezone.now() - timedelta(days=settings.TRASH_RETENTION_DAYS + 1)
+        Photo.all_objects.filter(pk=self.photos[0].pk).update(deleted_at=expired)
+        self.assertEqual(trash_media.purge_expired(), 1)
+        self.assertFalse(Photo.all_objects.filter(pk=self.photos[0].pk).exists())
+        self.assertTrue(Photo.all_objects.filter(pk=self.photos[1].pk).exists())
+        self.assertEqual(StorageCleanupTask.objects.filter(storage_name=self.photos[0].image.name).count(), 1)
+
+        self.client.post('/trash/empty/')
+        self.assertEqual(trash_media.purge_expired(), 1)
+        self.assertEqual(list(Photo.all_objects.values_list('pk', flat=True)), [self.photos[2].pk])
+
+
+class UploadOrderTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+
+    def test_new_uploads_go_first_without_ties(self):
+        photos = [self.add_photo(self.user, b'photo %d' % i) for i in range(3)]
+        photos.append(instant_upload(self.user, 'photo', photos[0].content_hash, photos[0].file_size))
+        orders = [photo.order for photo in photos]
+        self.assertEqual(len(set(orders)), len(orders))
+        self.assertEqual(list(Photo.objects.order_by(*MEDIA_ORDERING)), photos[::-1])
+        # Each user's library is its own scope
+        self.assertEqual(self.add_photo(self.make_user('bob'), b'bob').order, 0)
+        self.assertEqual(self.add_video(self.user, b'video').order, 0)
+
+    def test_uploads_are_appended_to_owned_albums(self):
+        trip = Album.objects.create(user=self.user, name='Trip')
+        other = Album.objects.create(user=self.make_user('bob'), name='Not mine')
+        self.client.force_login(self.user)
+        for i in range(2):
+            image = ContentFile(png_bytes(color=(i, 0, 0)), name=f'p{i}.png')
+            image.content_type = 'image/png'
+            self.client.post('/upload/photo/', {
+                'multi_upload': '1', 'title': 't', 'albums': [trip.pk], 'images': [image],
+            })
+        items = list(trip.album_photos.order_by('order'))
+        self.assertEqual([item.photo.title for item in items], ['t', 't'])
+        self.assertLess(items[0].photo_id, items[1].photo_id)
+        self.assertEqual(items[1].order - items[0].order, ORDER_GAP)
+        trip.refresh_from_db()
+        self.assertEqual(trip.photo_count, 2)
+
+        photo = self.add_photo(self.user, b'direct')
+        add_to_albums(photo, [other.pk])
+        self.assertFalse(other.album_photos.exists())
+
+
+class ApplyOrderTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.photos = [self.add_photo(self.user, b'photo %d' % i, title=f'p{i}') for i in range(6)]
+        for photo, order in zip(self.photos, [0, 1, 2, 3, 10 * ORDER_GAP, 11 * ORDER_GAP]):
+            Photo.objects.filter(pk=photo.pk).update(order=order)
+
+    def titles(self):
+        return list(Photo.objects.order_by(*MEDIA_ORDERING).values_list('title', flat=True))
+
+    def test_crowded_neighbours_only_shift_the_rows_that_follow(self):
+        a, b, c, d, e, f = self.photos
+        scope = Photo.objects.filter(user=self.user)
+        apply_order(scope, MEDIA_ORDERING, [d.pk, b.pk])
+        self.assertEqual(self.titles(), ['p0', 'p3', 'p1', 'p2', 'p4', 'p5'])
+        orders = dict(Photo.objects.values_list('title', 'order'))
+        self.assertEqual((orders['p0'], orders['p4'], orders['p5']), (0, 10 * ORDER_GAP, 11 * ORDER_GAP))
+        self.assertEqual(len(set(orders.values())), len(orders))
+
+    def test_batch_view(self):
+        a, b, c, d, e, f = self.photos
+        self.client.force_login(self.user)
+        response = self.client.post('/photos/reorder/batch/', {'ids': [f.pk, e.pk]})
+        self.assertEqual([item['id'] for item in response.json()['positions']], [f.pk, e.pk])
+        self.assertEqual(self.titles(), ['p0', 'p1', 'p2', 'p3', 'p5', 'p4'])
+
+        other = self.add_photo(self.make_user('bob'), b'bob')
+        response = self.client.post('/photos/reorder/batch/', {'ids': [a.pk, other.pk]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_album_batch_view(self):
+        album = Album.objects.create(user=self.user, name='Trip')
+        for photo in self.photos[:3]:
+            add_to_albums(photo, [album.pk])
+        self.client.force_login(self.user)
+        ids = [self.photos[2].pk, self.photos[0].pk, self.photos[1].pk]
+        response = self.client.post(f'/albums/{album.pk}/reorder/batch/', {'type': 'photo', 'ids': ids})
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(list(album.album_photos.order_by('order').values_list('photo_id', flat=True)), ids)
+
+
+class ReorderViewTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.client.force_login(self.user)
+        self.photos = [self.add_photo(self.user, b'photo %d' % i, title=f'p{i}') for i in range(4)]
+        self.album = Album.objects.create(user=self.user, name='Trip')
+        for photo in self.photos:
+            add_to_albums(photo, [self.album.pk])
+
+    def titles(self):
+        return list(Photo.objects.filter(user=self.user).order_by(*MEDIA_ORDERING).values_list('title', flat=True))
+
+    def album_titles(self):
+        return list(self.album.album_photos.order_by('order', 'id').values_list('photo__title', flat=True))
+
+    def test_single_moves_between_neighbours(self):
+        p0, p1, p2, p3 = self.photos
+        self.assertEqual(self.titles(), ['p3', 'p2', 'p1', 'p0'])
+        response = self.client.post('/photos/reorder/', {'id': p0.pk, 'prev_id': p3.pk, 'next_id': p2.pk})
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(self.titles(), ['p3', 'p0', 'p2', 'p1'])
+
+        response = self.client.post(f'/albums/{self.album.pk}/reorder/', {'type': 'photo', 'id': p3.pk, 'prev_id': p0.pk, 'next_id': p1.pk})
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(self.album_titles(), ['p0', 'p3', 'p1', 'p2'])
+
+        foreign = self.add_photo(self.make_user('bob'), b'bob')
+        response = self.client.post('/photos/reorder/', {'id': p1.pk, 'prev_id': foreign.pk})
+        self.assertFalse(response.json()['success'])
+        self.assertEqual(self.titles(), ['p3', 'p0', 'p2', 'p1'])
+
+    def test_batches_reject_ids_outside_the_scope(self):
+        p0, p1, p2, p3 = self.photos
+        foreign = self.add_photo(self.make_user('bob'), b'bob')
+        outside = self.add_photo(self.user, b'not in the album')
+        album_url = f'/albums/{self.album.pk}/reorder/batch/'
+        rejected = [
+            ('/photos/reorder/batch/', {'ids': [p0.pk, foreign.pk]}),
+            ('/photos/reorder/batch/', {'ids': [p0.pk, p0.pk]}),
+            ('/photos/reorder/batch/', {'ids': [p0.pk, 'x']}),
+            (album_url, {'type': 'photo', 'ids': [p0.pk, outside.pk]}),
+            (album_url, {'type': 'photo', 'ids': [foreign.pk]}),
+            (album_url, {'type': 'album', 'ids': [p0.pk]}),
+        ]
+        titles, album_titles = self.titles(), self.album_titles()
+        for url, data in rejected:
+            response = self.client.post(url, data)
+            self.assertEqual(response.status_code, 400, data)
+            self.assertFalse(response.json()['success'])
+        self.assertEqual((self.titles(), self.album_titles()), (titles, album_titles))
+
+        video = self.add_video(self.make_user('carol'), b'carol')
+        self.assertEqual(self.client.post('/videos/reorder/batch/', {'ids': [video.pk]}).status_code, 400)
+
+    def test_reorder_refreshes_the_listing(self):
+        p0, p1, p2, p3 = self.photos
+        etag = self.client.get('/photos/ajax/?cursor=')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/photos/reorder/batch/', {'ids': [p0.pk, p3.pk]})
+        response = self.client.get('/photos/ajax/?cursor=', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([photo['title'] for photo in response.json()['photos']], ['p0', 'p3', 'p2', 'p1'])
+
+
+class AlbumSyncTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.album = Album.objects.create(user=self.user, name='Trip')
+        self.photos = [self.add_photo(self.user, b'photo %d' % i, title=f'p{i}') for i in range(6)]
+
+    def ids(self, *indexes):
+        return [self.photos[i].pk for i in indexes]
+
+    def contents(self):
+        return list(AlbumPhoto.objects.filter(album=self.album).order_by('order').values_list('photo_id', flat=True))
+
+    def test_sync_applies_only_the_difference(self):
+        self.assertEqual(sync_album_items(self.album, 'photo', self.ids(0, 1, 2)), (3, 0, 0))
+        kept = AlbumPhoto.objects.get(album=self.album, photo=self.photos[2]).pk
+        # New items slot in between kept ones without moving them
+        self.assertEqual(sync_album_items(self.album, 'photo', self.ids(0, 3, 2, 4)), (2, 1, 0))
+        self.assertEqual(self.contents(), self.ids(0, 3, 2, 4))
+        self.assertEqual(AlbumPhoto.objects.get(album=self.album, photo=self.photos[2]).pk, kept)
+        # A new relative order repositions rows instead of recreating them
+        self.assertEqual(sync_album_items(self.album, 'photo', self.ids(4, 0, 3, 2)), (0, 0, 4))
+        self.assertEqual(self.contents(), self.ids(4, 0, 3, 2))
+        self.assertEqual(sync_album_items(self.album, 'photo', self.ids(4, 0, 3, 2)), (0, 0, 0))
+
+    def test_foreign_and_unknown_ids_are_ignored(self):
+        foreign = self.add_photo(self.make_user('bob'), b'bob')
+        sync_album_items(self.album, 'photo', [foreign.pk, self.photos[0].pk, 999999, self.photos[0].pk])
+        self.assertEqual(self.contents(), self.ids(0))
+
+    def test_query_count_does_not_grow_with_the_album(self):
+        def queries(ids):
+            with CaptureQueriesContext(connection) as captured:
+                sync_album_items(self.album, 'photo', ids)
+            return len(captured)
+
+        small = queries(self.ids(0))
+        AlbumPhoto.objects.filter(album=self.album).delete()
+        self.assertEqual(queries(self.ids(0, 1, 2, 3, 4, 5)), small)
+
+    def test_edit_contents_refreshes_the_album_page(self):
+        self.client.force_login(self.user)
+        url = f'/albums/{self.album.pk}/'
+        self.client.get(url)
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/albums/{self.album.pk}/edit-contents/', {'photo_ids': self.ids(1, 0)})
+        self.assertEqual(self.contents(), self.ids(1, 0))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'p1')
+
+
+class AlbumCounterTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.album = Album.objects.create(user=self.user, name='Trip')
+        self.photos = [self.add_photo(self.user, b'p' * (100 * i)) for i in range(1, 5)]
+        self.video = self.add_video(self.user, b'v' * 1000)
+
+    def counters(self):
+        self.album.refresh_from_db()
+        return self.album.photo_count, self.album.video_count, self.album.total_bytes
+
+    def assertCounters(self, photos, videos, size):
+        self.assertEqual(self.counters(), (photos, videos, size))
+        Album.rebuild_counters([self.album.pk])
+        self.assertEqual(self.counters(), (photos, videos, size))
+
+    def test_bulk_add_and_remove(self):
+        sync_album_items(self.album, 'photo', [photo.pk for photo in self.photos])
+        sync_album_items(self.album, 'video', [self.video.pk])
+        self.assertCounters(4, 1, 1000 + 1000)
+        sync_album_items(self.album, 'photo', [self.photos[0].pk, self.photos[3].pk])
+        self.assertCounters(2, 1, 100 + 400 + 1000)
+        AlbumPhoto.objects.filter(album=self.album).delete()
+        self.assertCounters(0, 1, 1000)
+        AlbumVideo.objects.get(album=self.album).delete()
+        self.assertCounters(0, 0, 0)
+
+    def test_trash_restore_and_delete(self):
+        sync_album_items(self.album, 'photo', [photo.pk for photo in self.photos])
+        Photo.objects.filter(pk__in=[self.photos[0].pk, self.photos[1].pk]).trash()
+        self.assertCounters(2, 0, 300 + 400)
+        # Trashed items are left alone by an edit and come back on restore
+        sync_album_items(self.album, 'photo', [self.photos[2].pk])
+        self.assertCounters(1, 0, 300)
+        Photo.all_objects.filter(pk=self.photos[0].pk).restore()
+        self.assertCounters(2, 0, 100 + 300)
+        Photo.objects.filter(pk=self.photos[2].pk).delete()
+        self.assertCounters(1, 0, 100)
+        trash_media.empty_trash(self.user)
+        self.assertCounters(1, 0, 100)
+
+
+class UnshareTests(TransactionTestCase):
+    """Runs in autocommit, where an on-commit callback outside a transaction fires at once"""
+
+    def test_cached_page_is_dropped_after_the_share_is_deactivated(self):
+        user = User.objects.create_user('alice', password='pw')
+        album = Album.objects.create(user=user, name='Trip')
+        self.client.force_login(user)
+        url = self.client.post(f'/albums/{album.pk}/share/').json()['share_url']
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        def delete_many(keys):
+            self.assertFalse(SharedAlbum.objects.filter(is_active=True).exists())
+            return original(keys)
+
+        original = cache.delete_many
+        with mock.patch.object(cache, 'delete_many', side_effect=delete_many) as deleted:
+            self.client.post(f'/albums/{album.pk}/unshare/')
+        deleted.assert_called_once()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class ShareCacheTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.client.force_login(self.user)
+
+    def test_unshare_drops_the_cached_page(self):
+        photo = self.add_photo(self.user, png_bytes(), name='p.png')
+        url = self.client.post(f'/photo/{photo.pk}/share/').json()['share_url']
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/photo/{photo.pk}/unshare/')
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_resharing_an_expired_album_replaces_the_cached_page(self):
+        album = Album.objects.create(user=self.user, name='Trip')
+        url = self.client.post(f'/albums/{album.pk}/share/').json()['share_url']
+        SharedAlbum.objects.update(expires_at=timezone.now() - timedelta(days=1))
+        self.assertTemplateUsed(self.client.get(url), 'storageapp/shared_expired.html')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(f'/albums/{album.pk}/share/').json()['share_url'], url)
+        self.assertTemplateUsed(self.client.get(url), 'storageapp/shared_album.html')
+
+
+class CacheVersionTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.other = self.make_user('bob')
+        self.album = Album.objects.create(user=self.user, name='Trip')
+        self.scopes = [media_scope(self.user.pk), album_scope(self.album.pk), notifications_scope(self.user.pk), media_scope(self.other.pk)]
+
+    def changed(self, write):
+        """Which of self.scopes `write` bumps once its transaction commits"""
+        before = cache_versions.get_versions(*self.scopes)
+        with self.captureOnCommitCallbacks(execute=True):
+            write()
+        after = cache_versions.get_versions(*self.scopes)
+        return [scope for scope, old, new in zip(self.scopes, before, after) if old != new]
+
+    def test_bumps_apply_on_commit_only(self):
+        scope = self.scopes[0]
+        version = cache_versions.get_versions(scope)
+        self.assertEqual(cache_versions.get_versions(scope), version)  # a new scope keeps its first version
+        with self.captureOnCommitCallbacks() as callbacks:
+            cache_versions.bump(scope)
+            self.assertEqual(cache_versions.get_versions(scope), version)
+            with self.assertRaises(ValueError), transaction.atomic():
+                cache_versions.bump(self.scopes[1])
+                raise ValueError
+        self.assertEqual(len(callbacks), 1)  # the rolled-back bump was dropped
+        callbacks[0]()
+        self.assertNotEqual(cache_versions.get_versions(scope), version)
+
+    def test_model_writes_bump_their_scopes(self):
+        media, album, notifications, other_media = self.scopes
+        photo = self.add_photo(self.user, b'photo')
+        self.assertEqual(self.changed(lambda: self.add_photo(self.user, b'another')), [media])
+        self.assertEqual(self.changed(lambda: Photo.objects.filter(pk=photo.pk).update(title='Renamed')), [media])
+        self.assertEqual(self.changed(lambda: add_to_albums(photo, [self.album.pk])), [album])
+        self.assertEqual(self.changed(lambda: Notification.objects.create(user=self.user, message='hi')), [notifications])
+        self.assertEqual(self.changed(lambda: Notification.objects.filter(user=self.user).update(is_read=True)), [notifications])
+        self.assertEqual(self.changed(lambda: Photo.objects.filter(user=self.other).update(title='x')), [])
+
+    def test_cached_values_are_rebuilt_after_a_bump(self):
+        build = mock.Mock(side_effect=['first', 'second'])
+        scopes = self.scopes[:1]
+        self.assertEqual(cache_versions.cached('test', scopes, build), 'first')
+        self.assertEqual(cache_versions.cached('test', scopes, build), 'first')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_photo(self.user, b'photo')
+        self.assertEqual(cache_versions.cached('test', scopes, build), 'second')
+        self.assertEqual(build.call_count, 2)
+
+    def test_keys_over_many_scopes_stay_short(self):
+        scopes = [album_scope(album_id) for album_id in range(100)]
+        self.assertLess(len(cache_versions.versioned_key('albums', *scopes)), 250)
+
+
+class ConditionalViewTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.client.force_login(self.user)
+        self.album = Album.objects.create(user=self.user, name='Trip')
+        self.url = f'/albums/{self.album.pk}/'
+
+    def etag(self, url):
+        self.client.get(url)  # the first page sets the CSRF cookie the ETag covers
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_unchanged_page_is_answered_with_304(self):
+        etag = self.etag(self.url)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_upload_changes_the_etag(self):
+        etag = self.etag('/photos/ajax/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_photo(self.user, b'new photo')
+        response = self.client.get('/photos/ajax/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_sharing_changes_the_etag(self):
+        etag = self.etag(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/albums/{self.album.pk}/share/')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '/shared/album/')
+
+    def test_queued_messages_are_rendered_instead_of_a_304(self):
+        etag = self.etag(self.url)
+        request = RequestFactory().get(self.url, HTTP_IF_NONE_MATCH=etag)
+        request.COOKIES = dict((name, morsel.value) for name, morsel in self.client.cookies.items())
+        request.user = self.user
+        request._messages = CookieStorage(request)
+        messages.success(request, 'Album saved')
+        response = views.album_detail(request, self.album.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Album saved')
+        self.assertFalse(response.has_header('ETag'))
+
+
+class OrphanCollectionTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+
+    def resource(self, public_id, age, tags=('media',)):
+        created_at = (timezone.now() - age).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return {'public_id': public_id, 'created_at': created_at, 'tags': list(tags)}
+
+    def test_cloudinary_files_are_aged_from_the_listing(self):
+        photo = self.add_photo(self.user, b'kept')
+        old = timedelta(days=30)
+        pages = [
+            {'resources': [
+                self.resource(photo.image.name, old),
+                self.resource('users/alice/photos/old', old),
+                self.resource('users/alice/photos/new', timedelta(minutes=5)),
+            ], 'next_cursor': 'page-2'},
+            {'resources': [
+                self.resource('users/alice/photos/older', old * 2),
+                self.resource('users/alice/photos/not-ours', old, tags=['static']),
+            ]},
+        ]
+        storage = CloudinaryMediaStorage(tag='media')
+        bloom, _ = build_reference_filter()
+        stats = {}
+        with mock.patch('cloudinary.api.resources', side_effect=pages) as listed, \
+                mock.patch('cloudinary.api.resource') as fetched:
+            orphans = list(find_orphans(storage, bloom, timezone.now() - timedelta(days=1), roots=['users'], stats=stats))
+        self.assertEqual(orphans, ['users/alice/photos/old', 'users/alice/photos/older'])
+        self.assertEqual((stats['scanned'], stats['recent'], stats['unknown_age']), (4, 1, 0))
+        self.assertEqual(listed.call_args_list[1].kwargs['next_cursor'], 'page-2')
+        fetched.assert_not_called()
+
+    def test_files_of_unknown_age_are_kept_and_reported(self):
+        name = default_storage.save('users/alice/photos/orphan.jpg', ContentFile(b'orphan'))
+        out, err = StringIO(), StringIO()
+        with mock.patch.object(FileSystemStorage, 'get_modified_time', side_effect=NotImplementedError):
+            call_command('collect_orphaned_files', stdout=out, stderr=err)
+        self.assertTrue(default_storage.exists(name))
+        self.assertIn('Deleted 0', out.getvalue())
+        self.assertRegex(err.getvalue(), r'Kept [1-9][0-9]* unreferenced file\(s\) whose age')
+
+
+class CloudinaryStreamingTests(MediaTestCase):
+    def response(self, data, status=200):
+        response = requests.Response()
+        response.status_code = status
+        response.raw = HTTPResponse(body=BytesIO(data), preload_content=False, status=status)
+        response.headers['Content-Length'] = str(len(data))
+        return response
+
+    def test_open_streams_the_body_as_it_is_read(self):
+        data = os.urandom(3 * 64 * 1024 + 17)
+        response = self.response(data)
+        storage = CloudinaryMediaStorage(tag='media')
+        with mock.patch('requests.get', return_value=response) as get, \
+                mock.patch.object(requests.Response, 'content', new_callable=mock.PropertyMock,
+                                  side_effect=AssertionError('read the whole body')):
+            source = storage.open('users/alice/videos/clip', 'rb')
+            self.assertEqual(source.size, len(data))
+            archive = b''.join(zipstream.stream_zip([zipstream.ZipEntry('clip.mp4', lambda: source)]))
+        self.assertTrue(get.call_args.kwargs['stream'])
+        self.assertTrue(response.raw.closed)
+        with zipfile.ZipFile(BytesIO(archive)) as zf:
+            self.assertEqual(zf.read('clip.mp4'), data)
+
+    def test_missing_file_raises_and_releases_the_connection(self):
+        response = self.response(b'not found', status=404)
+        with mock.patch('requests.get', return_value=response):
+            with self.assertRaises(FileNotFoundError):
+                CloudinaryMediaStorage(tag='media').open('users/alice/videos/gone', 'rb')
+        self.assertTrue(response.raw.closed)
+
+
+class ReadThroughCacheTests(MediaTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(dir=MEDIA_ROOT)
+        self.backend_root = os.path.join(self.root, 'backend')
+
+    def make_storage(self, **options):
+        storage = ReadThroughCacheStorage(
+            'django.core.files.storage.FileSystemStorage', os.path.join(self.root, 'cache'),
+            backend_options={'location': self.backend_root}, **{'max_bytes': 10 ** 6, **options},
+        )
+        self.backend_opens = mock.patch.object(storage.backend, 'open', wraps=storage.backend.open).start()
+        self.addCleanup(mock.patch.stopall)
+        return storage
+
+    def put(self, name, data):
+        path = os.path.join(self.backend_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read(self, storage, name):
+        with storage.open(name, 'rb') as f:
+            return f.read()
+
+    def test_second_open_is_served_from_disk(self):
+        self.put('a.jpg', b'original')
+        storage = self.make_storage()
+        with mock.patch.object(storage.backend, 'size', wraps=storage.backend.size) as sized:
+            self.assertEqual(self.read(storage, 'a.jpg'), b'original')
+            self.assertEqual(self.read(storage, 'a.jpg'), b'original')
+        self.assertEqual(self.backend_opens.call_count, 1)
+        sized.assert_not_called()  # just filled, so within validate_ttl
+
+    def test_size_mismatch_refetches_and_keeps_the_accounting(self):
+        self.put('a.jpg', b'original')
+        storage = self.make_storage(validate_ttl=0)
+        self.read(storage, 'a.jpg')
+        self.put('a.jpg', b'replaced, and longer')
+        self.assertEqual(self.read(storage, 'a.jpg'), b'replaced, and longer')
+        self.assertEqual(self.backend_opens.call_count, 2)
+        self.assertEqual(storage._used, sum(size for _, size, _ in storage._entries()))
+
+    def test_least_recently_used_files_are_evicted_first(self):
+        for name in 'abc':
+            self.put(f'{name}.jpg', name.encode() * 100)
+        storage = self.make_storage(max_bytes=250)
+        self.read(storage, 'a.jpg')
+        self.read(storage, 'b.jpg')
+        os.utime(storage._cache_path('a.jpg'), (1000, 1000))
+        os.utime(storage._cache_path('b.jpg'), (2000, 2000))
+        self.read(storage, 'a.jpg')  # a hit makes a the most recently used
+        self.read(storage, 'c.jpg')
+        cached = {name for name in 'abc' if os.path.exists(storage._cache_path(f'{name}.jpg'))}
+        self.assertEqual(cached, {'a', 'c'})
+        self.assertEqual(storage._used, 200)
+
+    def test_concurrent_opens_share_one_download(self):
+        self.put('a.jpg', b'x' * 1000)
+        storage = self.make_storage()
+
+        def slow_open(*args, **kwargs):
+            time.sleep(0.1)
+            return FileSystemStorage.open(storage.backend, *args, **kwargs)
+
+        self.backend_opens.side_effect = slow_open
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            contents = list(executor.map(lambda _: self.read(storage, 'a.jpg'), range(4)))
+        self.assertEqual(contents, [b'x' * 1000] * 4)
+        self.assertEqual(self.backend_opens.call_count, 1)
+
+
+class StorageHistoryTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.now = timezone.now()
+
+    def days_ago(self, days):
+        return self.now - timedelta(days=days)
+
+    def date(self, days_ago):
+        return timezone.localdate(self.days_ago(days_ago))
+
+    def backdate(self, media, days, delta):
+        """Move `media`'s upload, and the event logging `delta`, `days` into the past"""
+        type(media).all_objects.filter(pk=media.pk).update(uploaded_at=self.days_ago(days))
+        StorageEvent.objects.filter(user=self.user, delta=delta).update(created_at=self.days_ago(days))
+
+    def history(self):
+        return dict(StorageHistory.objects.filter(user=self.user).values_list('date', 'storage_used'))
+
+    def test_events_and_pre_log_uploads(self):
+        # Uploaded before the event log existed, so there is no event for it
+        old = self.add_photo(self.user, b'o' * 100)
+        StorageEvent.objects.filter(user=self.user).delete()
+        Photo.all_objects.filter(pk=old.pk).update(uploaded_at=self.days_ago(10))
+        self.backdate(self.add_photo(self.user, b'n' * 50), 3, 50)
+        removed = self.add_video(self.user, b'r' * 20)
+        self.backdate(removed, 2, 20)
+        Video.objects.filter(pk=removed.pk).delete()
+        StorageEvent.objects.filter(user=self.user, delta=-20).update(created_at=self.days_ago(1))
+        self.assertEqual(self.storage_used(self.user), 150)
+
+        start, end = self.date(12), self.date(0)
+        with mock.patch('storageapp.storage_history.log_started_at', return_value=self.days_ago(5)):
+            self.assertEqual(rebuild_history(start, end), 13)
+            rebuild_history(start, end)  # upserts the same rows
+        expected = {self.date(days): 0 for days in (12, 11)}
+        expected.update({self.date(days): 100 for days in range(10, 3, -1)})
+        expected.update({self.date(3): 150, self.date(2): 170, self.date(1): 150, self.date(0): 150})
+        self.assertEqual(self.history(), expected)
+
+    def test_series_starts_at_the_current_usage_without_events(self):
+        self.add_photo(self.user, b'x' * 70)
+        StorageEvent.objects.all().delete()
+        with mock.patch('storageapp.storage_history.log_started_at', return_value=None):
+            rebuild_history(self.date(2), self.date(0))
+        self.assertEqual(set(self.history().values()), {70})
+
+    def test_reconciling_logs_the_correction(self):
+        self.add_photo(self.user, b'x' * 70)
+        UserProfile.objects.filter(user=self.user).update(storage_used=500)  # drifted
+        UserProfile.recalculate_storage_used(user_ids=[self.user.pk])
+        UserProfile.recalculate_storage_used(user_ids=[self.user.pk])  # nothing left to correct
+        self.assertEqual(list(StorageEvent.objects.filter(user=self.user).order_by('id').values_list('delta', flat=True)), [70, -430])
+        self.assertEqual(self.storage_used(self.user), 70)
+
+
+class StorageAnalyticsTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.today = timezone.localdate()
+        self.first = self.today - timedelta(days=999)
+        # Usage on each day is the number of days since the first
+        StorageHistory.objects.bulk_create([
+            StorageHistory(user=self.user, date=self.first + timedelta(days=n), storage_used=n * 1024 * 1024)
+            for n in range(1000)
+        ])
+
+    def used_on(self, day):
+        return (day - self.first).days * 1024 * 1024
+
+    def rollups(self, resolution):
+        return dict(StorageRollup.objects.filter(user=self.user, resolution=resolution).values_list('period_start', 'storage_used'))
+
+    def test_rollups_hold_the_usage_at_the_end_of_each_period(self):
+        written, pruned = analytics.compact_history()
+        weeks, months = self.rollups(StorageRollup.WEEK), self.rollups(StorageRollup.MONTH)
+        self.assertEqual((written, pruned), (len(weeks) + len(months), 0))
+        for start, used in weeks.items():
+            self.assertEqual(start.weekday(), 0)
+            self.assertEqual(used, self.used_on(min(start + timedelta(days=6), self.today)))
+        self.assertEqual(months[self.today.replace(day=1)], self.used_on(self.today))
+        self.assertEqual(analytics.compact_history(), (written, 0))  # upserts the same rows
+        self.assertEqual(StorageRollup.objects.count(), written)
+
+    def test_each_range_is_drawn_within_max_points(self):
+        analytics.compact_history()
+        for range_key, resolution in (('30d', analytics.DAY), ('1y', analytics.DAY), ('all', StorageRollup.WEEK)):
+            series = analytics.storage_series(self.user, range_key, self.today)
+            self.assertEqual(series['resolution'], resolution, range_key)
+            self.assertLessEqual(len(series['points']), analytics.MAX_POINTS)
+            self.assertEqual(series['points'][-1]['storage_mb'], 999)  # today's usage, in MB
+        # Month rollups reach back to the start of the first recorded month
+        self.assertEqual(analytics.storage_series(self.user, 'all', self.today)['start'], self.first.replace(day=1).isoformat())
+        self.assertEqual(analytics.resolution_for(self.today - timedelta(days=10 * 365), self.today), StorageRollup.MONTH)
+
+    def test_pruning_keeps_the_daily_rows_charts_need(self):
+        with self.assertRaises(CommandError):
+            call_command('compact_storage_history', keep_days=30, stdout=StringIO())
+        call_command('compact_storage_history', days=0, keep_days=analytics.MIN_DAILY_RETENTION_DAYS, stdout=StringIO())
+        kept = StorageHistory.objects.filter(user=self.user)
+        self.assertEqual(kept.count(), analytics.MIN_DAILY_RETENTION_DAYS + 1)
+        self.assertEqual(analytics.first_recorded_day(self.user), self.first.replace(day=1))
+
+    def test_series_endpoint_is_refreshed_by_new_history(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/analytics/series/?range=30d')
+        self.assertEqual(response.json()['points'][-1]['storage_mb'], 999)
+        self.assertEqual(self.client.get('/analytics/series/?range=30d', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            StorageHistory.objects.filter(user=self.user, date=self.today).update(storage_used=2000 * 1024 * 1024)
+        response = self.client.get('/analytics/series/?range=30d', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['points'][-1]['storage_mb'], 2000)
+
+
+class StorageBreakdownTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        self.photo = self.add_photo(self.user, png_bytes(), name='p.png')
+        derivatives.generate_photo_derivatives(self.photo)
+        self.add_video(self.user, b'v' * 250)
+        trashed = self.add_photo(self.user, b't' * 40)
+        Photo.objects.filter(pk=trashed.pk).trash()
+        self.album = Album.objects.create(user=self.user, name='Trip')
+        add_to_albums(self.photo, [self.album.pk])
+        self.add_photo(self.make_user('bob'), b'bob' * 10)
+
+    def test_totals_match_the_ledger(self):
+        breakdown = storage_breakdown.compute_breakdown(self.user)
+        types = breakdown['types']
+        self.assertEqual((types['photos']['count'], types['videos']['count'], types['trash']['count']), (1, 1, 1))
+        charged = types['photos']['bytes'] + types['videos']['bytes'] + types['trash']['bytes']
+        self.assertEqual(charged, self.storage_used(self.user))
+        thumbnails = sum(self.photo.derivatives.values_list('file_size', flat=True))
+        self.assertEqual(types['thumbnails'], {'count': self.photo.derivatives.count(), 'bytes': thumbnails})
+        self.assertEqual(breakdown['total_bytes'], charged + thumbnails)
+        self.assertEqual(sum(sum(v for k, v in month.items() if k.endswith('_bytes')) for month in breakdown['months']), breakdown['total_bytes'])
+        self.assertEqual([(album['name'], album['total_bytes']) for album in breakdown['albums']], [('Trip', self.photo.file_size)])
+
+    def test_cached_until_media_or_albums_change(self):
+        with mock.patch.object(storage_breakdown, 'compute_breakdown', wraps=storage_breakdown.compute_breakdown) as computed:
+            storage_breakdown.storage_breakdown(self.user)
+            storage_breakdown.storage_breakdown(self.user)
+            self.assertEqual(computed.call_count, 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.add_video(self.user, b'w' * 10)
+            self.assertEqual(storage_breakdown.storage_breakdown(self.user)['types']['videos']['count'], 2)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.album.name = 'Holiday'
+                self.album.save()
+            self.assertEqual(storage_breakdown.storage_breakdown(self.user)['albums'][0]['name'], 'Holiday')
+        self.assertEqual(computed.call_count, 3)
+
+    def test_only_staff_can_see_another_users_breakdown(self):
+        bob = User.objects.get(username='bob')
+        self.client.force_login(bob)
+        self.assertEqual(self.client.get(f'/analytics/breakdown/?user={self.user.pk}').context['subject'], bob)
+        staff = User.objects.create_user('staff', password='pw', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(f'/analytics/breakdown/?user={self.user.pk}').context['subject'], self.user)
+        self.assertEqual(self.client.get('/analytics/breakdown/?user=999999').status_code, 404)
+
+
+class ForecastTests(MediaTestCase):
+    x = np.arange(30, dtype=np.float64)
+
+    def profile(self, user, used, limit=10 ** 9):
+        UserProfile.objects.update_or_create(user=user, defaults={'storage_used': used, 'storage_limit': limit})
+
+    def test_fit_trend_recovers_known_slopes(self):
+        missing = 1e6 - 50 * self.x
+        missing[::3] = np.nan
+        usage = np.vstack([100 * self.x + 1e4, missing, np.full(30, 7.0)])
+        slope, intercept = fit_trend(usage)
+        np.testing.assert_allclose(slope, [100, -50, 0], atol=1e-6)
+        np.testing.assert_allclose(intercept, [1e4, 1e6, 7], rtol=1e-9)
+
+    def test_fit_trend_resists_a_single_bulk_upload(self):
+        usage = (100 * self.x + 1e4)[None, :].copy()
+        usage[0, 10] += 1e6
+        self.assertLess(fit_trend(usage, iterations=0)[0][0], 0)  # plain least squares is thrown off
+        self.assertAlmostEqual(fit_trend(usage)[0][0], 100, delta=15)
+
+    def test_load_usage_streams_history_into_the_matrix(self):
+        alice, bob, carol = self.make_user('alice'), self.make_user('bob'), self.make_user('carol')
+        for user, used in ((alice, 40), (bob, 6), (carol, 1)):
+            self.profile(user, used)
+        today = date(2024, 3, 31)
+        StorageHistory.objects.bulk_create([
+            StorageHistory(user=alice, date=date(2024, 3, 26), storage_used=1),  # before the window
+            StorageHistory(user=alice, date=date(2024, 3, 27), storage_used=10),
+            StorageHistory(user=alice, date=date(2024, 3, 29), storage_used=30),
+            StorageHistory(user=alice, date=today, storage_used=99),  # today comes from the profile
+            StorageHistory(user=bob, date=date(2024, 3, 30), storage_used=5),
+            StorageHistory(user=carol, date=date(2024, 3, 30), storage_used=2),
+        ])
+        with mock.patch('storageapp.forecast.HISTORY_FETCH_SIZE', 2):
+            ids, usage, limits = load_usage(user_ids=[alice.pk, bob.pk], days=5, today=today)
+        self.assertEqual(list(ids), [alice.pk, bob.pk])
+        nan = np.nan
+        np.testing.assert_array_equal(usage, [[10, nan, 30, nan, 40], [nan, nan, nan, 5, 6]])
+        np.testing.assert_array_equal(limits, [10 ** 9, 10 ** 9])
+
+    def test_forecast_for_user(self):
+        user = self.make_user()
+        today = date(2024, 3, 31)
+        StorageHistory.objects.bulk_create([
+            StorageHistory(user=user, date=today - timedelta(days=29 - day), storage_used=1000 * day)
+            for day in range(29)
+        ])
+        self.profile(user, 29000, limit=100000)
+        forecast = forecast_for_user(user, today=today)
+        self.assertAlmostEqual(forecast['bytes_per_day'], 1000)
+        self.assertAlmostEqual(forecast['days_left'], 71)
+        self.assertEqual(forecast['full_on'], today + timedelta(days=71))
+        self.assertIsNone(forecast_for_user(self.make_user('new'), today=today))
+
+
+class QuotaTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        UserProfile.objects.update_or_create(user=self.user, defaults={'storage_used': 600, 'storage_limit': 1000})
+
+    def profile(self):
+        return UserProfile.objects.get(user=self.user)
+
+    def test_reservations_stop_at_the_limit(self):
+        held = [quota.reserve(self.user.pk, 150), quota.reserve(self.user.pk, 250)]
+        with self.assertRaises(quota.QuotaExceeded):
+            quota.reserve(self.user.pk, 1)
+        self.assertEqual(self.profile().storage_reserved, 400)
+        self.assertTrue(quota.release(held[0]))
+        self.assertFalse(quota.release(held[0]))  # never given back twice
+        self.assertEqual(self.profile().storage_reserved, 250)
+        with self.assertRaises(ValueError):
+            quota.reserve(self.user.pk, -1)
+
+    def test_reservation_is_released_however_the_upload_ends(self):
+        with self.assertRaises(OSError):
+            with quota.reservation(self.user.pk, 400):
+                self.assertEqual(self.profile().storage_reserved, 400)
+                raise OSError('storage down')
+        self.assertEqual(self.profile().storage_reserved, 0)
+        self.assertFalse(StorageReservation.objects.exists())
+
+    def test_expired_reservations_are_reclaimed(self):
+        quota.reserve(self.user.pk, 100, expires_at=timezone.now() - timedelta(minutes=1))
+        quota.reserve(self.user.pk, 200)
+        self.assertEqual(quota.release_expired_reservations(), 1)
+        self.assertEqual(self.profile().storage_reserved, 200)
+
+    def test_upload_view_refuses_what_reservations_leave_no_room_for(self):
+        quota.reserve(self.user.pk, 350)
+        self.client.force_login(self.user)
+        image = ContentFile(png_bytes(), name='big.png')
+        image.content_type = 'image/png'
+        self.client.post('/upload/photo/', {'multi_upload': '1', 'title': 't', 'images': [image]})
+        self.assertFalse(Photo.objects.exists())
+        self.assertEqual(self.profile().storage_reserved, 350)
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class ConcurrentQuotaTests(TransactionTestCase):
+    """Real parallel connections; SQLite's shared in-memory test database cannot take concurrent writers"""
+
+    def test_parallel_reservations_never_exceed_the_limit(self):
+        user = User.objects.create_user('alice', password='pw')
+        UserProfile.objects.update_or_create(user=user, defaults={'storage_used': 0, 'storage_limit': 1000})
+
+        def upload(_):
+            try:
+                quota.reserve(user.pk, 100)
+                return True
+            except quota.QuotaExceeded:
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(upload, range(25)))  # re-raises anything else a thread hit
+        self.assertEqual(results.count(True), 10)
+        self.assertEqual(UserProfile.objects.get(user=user).storage_reserved, 1000)
+        self.assertEqual(StorageReservation.objects.count(), 10)
+
+
+class AdminLedgerTests(MediaTestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        UserProfile.objects.update_or_create(user=self.user, defaults={'storage_used': 1000, 'storage_reserved': 300})
+        admin = User.objects.create_superuser('admin', password='pw')
+        self.client.force_login(admin)
+
+    def profile_updates(self, queries):
+        return [q['sql'] for q in queries if q['sql'].startswith('UPDATE') and 'userprofile' in q['sql']]
+
+    def test_approving_an_upgrade_leaves_the_ledger_alone(self):
+        upgrade = StorageUpgradeRequest.objects.create(user=self.user)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post('/admin/storageapp/storageupgraderequest/', {
+                'action': 'approve_request', '_selected_action': [upgrade.pk],
+            })
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(profile.storage_limit, EXTRA_STORAGE_LIMIT)
+        self.assertTrue(profile.has_paid_for_extra_storage)
+        self.assertEqual((profile.storage_used, profile.storage_reserved), (1000, 300))
+        updates = self.profile_updates(queries.captured_queries)
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('storage_used', updates[0])
+        self.assertNotIn('storage_reserved', updates[0])
+
+    def test_profile_form_saves_only_the_edited_fields(self):
+        profile = UserProfile.objects.get(user=self.user)
+        url = f'/admin/storageapp/userprofile/{profile.pk}/change/'
+        self.assertNotIn('storage_reserved', self.client.get(url).context['adminform'].form.fields)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url, {
+                'user': self.user.pk, 'storage_limit': profile.storage_limit, 'phone_number': '555-0100',
+                'gmail': '', 'storage_used': 0, 'storage_reserved': 0,
+            })
+        profile.refresh_from_db()
+        self.assertEqual(profile.phone_number, '555-0100')
+        self.assertEqual((profile.storage_used, profile.storage_reserved), (1000, 300))
+        updates = self.profile_updates(queries.captured_queries)
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('storage_used', updates[0])
@@ -0,0 +1,57 @@
+"""Trash for deleted photos and videos.
+
+Deleting media only sets ``deleted_at`` (MediaQuerySet.trash), which hides
+it from every listing through the default manager while keeping its files,
+album memberships and storage charge. It can be restored for
+``settings.TRASH_RETENTION_DAYS``; after that, or once the user empties the
+trash, ``purge_trash`` deletes it for good in bounded batches, releasing
+storage and queueing the files for removal (see storage_cleanup).
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Photo, Video
+
+PURGE_BATCH_SIZE = 500
+
+
+def trash_cutoff(now=None):
+    """Media trashed before this moment has expired and is due for purging"""
+    return (now or timezone.now()) - timedelta(days=settings.TRASH_RETENTION_DAYS)
+
+
+def trashed_media(model, user):
+    """`user`'s restorable trash for `model`, most recently deleted first"""
+    return model.all_objects.filter(user=user, deleted_at__gte=trash_cutoff()).order_by('-deleted_at', '-id')
+
+
+def empty_trash(user):
+    """Expire everything in `user`'s trash at once; purge_trash then removes it.
+
+    Returns the number of items emptied.
+    """
+    cutoff = trash_cutoff()
+    emptied = 0
+    for model in (Photo, Video):
+        trash = model.all_objects.filter(user=user, deleted_at__gte=cutoff)
+        emptied += trash.update(deleted_at=cutoff - timedelta(seconds=1))
+    return emptied
+
+
+def purge_expired(batch_size=PURGE_BATCH_SIZE):
+    """Delete expired trash for good, `batch_size` rows per transaction; returns the number purged"""
+    cutoff = trash_cutoff()
+    purged = 0
+    for model in (Photo, Video):
+        expired = model.all_objects.filter(deleted_at__lt=cutoff).order_by('deleted_at', 'id')
+        while True:
+            with transaction.atomic():
+                ids = list(expired.select_for_update(skip_locked=True).values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                model.all_objects.filter(id__in=ids).delete()
+            purged += len(ids)
+    return purged
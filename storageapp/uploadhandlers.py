@@ -0,0 +1,40 @@
+"""Upload handlers that SHA-256 the file while the request body streams in.
+
+The digest is attached to the resulting UploadedFile as ``sha256`` so the
+deduplication layer never has to read the bytes a second time.
+"""
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class HashingMemoryFileUploadHandler(MemoryFileUploadHandler):
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.activated:
+            self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.sha256 = self.sha256.hexdigest()
+        return uploaded_file
+
+
+class HashingTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        uploaded_file.sha256 = self.sha256.hexdigest()
+        return uploaded_file
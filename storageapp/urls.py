@@ -12,6 +12,11 @@ urlpatterns = [
     path('videos/delete/', views.delete_videos, name='delete_videos'),
     path('upload/photo/', views.upload_photo, name='upload_photo'),
     path('upload/video/', views.upload_video, name='upload_video'),
+    path('upload/preflight/', views.upload_preflight, name='upload_preflight'),
+    path('upload/video/sessions/', views.upload_session_create, name='upload_session_create'),
+    path('upload/video/sessions/<uuid:session_id>/', views.upload_session_status, name='upload_session_status'),
+    path('upload/video/sessions/<uuid:session_id>/chunk/', views.upload_session_chunk, name='upload_session_chunk'),
+    path('upload/video/sessions/<uuid:session_id>/finalize/', views.upload_session_finalize, name='upload_session_finalize'),
     path('photo/<int:photo_id>/', views.photo_detail, name='photo_detail'),
     path('photo/<int:photo_id>/delete/', views.delete_photo, name='delete_photo'),
     path('photo/<int:photo_id>/share/', views.share_photo, name='share_photo'),
@@ -30,6 +35,9 @@ urlpatterns = [
     path('photos/delete/', views.delete_photos, name='delete_photos'),
     path('photos/download/', views.download_photos, name='download_photos'),
     path('videos/download/', views.download_videos, name='download_videos'),
+    path('trash/', views.trash, name='trash'),
+    path('trash/restore/', views.restore_media, name='restore_media'),
+    path('trash/empty/', views.empty_trash, name='empty_trash'),
     path('albums/', views.album_list, name='album_list'),
     path('albums/create/', views.album_create, name='album_create'),
     path('albums/<int:album_id>/', views.album_detail, name='album_detail'),
@@ -37,10 +45,15 @@ urlpatterns = [
     path('albums/<int:album_id>/delete/', views.album_delete, name='album_delete'),
     path('albums/<int:album_id>/edit-contents/', views.album_edit_contents, name='album_edit_contents'),
     path('albums/<int:album_id>/reorder/', views.reorder_album_media, name='reorder_album_media'),
+    path('albums/<int:album_id>/reorder/batch/', views.reorder_album_media_batch, name='reorder_album_media_batch'),
     path('photos/reorder/', views.reorder_photos, name='reorder_photos'),
+    path('photos/reorder/batch/', views.reorder_photos_batch, name='reorder_photos_batch'),
     path('videos/reorder/', views.reorder_videos, name='reorder_videos'),
+    path('videos/reorder/batch/', views.reorder_videos_batch, name='reorder_videos_batch'),
     path('albums/<int:album_id>/share/', views.share_album, name='share_album'),
     path('albums/<int:album_id>/unshare/', views.unshare_album, name='unshare_album'),
     path('shared/album/<uuid:token>/', views.shared_album, name='shared_album'),
     path('analytics/', views.storage_analytics, name='storage_analytics'),
+    path('analytics/series/', views.storage_analytics_series, name='storage_analytics_series'),
+    path('analytics/breakdown/', views.storage_breakdown, name='storage_breakdown'),
 ] 
\ No newline at end of file
@@ -1,24 +1,42 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import User
 from django.contrib import messages
-from django.http import HttpResponseForbidden, JsonResponse, HttpResponse,HttpResponseBase
+from django.http import Http404, HttpResponseForbidden, JsonResponse, HttpResponse,HttpResponseBase, StreamingHttpResponse
 from django.views.decorators.http import require_POST
 from django.core.paginator import Paginator
 from django.db.models import Sum, Q
-from .models import Photo, Video, UserProfile, Notification, StorageUpgradeRequest, Album, AlbumPhoto, AlbumVideo, SharedPhoto, SharedVideo, SharedAlbum, StorageHistory
+from .models import Photo, Video, UserProfile, Notification, StorageUpgradeRequest, Album, AlbumPhoto, AlbumVideo, SharedPhoto, SharedVideo, SharedAlbum, UploadSession
 from .forms import PhotoUploadForm, VideoUploadForm, CustomUserCreationForm, MultiPhotoUploadForm, MultiVideoUploadForm
+from .derivatives import generate_photo_derivatives
+from .pagination import InvalidCursor, keyset_paginate
+from .zipstream import ZipEntry, stream_zip
+from . import chunked_upload
+from .dedup import instant_upload, save_media
+from .quota import QuotaExceeded, reservation
+from . import search as media_search
+from . import ordering as media_ordering
+from .albums import add_to_albums, parse_ids, sync_album_items
+from .share_cache import invalidate_album_shares, invalidate_shares, resolve_share
+from .cache_versions import album_scope, bump, cached, conditional_view, media_scope, profile_scope, scope_validators
+from .dashboard import DashboardSummary
+from . import trash as trash_media
+from . import analytics as storage_analytics_data
+from .storage_breakdown import storage_breakdown as compute_storage_breakdown
+from .forecast import forecast_for_user
+import hashlib
 import os
-import io
-import zipfile
 from django.utils import timezone
 from datetime import datetime, timedelta
 from django import forms
-from django.db import models
+from django.db import models, transaction
 import json
 from PIL import Image
 from io import BytesIO
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
+from django.conf import settings
+from django.urls import reverse
 
 def home(request):
     """Home page with login/signup options"""
@@ -46,88 +64,104 @@ def signup(request):
 def dashboard(request):
     """User dashboard showing media overview"""
     user = request.user
-    profile, created = UserProfile.objects.get_or_create(user=user)
-
-    # Set correct storage limit based on payment status
-    if profile.has_paid_for_extra_storage:
-        profile.storage_limit = 107374182400  # 100GB
-    else:
-        profile.storage_limit = 5368709120  # 5GB
-    profile.save()
-    
-    # Get user's media counts
-    photo_count = user.photos.count()
-    video_count = user.videos.count()
+    # Counts, totals and profile in one query, cached until any of them changes
+    summary = DashboardSummary.for_user(user)
     
     # Get recent media
-    recent_photos = user.photos.all()[:6]
+    recent_photos = user.photos.prefetch_related('derivatives')[:6]
     recent_videos = user.videos.all()[:6]
     
-    # Calculate storage usage
-    total_photo_size = user.photos.aggregate(Sum('file_size'))['file_size__sum'] or 0
-    total_video_size = user.videos.aggregate(Sum('file_size'))['file_size__sum'] or 0
-    total_storage = total_photo_size + total_video_size
-    
-    # Update profile storage
-    profile.storage_used = total_storage
-    profile.save()
-    
-    unread_notifications = user.notifications.filter(is_read=False).count()
-    
     context = {
-        'profile': profile,
-        'photo_count': photo_count,
-        'video_count': video_count,
+        'profile': summary.profile,
+        'photo_count': summary.photo_count,
+        'video_count': summary.video_count,
         'recent_photos': recent_photos,
         'recent_videos': recent_videos,
-        'total_storage_mb': round(total_storage / (1024 * 1024), 2),
-        'unread_notifications': unread_notifications,
+        'total_storage_mb': summary.total_storage_mb,
+        'unread_notifications': summary.unread_notifications,
     }
     return render(request, 'storageapp/dashboard.html', context)
 
+# Sort keys for keyset pagination; each ends in a unique column so pages never overlap
+PHOTO_ORDERING = media_ordering.MEDIA_ORDERING
+VIDEO_ORDERINGS = {
+    'newest': ('-uploaded_at', '-id'),
+    'oldest': ('uploaded_at', 'id'),
+    'largest': ('-file_size', '-id'),
+    'smallest': ('file_size', 'id'),
+    'title_az': ('title', 'id'),
+    'title_za': ('-title', '-id'),
+}
+DEFAULT_VIDEO_ORDERING = media_ordering.MEDIA_ORDERING
+
+MAX_VIDEO_SIZE = 1000 * 1024 * 1024  # 1000MB
+
+def format_file_size(size):
+    """Human readable size used by the infinite scroll JSON"""
+    if size < 1024:
+        return f"{size} B"
+    elif size < 1024 * 1024:
+        return f"{size / 1024:.1f} KB"
+    elif size < 1024 * 1024 * 1024:
+        return f"{size / (1024 * 1024):.1f} MB"
+    return f"{size / (1024 * 1024 * 1024):.1f} GB"
+
 @login_required
 def photos(request):
     """User's photos page"""
-    photos_list = request.user.photos.all()
-    paginator = Paginator(photos_list, 12)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    photos_list = request.user.photos.prefetch_related('derivatives')
+    page_obj = keyset_paginate(photos_list, PHOTO_ORDERING, per_page=12)
     
     context = {
         'page_obj': page_obj,
         'photos': page_obj,
+        'next_cursor': page_obj.next_cursor,
     }
     return render(request, 'storageapp/photos.html', context)
 
+def _media_validators(request, *args, **kwargs):
+    """Listing responses only change when something in the user's library does"""
+    return scope_validators(media_scope(request.user.id))
+
 @login_required
+@conditional_view(_media_validators)
 def photos_ajax(request):
-    """AJAX endpoint for infinite scroll photos"""
-    photos_list = request.user.photos.all()
-    paginator = Paginator(photos_list, 12)
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
+    """AJAX endpoint for infinite scroll photos.
+
+    Pass ``cursor`` (the ``next_cursor`` of the previous response, empty for
+    the first page) for keyset pagination; ``page`` is still accepted.
+    """
+    photos_list = request.user.photos.prefetch_related('derivatives')
+    cursor_mode = 'cursor' in request.GET
+    if cursor_mode:
+        try:
+            page_obj = keyset_paginate(photos_list, PHOTO_ORDERING, cursor=request.GET['cursor'], per_page=12)
+        except InvalidCursor as e:
+            return JsonResponse({'error': str(e)}, status=400)
+    else:
+        paginator = Paginator(photos_list, 12)
+        page_number = request.GET.get('page', 1)
+        page_obj = paginator.get_page(page_number)
     
     photos_data = []
     for photo in page_obj:
-        # Format file size
-        if photo.file_size < 1024:
-            file_size_formatted = f"{photo.file_size} B"
-        elif photo.file_size < 1024 * 1024:
-            file_size_formatted = f"{photo.file_size / 1024:.1f} KB"
-        elif photo.file_size < 1024 * 1024 * 1024:
-            file_size_formatted = f"{photo.file_size / (1024 * 1024):.1f} MB"
-        else:
-            file_size_formatted = f"{photo.file_size / (1024 * 1024 * 1024):.1f} GB"
-        
         photos_data.append({
             'id': photo.id,
             'title': photo.title or 'Untitled',
             'image_url': photo.image.url,
+            'thumbnail_url': photo.thumbnail_url,
+            'thumbnail_webp_url': photo.thumbnail_webp_url,
             'uploaded_at': photo.uploaded_at.strftime('%b %d, %Y'),
             'file_size': photo.file_size,
-            'file_size_formatted': file_size_formatted,
+            'file_size_formatted': format_file_size(photo.file_size),
         })
     
+    if cursor_mode:
+        return JsonResponse({
+            'photos': photos_data,
+            'has_next': page_obj.has_next(),
+            'next_cursor': page_obj.next_cursor,
+        })
     return JsonResponse({
         'photos': photos_data,
         'has_next': page_obj.has_next(),
@@ -135,92 +169,69 @@ def photos_ajax(request):
         'current_page': page_obj.number,
     })
 
-@login_required
-def videos(request):
-    """User's videos page with sorting and filtering"""
-    sort = request.GET.get('sort', 'newest')
-    date_filter = request.GET.get('filter', 'all')
-    videos_list = request.user.videos.all()
+def filter_videos_by_date(videos_list, date_filter):
     now = timezone.now()
     if date_filter == 'month':
         videos_list = videos_list.filter(uploaded_at__year=now.year, uploaded_at__month=now.month)
     elif date_filter == 'year':
         videos_list = videos_list.filter(uploaded_at__year=now.year)
-    if sort == 'newest':
-        videos_list = videos_list.order_by('-uploaded_at')
-    elif sort == 'oldest':
-        videos_list = videos_list.order_by('uploaded_at')
-    elif sort == 'largest':
-        videos_list = videos_list.order_by('-file_size')
-    elif sort == 'smallest':
-        videos_list = videos_list.order_by('file_size')
-    elif sort == 'title_az':
-        videos_list = videos_list.order_by('title')
-    elif sort == 'title_za':
-        videos_list = videos_list.order_by('-title')
-    paginator = Paginator(videos_list, 8)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    return videos_list
+
+@login_required
+def videos(request):
+    """User's videos page with sorting and filtering"""
+    sort = request.GET.get('sort', 'newest')
+    date_filter = request.GET.get('filter', 'all')
+    videos_list = filter_videos_by_date(request.user.videos.all(), date_filter)
+    ordering = VIDEO_ORDERINGS.get(sort, DEFAULT_VIDEO_ORDERING)
+    page_obj = keyset_paginate(videos_list, ordering, per_page=8)
     context = {
         'page_obj': page_obj,
         'videos': page_obj,
         'sort': sort,
         'date_filter': date_filter,
+        'next_cursor': page_obj.next_cursor,
     }
     return render(request, 'storageapp/videos.html', context)
 
 @login_required
+@conditional_view(_media_validators)
 def videos_ajax(request):
-    """AJAX endpoint for infinite scroll videos"""
+    """AJAX endpoint for infinite scroll videos (``cursor`` or ``page`` paginated like photos_ajax)"""
     sort = request.GET.get('sort', 'newest')
     date_filter = request.GET.get('filter', 'all')
-    videos_list = request.user.videos.all()
-    now = timezone.now()
+    videos_list = filter_videos_by_date(request.user.videos.all(), date_filter)
+    ordering = VIDEO_ORDERINGS.get(sort, DEFAULT_VIDEO_ORDERING)
     
-    if date_filter == 'month':
-        videos_list = videos_list.filter(uploaded_at__year=now.year, uploaded_at__month=now.month)
-    elif date_filter == 'year':
-        videos_list = videos_list.filter(uploaded_at__year=now.year)
-    
-    if sort == 'newest':
-        videos_list = videos_list.order_by('-uploaded_at')
-    elif sort == 'oldest':
-        videos_list = videos_list.order_by('uploaded_at')
-    elif sort == 'largest':
-        videos_list = videos_list.order_by('-file_size')
-    elif sort == 'smallest':
-        videos_list = videos_list.order_by('file_size')
-    elif sort == 'title_az':
-        videos_list = videos_list.order_by('title')
-    elif sort == 'title_za':
-        videos_list = videos_list.order_by('-title')
-    
-    paginator = Paginator(videos_list, 8)
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
+    cursor_mode = 'cursor' in request.GET
+    if cursor_mode:
+        try:
+            page_obj = keyset_paginate(videos_list, ordering, cursor=request.GET['cursor'], per_page=8)
+        except InvalidCursor as e:
+            return JsonResponse({'error': str(e)}, status=400)
+    else:
+        paginator = Paginator(videos_list.order_by(*ordering), 8)
+        page_number = request.GET.get('page', 1)
+        page_obj = paginator.get_page(page_number)
     
     videos_data = []
     for video in page_obj:
-        # Format file size
-        if video.file_size < 1024:
-            file_size_formatted = f"{video.file_size} B"
-        elif video.file_size < 1024 * 1024:
-            file_size_formatted = f"{video.file_size / 1024:.1f} KB"
-        elif video.file_size < 1024 * 1024 * 1024:
-            file_size_formatted = f"{video.file_size / (1024 * 1024):.1f} MB"
-        else:
-            file_size_formatted = f"{video.file_size / (1024 * 1024 * 1024):.1f} GB"
-        
         videos_data.append({
             'id': video.id,
             'title': video.title or 'Untitled',
             'thumbnail_url': video.thumbnail.url if video.thumbnail else None,
             'uploaded_at': video.uploaded_at.strftime('%b %d, %Y'),
             'file_size': video.file_size,
-            'file_size_formatted': file_size_formatted,
+            'file_size_formatted': format_file_size(video.file_size),
             'duration': video.duration.strftime('%H:%M:%S') if video.duration else None,
         })
     
+    if cursor_mode:
+        return JsonResponse({
+            'videos': videos_data,
+            'has_next': page_obj.has_next(),
+            'next_cursor': page_obj.next_cursor,
+        })
     return JsonResponse({
         'videos': videos_data,
         'has_next': page_obj.has_next(),
@@ -232,8 +243,8 @@ def videos_ajax(request):
 def upload_photo(request):
     """Upload photo form with storage restriction and both single/multiple upload support"""
     profile, _ = UserProfile.objects.get_or_create(user=request.user)
-    if not profile.has_paid_for_extra_storage and profile.storage_used >= 1073741824:
-        messages.warning(request, 'You have reached your free 1GB storage limit. Please upgrade to upload more.')
+    if not profile.has_paid_for_extra_storage and profile.storage_used + profile.storage_reserved >= profile.storage_limit:
+        messages.warning(request, 'You have reached your free storage limit. Please upgrade to upload more.')
         return redirect('pay_for_extra_storage')
     single_form = PhotoUploadForm(user=request.user)
     multi_form = MultiPhotoUploadForm(user=request.user)
@@ -249,18 +260,18 @@ def upload_photo(request):
                     elif not image.content_type.startswith('image/'):
                         messages.error(request, 'Unsupported file type. Please upload an image file.')
                     else:
-                        photo = single_form.save(commit=False)
-                        photo.user = request.user
-                        
-                        # Debug: Check what storage is being used
-                        from django.conf import settings
-                        print(f"DEBUG: DEFAULT_FILE_STORAGE = {settings.DEFAULT_FILE_STORAGE}")
-                        print(f"DEBUG: CLOUDINARY_STORAGE = {settings.CLOUDINARY_STORAGE}")
-                        
-                        photo.save()
-                        single_form.save_m2m()  # Save albums
-                        messages.success(request, 'Photo uploaded successfully!')
-                        return redirect('photos')
+                        try:
+                            with reservation(request.user.pk, image.size):
+                                photo = single_form.save(commit=False)
+                                photo.user = request.user
+                                save_media(photo, 'image', image)
+                        except QuotaExceeded:
+                            messages.error(request, 'Not enough storage left for this photo. Please upgrade to upload more.')
+                        else:
+                            add_to_albums(photo, single_form.cleaned_data['albums'])
+                            generate_photo_derivatives(photo)
+                            messages.success(request, 'Photo uploaded successfully!')
+                            return redirect('photos')
         elif 'multi_upload' in request.POST:
             multi_form = MultiPhotoUploadForm(request.POST, user=request.user)
             if multi_form.is_valid():
@@ -280,9 +291,16 @@ def upload_photo(request):
                             messages.error(request, f'File {image.name} is not a supported image type.')
                             errors += 1
                         else:
-                            photo = Photo.objects.create(user=request.user, image=image, title=title, description=description)
+                            try:
+                                with reservation(request.user.pk, image.size):
+                                    photo = save_media(Photo(user=request.user, title=title, description=description), 'image', image)
+                            except QuotaExceeded:
+                                messages.error(request, f'Not enough storage left for {image.name}. Please upgrade to upload more.')
+                                errors += 1
+                                continue
+                            generate_photo_derivatives(photo)
                             if albums:
-                                photo.albums.set(albums)
+                                add_to_albums(photo, albums)
                     if errors == 0:
                         messages.success(request, f'{len(images)} photo(s) uploaded successfully!')
                         return redirect('photos')
@@ -292,12 +310,12 @@ def upload_photo(request):
 def upload_video(request):
     """Upload video form with storage restriction and both single/multiple upload support"""
     profile, _ = UserProfile.objects.get_or_create(user=request.user)
-    if not profile.has_paid_for_extra_storage and profile.storage_used >= 1073741824:
-        messages.warning(request, 'You have reached your free 1GB storage limit. Please upgrade to upload more.')
+    if not profile.has_paid_for_extra_storage and profile.storage_used + profile.storage_reserved >= profile.storage_limit:
+        messages.warning(request, 'You have reached your free storage limit. Please upgrade to upload more.')
         return redirect('pay_for_extra_storage')
     single_form = VideoUploadForm(user=request.user)
     multi_form = MultiVideoUploadForm(user=request.user)
-    max_video_size = 1000 * 1024 * 1024  # 1000MB
+    max_video_size = MAX_VIDEO_SIZE
     if request.method == 'POST':
         if 'single_upload' in request.POST:
             single_form = VideoUploadForm(request.POST, request.FILES, user=request.user)
@@ -309,12 +327,17 @@ def upload_video(request):
                     elif not video_file.content_type.startswith('video/'):
                         messages.error(request, 'Unsupported file type. Please upload a video file.')
                     else:
-                        video = single_form.save(commit=False)
-                        video.user = request.user
-                        video.save()
-                        single_form.save_m2m()  # Save albums
-                        messages.success(request, 'Video uploaded successfully!')
-                        return redirect('videos')
+                        try:
+                            with reservation(request.user.pk, video_file.size):
+                                video = single_form.save(commit=False)
+                                video.user = request.user
+                                save_media(video, 'video_file', video_file)
+                        except QuotaExceeded:
+                            messages.error(request, 'Not enough storage left for this video. Please upgrade to upload more.')
+                        else:
+                            add_to_albums(video, single_form.cleaned_data['albums'])
+                            messages.success(request, 'Video uploaded successfully!')
+                            return redirect('videos')
         elif 'multi_upload' in request.POST:
             multi_form = MultiVideoUploadForm(request.POST, user=request.user)
             if multi_form.is_valid():
@@ -334,13 +357,128 @@ def upload_video(request):
                             messages.error(request, f'File {video_file.name} is not a supported video type.')
                             errors += 1
                         else:
-                            video = Video.objects.create(user=request.user, video_file=video_file, title=title, description=description)
+                            try:
+                                with reservation(request.user.pk, video_file.size):
+                                    video = save_media(Video(user=request.user, title=title, description=description), 'video_file', video_file)
+                            except QuotaExceeded:
+                                messages.error(request, f'Not enough storage left for {video_file.name}. Please upgrade to upload more.')
+                                errors += 1
+                                continue
                             if albums:
-                                video.albums.set(albums)
+                                add_to_albums(video, albums)
                     if errors == 0:
                         messages.success(request, f'{len(videos)} video(s) uploaded successfully!')
                         return redirect('videos')
-    return render(request, 'storageapp/upload_video.html', {'single_form': single_form, 'multi_form': multi_form})
+    return render(request, 'storageapp/upload_video.html', {
+        'single_form': single_form,
+        'multi_form': multi_form,
+        'chunked_upload_threshold': settings.CHUNKED_UPLOAD_CHUNK_SIZE,
+    })
+
+@login_required
+@require_POST
+def upload_session_create(request):
+    """Start a resumable video upload; the client then sends chunks to upload_session_chunk"""
+    filename = request.POST.get('filename', '').strip()
+    content_type = request.POST.get('content_type', '')
+    try:
+        total_size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'A numeric size is required.'}, status=400)
+    if not filename:
+        return JsonResponse({'success': False, 'error': 'A filename is required.'}, status=400)
+    if total_size <= 0 or total_size > MAX_VIDEO_SIZE:
+        return JsonResponse({'success': False, 'error': 'Video is too large. Maximum allowed size is 1000MB.'}, status=400)
+    if not content_type.startswith('video/'):
+        return JsonResponse({'success': False, 'error': 'Unsupported file type. Please upload a video file.'}, status=400)
+    album_ids = [int(pk) for pk in request.POST.getlist('album_ids') if pk.isdigit()]
+
+    try:
+        session = chunked_upload.create_session(
+            request.user, filename, content_type, total_size,
+            title=request.POST.get('title', '')[:200],
+            description=request.POST.get('description', ''),
+            album_ids=album_ids,
+        )
+    except QuotaExceeded:
+        return JsonResponse({'success': False, 'error': 'Not enough storage left for this video. Please upgrade to upload more.'}, status=403)
+    return JsonResponse({
+        'success': True,
+        'upload_id': str(session.pk),
+        'offset': session.offset,
+        'chunk_size': settings.CHUNKED_UPLOAD_CHUNK_SIZE,
+        'expires_at': session.expires_at.isoformat(),
+    }, status=201)
+
+@login_required
+def upload_session_status(request, session_id):
+    """Report how many bytes the server holds so an interrupted client knows where to resume"""
+    session = get_object_or_404(UploadSession, pk=session_id, user=request.user)
+    return JsonResponse({
+        'upload_id': str(session.pk),
+        'offset': session.offset,
+        'size': session.total_size,
+        'status': session.status,
+        'expired': session.is_expired(),
+        'video_id': session.video_id,
+    })
+
+@login_required
+@require_POST
+def upload_session_chunk(request, session_id):
+    """Append the raw request body at the offset given in X-Upload-Offset (or ?offset=)"""
+    try:
+        offset = int(request.headers.get('X-Upload-Offset', request.GET.get('offset', '')))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'A numeric offset is required.'}, status=400)
+    try:
+        session = chunked_upload.append_chunk(session_id, request.user, offset, request, length)
+    except chunked_upload.ChunkError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=e.status)
+    return JsonResponse({'success': True, 'offset': session.offset, 'size': session.total_size})
+
+@login_required
+@require_POST
+def upload_session_finalize(request, session_id):
+    """Assemble the received chunks into a Video"""
+    try:
+        video = chunked_upload.finalize_session(session_id, request.user)
+    except chunked_upload.ChunkError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=e.status)
+    return JsonResponse({'success': True, 'video_id': video.id, 'redirect_url': reverse('videos')})
+
+@login_required
+@require_POST
+def upload_preflight(request):
+    """Let a client skip the transfer when the server already stores these exact bytes for the user"""
+    sha256 = request.POST.get('sha256', '').lower()
+    media_type = request.POST.get('media_type', 'photo')
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'A numeric size is required.'}, status=400)
+    if len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256):
+        return JsonResponse({'success': False, 'error': 'A hex SHA-256 digest is required.'}, status=400)
+    if media_type not in ('photo', 'video'):
+        return JsonResponse({'success': False, 'error': 'media_type must be photo or video.'}, status=400)
+    if size < 0:
+        return JsonResponse({'success': False, 'error': 'Size cannot be negative.'}, status=400)
+
+    try:
+        with reservation(request.user.pk, size):
+            instance = instant_upload(
+                request.user, media_type, sha256, size,
+                title=request.POST.get('title', '')[:200],
+                description=request.POST.get('description', ''),
+            )
+    except QuotaExceeded:
+        return JsonResponse({'success': False, 'error': 'Not enough storage left for this upload. Please upgrade to upload more.'}, status=403)
+    if instance is None:
+        return JsonResponse({'success': True, 'exists': False})
+    if media_type == 'photo':
+        generate_photo_derivatives(instance)
+    return JsonResponse({'success': True, 'exists': True, 'media_type': media_type, 'id': instance.id})
 
 @login_required
 def photo_detail(request, photo_id):
@@ -376,35 +514,16 @@ def video_detail(request, video_id):
 @require_POST
 def delete_photo(request, photo_id):
     """Delete photo"""
-    photo = get_object_or_404(Photo, id=photo_id, user=request.user)
-    
-    # Delete file from storage
-    if photo.image:
-        if os.path.isfile(photo.image.path):
-            os.remove(photo.image.path)
-    
-    photo.delete()
-    messages.success(request, 'Photo deleted successfully!')
+    get_object_or_404(Photo, id=photo_id, user=request.user)
+    Photo.objects.filter(id=photo_id).trash()
+    messages.success(request, 'Photo moved to the trash.')
     return redirect('photos')
 
 @login_required
 def delete_video(request, video_id):
-    video = get_object_or_404(Video, id=video_id, user=request.user)
-    try:
-        # Delete files from storage
-        if video.video_file and hasattr(video.video_file, 'path'):
-            os.remove(video.video_file.path)
-        if video.thumbnail and hasattr(video.thumbnail, 'path'):
-            os.remove(video.thumbnail.path)
-        video.delete()
-        messages.success(request, 'Video deleted successfully!')
-    except PermissionError as e:
-        if getattr(e, 'winerror', None) == 32:
-            messages.error(request, 'Cannot delete the video file because it is currently in use. Please close any programs using it and try again.')
-        else:
-            messages.error(request, f'Error deleting video: {e}')
-    except Exception as e:
-        messages.error(request, f'Error deleting video: {e}')
+    get_object_or_404(Video, id=video_id, user=request.user)
+    Video.objects.filter(id=video_id).trash()
+    messages.success(request, 'Video moved to the trash.')
     return redirect('videos')
 
 @login_required
@@ -420,30 +539,26 @@ def delete_notification(request, notification_id):
 
 @login_required
 def search_media(request):
-    """Search through user's media"""
-    query = request.GET.get('q', '')
+    """Ranked full-text search through user's media"""
+    query = request.GET.get('q', '').strip()
     media_type = request.GET.get('type', 'all')
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
     
-    photos = []
-    videos = []
-    
+    results = []
     if query:
-        if media_type in ['all', 'photos']:
-            photos = request.user.photos.filter(
-                Q(title__icontains=query) | 
-                Q(description__icontains=query)
-            )
-        if media_type in ['all', 'videos']:
-            videos = request.user.videos.filter(
-                Q(title__icontains=query) | 
-                Q(description__icontains=query)
-            )
+        digest = hashlib.md5(f'{media_type}:{page}:{query}'.encode()).hexdigest()
+        results = cached(
+            f'search:{request.user.id}:{digest}', [media_scope(request.user.id)],
+            lambda: media_search.search_media(request.user, query, media_type=media_type, page=page),
+        )
     
     context = {
         'query': query,
         'media_type': media_type,
-        'photos': photos,
-        'videos': videos,
+        'results': results,
     }
     return render(request, 'storageapp/search.html', context)
 
@@ -475,18 +590,10 @@ def notifications(request):
 @login_required
 def delete_photos(request):
     if request.method == 'POST':
-        photo_ids = request.POST.getlist('photo_ids')
-        photos = Photo.objects.filter(id__in=photo_ids, user=request.user)
-        deleted_count = 0
-        for photo in photos:
-            if photo.image and hasattr(photo.image, 'path'):
-                try:
-                    os.remove(photo.image.path)
-                except Exception:
-                    pass
-            photo.delete()
-            deleted_count += 1
-        messages.success(request, f'{deleted_count} photo(s) deleted successfully!')
+        photo_ids = parse_ids(request.POST.getlist('photo_ids'))
+        # One UPDATE; purge_trash does the real deletion later (see trash.py)
+        deleted_count = Photo.objects.filter(id__in=photo_ids, user=request.user).trash()
+        messages.success(request, f'{deleted_count} photo(s) moved to the trash.')
     return redirect('photos')
 
 @login_required
@@ -497,18 +604,18 @@ def download_photos(request):
         if not photos:
             messages.error(request, 'No photos selected for download.')
             return redirect('photos')
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-            for photo in photos:
-                if photo.image and hasattr(photo.image, 'path') and photo.image.storage.exists(photo.image.name):
-                    with photo.image.open('rb') as f:
-                        file_data = f.read()
-                        file_name = photo.image.name.split('/')[-1]
-                        zip_file.writestr(file_name, file_data)
-        zip_buffer.seek(0)
+        entries = (
+            ZipEntry(
+                photo.image.name.split('/')[-1],
+                open=lambda image=photo.image: image.storage.open(image.name, 'rb'),
+                size=photo.file_size,
+                modified=timezone.localtime(photo.uploaded_at),
+            )
+            for photo in photos if photo.image
+        )
         today_str = datetime.now().strftime('%Y%m%d')
         zip_filename = f"{request.user.username}_photos_{today_str}.zip"
-        response = HttpResponse(zip_buffer, content_type='application/zip')
+        response = StreamingHttpResponse(stream_zip(entries), content_type='application/zip')
         response['Content-Disposition'] = f'attachment; filename={zip_filename}'
         return response
     return redirect('photos')
@@ -516,31 +623,44 @@ def download_photos(request):
 @login_required
 def delete_videos(request):
     if request.method == 'POST':
-        video_ids = request.POST.getlist('video_ids')
-        videos = Video.objects.filter(id__in=video_ids, user=request.user)
-        deleted_count = 0
-        failed_count = 0
-        for video in videos:
-            try:
-                if video.video_file and hasattr(video.video_file, 'path'):
-                    os.remove(video.video_file.path)
-                if video.thumbnail and hasattr(video.thumbnail, 'path'):
-                    os.remove(video.thumbnail.path)
-                video.delete()
-                deleted_count += 1
-            except PermissionError as e:
-                if getattr(e, 'winerror', None) == 32:
-                    failed_count += 1
-                else:
-                    messages.error(request, f'Error deleting video: {e}')
-            except Exception as e:
-                messages.error(request, f'Error deleting video: {e}')
+        video_ids = parse_ids(request.POST.getlist('video_ids'))
+        # One UPDATE; purge_trash does the real deletion later (see trash.py)
+        deleted_count = Video.objects.filter(id__in=video_ids, user=request.user).trash()
         if deleted_count:
-            messages.success(request, f'{deleted_count} video(s) deleted successfully!')
-        if failed_count:
-            messages.error(request, f"{failed_count} video(s) could not be deleted because they are currently in use. Please close any programs using them and try again.")
+            messages.success(request, f'{deleted_count} video(s) moved to the trash.')
     return redirect('videos')
 
+@login_required
+def trash(request):
+    """Photos and videos that were deleted but can still be restored"""
+    context = {
+        'photos': trash_media.trashed_media(Photo, request.user).prefetch_related('derivatives'),
+        'videos': trash_media.trashed_media(Video, request.user),
+        'retention_days': settings.TRASH_RETENTION_DAYS,
+    }
+    return render(request, 'storageapp/trash.html', context)
+
+@login_required
+@require_POST
+def restore_media(request):
+    """Take the selected photos and videos out of the trash"""
+    cutoff = trash_media.trash_cutoff()
+    restored = 0
+    for model, field in ((Photo, 'photo_ids'), (Video, 'video_ids')):
+        ids = parse_ids(request.POST.getlist(field))
+        if ids:
+            restored += model.all_objects.filter(id__in=ids, user=request.user, deleted_at__gte=cutoff).restore()
+    messages.success(request, f'{restored} item(s) restored.')
+    return redirect('trash')
+
+@login_required
+@require_POST
+def empty_trash(request):
+    """Permanently delete everything in the trash (removed in the background by purge_trash)"""
+    emptied = trash_media.empty_trash(request.user)
+    messages.success(request, f'{emptied} item(s) permanently deleted.')
+    return redirect('trash')
+
 @login_required
 def download_videos(request):
     if request.method == 'POST':
@@ -549,18 +669,18 @@ def download_videos(request):
         if not videos:
             messages.error(request, 'No videos selected for download.')
             return redirect('videos')
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-            for video in videos:
-                if video.video_file and hasattr(video.video_file, 'path') and video.video_file.storage.exists(video.video_file.name):
-                    with video.video_file.open('rb') as f:
-                        file_data = f.read()
-                        file_name = video.video_file.name.split('/')[-1]
-                        zip_file.writestr(file_name, file_data)
-        zip_buffer.seek(0)
+        entries = (
+            ZipEntry(
+                video.video_file.name.split('/')[-1],
+                open=lambda video_file=video.video_file: video_file.storage.open(video_file.name, 'rb'),
+                size=video.file_size,
+                modified=timezone.localtime(video.uploaded_at),
+            )
+            for video in videos if video.video_file
+        )
         today_str = datetime.now().strftime('%Y%m%d')
         zip_filename = f"{request.user.username}_videos_{today_str}.zip"
-        response = HttpResponse(zip_buffer, content_type='application/zip')
+        response = StreamingHttpResponse(stream_zip(entries), content_type='application/zip')
         response['Content-Disposition'] = f'attachment; filename={zip_filename}'
         return response
     return redirect('videos')
@@ -585,32 +705,24 @@ def album_create(request):
             album.save()
             form.save_m2m()
             
-            # Handle bulk photo assignment
-            photo_ids = request.POST.get('photo_ids')
-            if photo_ids:
-                ids = [int(pk) for pk in photo_ids.split(',') if pk.isdigit()]
-                photos = Photo.objects.filter(id__in=ids, user=request.user)
-                for index, photo in enumerate(photos):
-                    AlbumPhoto.objects.create(album=album, photo=photo, order=index)
-            
-            # Handle bulk video assignment
-            video_ids = request.POST.get('video_ids')
-            if video_ids:
-                ids = [int(pk) for pk in video_ids.split(',') if pk.isdigit()]
-                videos = Video.objects.filter(id__in=ids, user=request.user)
-                for index, video in enumerate(videos):
-                    AlbumVideo.objects.create(album=album, video=video, order=index)
+            # Handle bulk photo/video assignment
+            sync_album_items(album, 'photo', parse_ids(request.POST.get('photo_ids', '').split(',')))
+            sync_album_items(album, 'video', parse_ids(request.POST.get('video_ids', '').split(',')))
             
             return redirect('album_detail', album_id=album.id)
     else:
         form = AlbumForm()
     return render(request, 'storageapp/album_form.html', {'form': form})
 
+def _album_validators(request, album_id):
+    return scope_validators(album_scope(album_id), media_scope(request.user.id))
+
 @login_required
+@conditional_view(_album_validators)
 def album_detail(request, album_id):
     album = get_object_or_404(Album, id=album_id, user=request.user)
-    photos = Photo.objects.filter(album_photos__album=album).order_by('album_photos__order')
-    videos = Video.objects.filter(album_videos__album=album).order_by('album_videos__order')
+    photos = Photo.objects.filter(album_photos__album=album).order_by('album_photos__order', 'album_photos__id').prefetch_related('derivatives')
+    videos = Video.objects.filter(album_videos__album=album).order_by('album_videos__order', 'album_videos__id')
     active_share = album.shares.filter(is_active=True).first()
     is_shared = active_share is not None
     share_url = request.build_absolute_uri(active_share.get_share_url()) if is_shared else ''
@@ -648,32 +760,15 @@ def album_delete(request, album_id):
 @login_required
 def album_edit_contents(request, album_id):
     album = get_object_or_404(Album, id=album_id, user=request.user)
-    user_photos = Photo.objects.filter(user=request.user)
+    user_photos = Photo.objects.filter(user=request.user).prefetch_related('derivatives')
     user_videos = Video.objects.filter(user=request.user)
     
     if request.method == 'POST':
         photo_ids = request.POST.getlist('photo_ids')
         video_ids = request.POST.getlist('video_ids')
         
-        # Clear existing relationships
-        AlbumPhoto.objects.filter(album=album).delete()
-        AlbumVideo.objects.filter(album=album).delete()
-        
-        # Add photos with order
-        for index, photo_id in enumerate(photo_ids):
-            try:
-                photo = Photo.objects.get(id=photo_id, user=request.user)
-                AlbumPhoto.objects.create(album=album, photo=photo, order=index)
-            except Photo.DoesNotExist:
-                pass
-        
-        # Add videos with order
-        for index, video_id in enumerate(video_ids):
-            try:
-                video = Video.objects.get(id=video_id, user=request.user)
-                AlbumVideo.objects.create(album=album, video=video, order=index)
-            except Video.DoesNotExist:
-                pass
+        sync_album_items(album, 'photo', parse_ids(photo_ids))
+        sync_album_items(album, 'video', parse_ids(video_ids))
         
         messages.success(request, 'Album contents updated!')
         return redirect('album_detail', album_id=album.id)
@@ -699,53 +794,24 @@ def reorder_album_media(request, album_id):
         data = request.POST
         media_type = data.get('type')  # 'photo' or 'video'
         media_id = data.get('id')
-        new_order = int(data.get('order', 0))
         
         if media_type == 'photo':
-            # Update photo order
-            album_photo = AlbumPhoto.objects.get(album=album, photo_id=media_id)
-            old_order = album_photo.order
-            
-            if new_order > old_order:
-                # Moving down - shift others up
-                AlbumPhoto.objects.filter(
-                    album=album, 
-                    order__gt=old_order, 
-                    order__lte=new_order
-                ).update(order=models.F('order') - 1)
-            else:
-                # Moving up - shift others down
-                AlbumPhoto.objects.filter(
-                    album=album, 
-                    order__gte=new_order, 
-                    order__lt=old_order
-                ).update(order=models.F('order') + 1)
-            
-            album_photo.order = new_order
-            album_photo.save()
-            
+            scope = AlbumPhoto.objects.filter(album=album).active()
+            item = scope.get(photo_id=media_id)
+            id_field = 'photo_id'
         elif media_type == 'video':
-            # Update video order
-            album_video = AlbumVideo.objects.get(album=album, video_id=media_id)
-            old_order = album_video.order
-            
-            if new_order > old_order:
-                # Moving down - shift others up
-                AlbumVideo.objects.filter(
-                    album=album, 
-                    order__gt=old_order, 
-                    order__lte=new_order
-                ).update(order=models.F('order') - 1)
-            else:
-                # Moving up - shift others down
-                AlbumVideo.objects.filter(
-                    album=album, 
-                    order__gte=new_order, 
-                    order__lt=old_order
-                ).update(order=models.F('order') + 1)
-            
-            album_video.order = new_order
-            album_video.save()
+            scope = AlbumVideo.objects.filter(album=album).active()
+            item = scope.get(video_id=media_id)
+            id_field = 'video_id'
+        else:
+            return JsonResponse({'success': False, 'error': 'Unknown media type'})
+        
+        before, after = media_ordering.resolve_neighbours(
+            scope, media_ordering.ALBUM_ITEM_ORDERING, item,
+            prev_id=data.get('prev_id'), next_id=data.get('next_id'), index=data.get('order'), id_field=id_field,
+        )
+        media_ordering.move_item(scope, media_ordering.ALBUM_ITEM_ORDERING, item, before, after)
+        invalidate_album_shares([album.id])
         
         return JsonResponse({'success': True})
         
@@ -758,29 +824,13 @@ def reorder_photos(request):
     """Handle drag-and-drop reordering of photos"""
     try:
         data = request.POST
-        photo_id = data.get('id')
-        new_order = int(data.get('order', 0))
-        
-        photo = Photo.objects.get(id=photo_id, user=request.user)
-        old_order = photo.order
-        
-        if new_order > old_order:
-            # Moving down - shift others up
-            Photo.objects.filter(
-                user=request.user,
-                order__gt=old_order, 
-                order__lte=new_order
-            ).update(order=models.F('order') - 1)
-        else:
-            # Moving up - shift others down
-            Photo.objects.filter(
-                user=request.user,
-                order__gte=new_order, 
-                order__lt=old_order
-            ).update(order=models.F('order') + 1)
+        photo = Photo.objects.get(id=data.get('id'), user=request.user)
+        scope = Photo.objects.filter(user=request.user)
         
-        photo.order = new_order
-        photo.save()
+        before, after = media_ordering.resolve_neighbours(
+            scope, PHOTO_ORDERING, photo, prev_id=data.get('prev_id'), next_id=data.get('next_id'), index=data.get('order'),
+        )
+        media_ordering.move_item(scope, PHOTO_ORDERING, photo, before, after)
         
         return JsonResponse({'success': True})
         
@@ -793,44 +843,72 @@ def reorder_videos(request):
     """Handle drag-and-drop reordering of videos"""
     try:
         data = request.POST
-        video_id = data.get('id')
-        new_order = int(data.get('order', 0))
+        video = Video.objects.get(id=data.get('id'), user=request.user)
+        scope = Video.objects.filter(user=request.user)
         
-        video = Video.objects.get(id=video_id, user=request.user)
-        old_order = video.order
-        
-        if new_order > old_order:
-            # Moving down - shift others up
-            Video.objects.filter(
-                user=request.user,
-                order__gt=old_order, 
-                order__lte=new_order
-            ).update(order=models.F('order') - 1)
-        else:
-            # Moving up - shift others down
-            Video.objects.filter(
-                user=request.user,
-                order__gte=new_order, 
-                order__lt=old_order
-            ).update(order=models.F('order') + 1)
-        
-        video.order = new_order
-        video.save()
+        before, after = media_ordering.resolve_neighbours(
+            scope, DEFAULT_VIDEO_ORDERING, video, prev_id=data.get('prev_id'), next_id=data.get('next_id'), index=data.get('order'),
+        )
+        media_ordering.move_item(scope, DEFAULT_VIDEO_ORDERING, video, before, after)
         
         return JsonResponse({'success': True})
         
     except (Video.DoesNotExist, ValueError, KeyError) as e:
         return JsonResponse({'success': False, 'error': str(e)})
 
+def _reorder_batch(request, scope, ordering, id_field='id'):
+    """Apply the posted `ids` list to `scope` and report the resulting order values"""
+    try:
+        ids = [int(pk) for pk in request.POST.getlist('ids')]
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Item ids must be integers'}, status=400)
+    try:
+        positions = media_ordering.apply_order(scope, ordering, ids, id_field=id_field)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    return JsonResponse({
+        'success': True,
+        'positions': [{'id': item_id, 'order': order} for item_id, order in positions],
+    })
+
+@login_required
+@require_POST
+def reorder_photos_batch(request):
+    """Apply a whole drag-and-drop arrangement of photos in one request"""
+    return _reorder_batch(request, Photo.objects.filter(user=request.user), PHOTO_ORDERING)
+
+@login_required
+@require_POST
+def reorder_videos_batch(request):
+    """Apply a whole drag-and-drop arrangement of videos in one request"""
+    return _reorder_batch(request, Video.objects.filter(user=request.user), DEFAULT_VIDEO_ORDERING)
+
+@login_required
+@require_POST
+def reorder_album_media_batch(request, album_id):
+    """Apply a whole drag-and-drop arrangement of an album's photos or videos in one request"""
+    album = get_object_or_404(Album, id=album_id, user=request.user)
+    media_type = request.POST.get('type')
+    if media_type == 'photo':
+        response = _reorder_batch(request, AlbumPhoto.objects.filter(album=album).active(), media_ordering.ALBUM_ITEM_ORDERING, 'photo_id')
+    elif media_type == 'video':
+        response = _reorder_batch(request, AlbumVideo.objects.filter(album=album).active(), media_ordering.ALBUM_ITEM_ORDERING, 'video_id')
+    else:
+        return JsonResponse({'success': False, 'error': 'Unknown media type'}, status=400)
+    invalidate_album_shares([album.id])
+    return response
+
 @login_required
 @require_POST
 def share_photo(request, photo_id):
     photo = get_object_or_404(Photo, id=photo_id, user=request.user)
-    shared, created = SharedPhoto.objects.get_or_create(photo=photo, is_active=True)
-    if not created and shared.is_expired():
-        shared.is_active = True
-        shared.expires_at = None
-        shared.save()
+    with transaction.atomic():
+        shared, created = SharedPhoto.objects.get_or_create(photo=photo, is_active=True)
+        if not created and shared.is_expired():
+            shared.is_active = True
+            shared.expires_at = None
+            shared.save()
+            invalidate_shares('photo', [shared.share_token])
     share_url = request.build_absolute_uri(shared.get_share_url())
     return JsonResponse({'success': True, 'share_url': share_url})
 
@@ -838,24 +916,43 @@ def share_photo(request, photo_id):
 @require_POST
 def unshare_photo(request, photo_id):
     photo = get_object_or_404(Photo, id=photo_id, user=request.user)
-    SharedPhoto.objects.filter(photo=photo, is_active=True).update(is_active=False)
+    with transaction.atomic():
+        shares = SharedPhoto.objects.filter(photo=photo, is_active=True)
+        tokens = list(shares.select_for_update().values_list('share_token', flat=True))
+        shares.update(is_active=False)
+        # Deleted on commit, so no request can re-cache the share while it still reads as active
+        invalidate_shares('photo', tokens)
     return JsonResponse({'success': True})
 
+def _share_validators(kind):
+    """Validators from the cached share payload's fingerprint; unknown/expired shares always render"""
+    def validators(request, token):
+        share = resolve_share(kind, token)
+        if share is None or share.get('expired'):
+            return None
+        return share['etag'], None
+    return validators
+
+@conditional_view(_share_validators('photo'))
 def shared_photo(request, token):
-    shared = get_object_or_404(SharedPhoto, share_token=token, is_active=True)
-    if shared.is_expired():
+    share = resolve_share('photo', token)
+    if share is None:
+        raise Http404('No SharedPhoto matches the given query.')
+    if share.get('expired'):
         return render(request, 'storageapp/shared_expired.html')
-    return render(request, 'storageapp/shared_photo.html', {'photo': shared.photo})
+    return render(request, 'storageapp/shared_photo.html', {'photo': share['photo']})
 
 @login_required
 @require_POST
 def share_video(request, video_id):
     video = get_object_or_404(Video, id=video_id, user=request.user)
-    shared, created = SharedVideo.objects.get_or_create(video=video, is_active=True)
-    if not created and shared.is_expired():
-        shared.is_active = True
-        shared.expires_at = None
-        shared.save()
+    with transaction.atomic():
+        shared, created = SharedVideo.objects.get_or_create(video=video, is_active=True)
+        if not created and shared.is_expired():
+            shared.is_active = True
+            shared.expires_at = None
+            shared.save()
+            invalidate_shares('video', [shared.share_token])
     share_url = request.build_absolute_uri(shared.get_share_url())
     return JsonResponse({'success': True, 'share_url': share_url})
 
@@ -863,24 +960,35 @@ def share_video(request, video_id):
 @require_POST
 def unshare_video(request, video_id):
     video = get_object_or_404(Video, id=video_id, user=request.user)
-    SharedVideo.objects.filter(video=video, is_active=True).update(is_active=False)
+    with transaction.atomic():
+        shares = SharedVideo.objects.filter(video=video, is_active=True)
+        tokens = list(shares.select_for_update().values_list('share_token', flat=True))
+        shares.update(is_active=False)
+        invalidate_shares('video', tokens)
     return JsonResponse({'success': True})
 
+@conditional_view(_share_validators('video'))
 def shared_video(request, token):
-    shared = get_object_or_404(SharedVideo, share_token=token, is_active=True)
-    if shared.is_expired():
+    share = resolve_share('video', token)
+    if share is None:
+        raise Http404('No SharedVideo matches the given query.')
+    if share.get('expired'):
         return render(request, 'storageapp/shared_expired.html')
-    return render(request, 'storageapp/shared_video.html', {'video': shared.video})
+    return render(request, 'storageapp/shared_video.html', {'video': share['video']})
 
 @login_required
 @require_POST
 def share_album(request, album_id):
     album = get_object_or_404(Album, id=album_id, user=request.user)
-    shared, created = SharedAlbum.objects.get_or_create(album=album, is_active=True)
-    if not created and shared.is_expired():
-        shared.is_active = True
-        shared.expires_at = None
-        shared.save()
+    with transaction.atomic():
+        shared, created = SharedAlbum.objects.get_or_create(album=album, is_active=True)
+        if created:
+            bump(album_scope(album.id))
+        if not created and shared.is_expired():
+            shared.is_active = True
+            shared.expires_at = None
+            shared.save()
+            invalidate_shares('album', [shared.share_token])
     share_url = request.build_absolute_uri(shared.get_share_url())
     return JsonResponse({'success': True, 'share_url': share_url})
 
@@ -888,73 +996,88 @@ def share_album(request, album_id):
 @require_POST
 def unshare_album(request, album_id):
     album = get_object_or_404(Album, id=album_id, user=request.user)
-    SharedAlbum.objects.filter(album=album, is_active=True).update(is_active=False)
+    with transaction.atomic():
+        shares = SharedAlbum.objects.filter(album=album, is_active=True)
+        tokens = list(shares.select_for_update().values_list('share_token', flat=True))
+        shares.update(is_active=False)
+        invalidate_shares('album', tokens)
+    bump(album_scope(album.id))
     return JsonResponse({'success': True})
 
+@conditional_view(_share_validators('album'))
 def shared_album(request, token):
-    shared = get_object_or_404(SharedAlbum, share_token=token, is_active=True)
-    if shared.is_expired():
+    share = resolve_share('album', token)
+    if share is None:
+        raise Http404('No SharedAlbum matches the given query.')
+    if share.get('expired'):
         return render(request, 'storageapp/shared_expired.html')
-    
-    album = shared.album
-    photos = Photo.objects.filter(album_photos__album=album).order_by('album_photos__order')
-    videos = Video.objects.filter(album_videos__album=album).order_by('album_videos__order')
 
     return render(request, 'storageapp/shared_album.html', {
-        'album': album,
-        'photos': photos,
-        'videos': videos
+        'album': share['album'],
+        'photos': share['photos'],
+        'videos': share['videos'],
     })
 
+def _analytics_range(request):
+    range_key = request.GET.get('range', storage_analytics_data.DEFAULT_RANGE)
+    return range_key if range_key in storage_analytics_data.RANGES else storage_analytics_data.DEFAULT_RANGE
+
+def _storage_series(user, range_key):
+    today = timezone.now().date()
+    return cached(
+        f'storage_series:{user.id}:{range_key}:{today.isoformat()}', [profile_scope(user.id)],
+        lambda: storage_analytics_data.storage_series(user, range_key, today),
+    )
+
 @login_required
 def storage_analytics(request):
     """Storage analytics page with charts"""
-    user = request.user
-    profile, created = UserProfile.objects.get_or_create(user=user)
-    
-    # Get date range (last 30 days by default)
-    end_date = timezone.now().date()
-    start_date = end_date - timedelta(days=30)
-    
-    # Get storage history data
-    storage_history = StorageHistory.objects.filter(
-        user=user,
-        date__range=[start_date, end_date]
-    ).order_by('date')
-    
-    # Prepare data for chart
-    dates = []
-    storage_values = []
-    
-    for record in storage_history:
-        dates.append(record.date.strftime('%Y-%m-%d'))
-        storage_values.append(round(record.storage_used / (1024 * 1024), 2))  # Convert to MB
-    
-    # If no history data, create some sample data
-    if not storage_history.exists():
-        # Create sample data based on current storage
-        current_storage = profile.storage_used / (1024 * 1024)  # MB
-        for i in range(30):
-            date = start_date + timedelta(days=i)
-            dates.append(date.strftime('%Y-%m-%d'))
-            # Add some variation to make it look realistic
-            variation = current_storage * (0.8 + 0.4 * (i / 30))  # Gradual increase
-            storage_values.append(round(variation, 2))
-    
+    profile, created = UserProfile.objects.get_or_create(user=request.user)
+    series = _storage_series(request.user, _analytics_range(request))
+    today = timezone.now().date()
+    forecast = cached(
+        f'storage_forecast:{request.user.id}:{today.isoformat()}', [profile_scope(request.user.id)],
+        lambda: forecast_for_user(request.user, today) or {},
+    )
+
     storage_limit_mb = profile.get_storage_limit_mb()
     storage_used_mb = profile.get_storage_used_mb()
-    available_storage_mb = storage_limit_mb - storage_used_mb
-    if available_storage_mb < 0:
-        available_storage_mb = 0
-    
+    available_storage_mb = max(storage_limit_mb - storage_used_mb, 0)
+
     context = {
         'profile': profile,
-        'dates': json.dumps(dates),
-        'storage_values': json.dumps(storage_values),
+        'series': series,
+        'resolution_label': storage_analytics_data.RESOLUTION_LABELS[series['resolution']],
+        'ranges': [(key, label) for key, (label, _) in storage_analytics_data.RANGES.items()],
+        'dates': json.dumps([point['date'] for point in series['points']]),
+        'storage_values': json.dumps([point['storage_mb'] for point in series['points']]),
         'storage_limit_mb': storage_limit_mb,
         'storage_used_mb': storage_used_mb,
         'available_storage_mb': available_storage_mb,
         'storage_percentage': profile.get_storage_percentage(),
+        'forecast': forecast,
     }
-    
     return render(request, 'storageapp/storage_analytics.html', context)
+
+def _series_validators(request):
+    # The window moves with the date even when no data changes
+    version, last_modified = scope_validators(profile_scope(request.user.id))
+    return f'{version}:{_analytics_range(request)}:{timezone.now().date()}', last_modified
+
+@login_required
+@conditional_view(_series_validators)
+def storage_analytics_series(request):
+    """JSON usage series for ``range`` (30d, 1y or all), at most MAX_POINTS points"""
+    return JsonResponse({'success': True, **_storage_series(request.user, _analytics_range(request))})
+
+@login_required
+def storage_breakdown(request):
+    """Where the user's storage goes: by type, album and upload month.
+
+    Staff can pass ``user`` (an id) to see anyone's breakdown.
+    """
+    user = request.user
+    if request.user.is_staff and request.GET.get('user', '').isdigit():
+        user = get_object_or_404(User, pk=request.GET['user'])
+    breakdown = compute_storage_breakdown(user)
+    return render(request, 'storageapp/storage_breakdown.html', {'subject': user, **breakdown})
@@ -0,0 +1,172 @@
+"""Streaming ZIP writer for media exports.
+
+Archives are produced as a generator of byte chunks, so a
+StreamingHttpResponse can start sending immediately and memory stays at
+roughly one chunk regardless of how many (or how large) the files are.
+Entries are STORED (photos and videos are already compressed) with the
+CRC and sizes written in a trailing data descriptor, and ZIP64 records are
+emitted whenever a size, offset or entry count outgrows the classic format.
+"""
+import logging
+import struct
+import zlib
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+ZIP_CHUNK_SIZE = 1024 * 1024  # bytes read from storage per iteration
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_ENTRY_LIMIT = 0xFFFF
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+METHOD_STORED = 0
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+
+LOCAL_FILE_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_DIRECTORY_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR_ZIP64 = struct.Struct('<IIQQ')
+ZIP64_EXTRA_HEADER = struct.Struct('<HH')
+ZIP64_END_OF_CENTRAL_DIRECTORY = struct.Struct('<IQHHIIQQQQ')
+ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR = struct.Struct('<IIQI')
+END_OF_CENTRAL_DIRECTORY = struct.Struct('<IHHHHIIH')
+
+
+class ZipEntry:
+    """A file to add to the archive.
+
+    `open` is a callable returning a binary file object; it is only called
+    when the entry is reached, so storage connections are opened one at a
+    time. `size` is a hint used to decide up front whether the entry needs
+    ZIP64 headers.
+    """
+
+    def __init__(self, name, open, size=None, modified=None):
+        self.name = name
+        self.open = open
+        self.size = size
+        self.modified = modified
+
+
+def _dos_datetime(value):
+    value = value or datetime.now()
+    if value.year < 1980:
+        value = datetime(1980, 1, 1)
+    dos_time = (value.hour << 11) | (value.minute << 5) | (value.second // 2)
+    dos_date = ((value.year - 1980) << 9) | (value.month << 5) | value.day
+    return dos_time, dos_date
+
+
+def _unique_name(name, seen):
+    """Avoid duplicate archive names (e.g. two 'IMG_0001.jpg' from different folders)"""
+    candidate = name
+    stem, dot, extension = name.rpartition('.')
+    if not dot:
+        stem, extension = name, ''
+    counter = 1
+    while candidate in seen:
+        candidate = f'{stem} ({counter}){dot}{extension}'
+        counter += 1
+    seen.add(candidate)
+    return candidate
+
+
+def stream_zip(entries, chunk_size=ZIP_CHUNK_SIZE):
+    """Yield the bytes of a ZIP archive containing `entries` (iterable of ZipEntry)"""
+    offset = 0
+    central_directory = []
+    seen_names = set()
+
+    for entry in entries:
+        try:
+            source = entry.open()
+        except Exception:
+            logger.exception('Skipping %s: could not open it for export', entry.name)
+            continue
+
+        name = _unique_name(entry.name, seen_names).encode('utf-8')
+        dos_time, dos_date = _dos_datetime(entry.modified)
+        flags = FLAG_DATA_DESCRIPTOR | FLAG_UTF8
+        zip64 = (entry.size is not None and entry.size >= ZIP32_LIMIT) or offset >= ZIP32_LIMIT
+        header_offset = offset
+
+        # CRC and sizes are unknown until the data has streamed, so the local
+        # header carries zeros (or the ZIP64 markers) and the data descriptor
+        # that follows the data holds the real values.
+        if zip64:
+            extra = ZIP64_EXTRA_HEADER.pack(0x0001, 16) + struct.pack('<QQ', 0, 0)
+            header_size = ZIP32_LIMIT
+        else:
+            extra = b''
+            header_size = 0
+        local_header = LOCAL_FILE_HEADER.pack(
+            0x04034b50, VERSION_ZIP64 if zip64 else VERSION_DEFAULT, flags, METHOD_STORED,
+            dos_time, dos_date, 0, header_size, header_size, len(name), len(extra),
+        ) + name + extra
+        yield local_header
+        offset += len(local_header)
+
+        crc = 0
+        size = 0
+        with source:
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                yield chunk
+        offset += size
+
+        if size >= ZIP32_LIMIT and not zip64:
+            # The size hint was wrong; a 32-bit descriptor cannot describe this entry
+            raise ValueError(f'{entry.name} exceeded its expected size; cannot finish the archive')
+
+        if zip64:
+            descriptor = DATA_DESCRIPTOR_ZIP64.pack(0x08074b50, crc, size, size)
+        else:
+            descriptor = DATA_DESCRIPTOR.pack(0x08074b50, crc, size, size)
+        yield descriptor
+        offset += len(descriptor)
+
+        central_directory.append((name, flags, dos_time, dos_date, crc, size, header_offset, zip64))
+
+    # Central directory
+    directory_offset = offset
+    directory_size = 0
+    for name, flags, dos_time, dos_date, crc, size, header_offset, zip64 in central_directory:
+        needs_zip64 = zip64 or size >= ZIP32_LIMIT or header_offset >= ZIP32_LIMIT
+        if needs_zip64:
+            extra = ZIP64_EXTRA_HEADER.pack(0x0001, 24) + struct.pack('<QQQ', size, size, header_offset)
+            size32 = offset32 = ZIP32_LIMIT
+        else:
+            extra = b''
+            size32, offset32 = size, header_offset
+        version = VERSION_ZIP64 if needs_zip64 else VERSION_DEFAULT
+        record = CENTRAL_DIRECTORY_HEADER.pack(
+            0x02014b50, version, version, flags, METHOD_STORED, dos_time, dos_date,
+            crc, size32, size32, len(name), len(extra), 0, 0, 0, 0, offset32,
+        ) + name + extra
+        yield record
+        directory_size += len(record)
+
+    entry_count = len(central_directory)
+    end_offset = directory_offset + directory_size
+    if entry_count >= ZIP32_ENTRY_LIMIT or directory_offset >= ZIP32_LIMIT or directory_size >= ZIP32_LIMIT:
+        yield ZIP64_END_OF_CENTRAL_DIRECTORY.pack(
+            0x06064b50, ZIP64_END_OF_CENTRAL_DIRECTORY.size - 12, VERSION_ZIP64, VERSION_ZIP64,
+            0, 0, entry_count, entry_count, directory_size, directory_offset,
+        )
+        yield ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR.pack(0x07064b50, 0, end_offset, 1)
+        yield END_OF_CENTRAL_DIRECTORY.pack(
+            0x06054b50, 0, 0,
+            min(entry_count, ZIP32_ENTRY_LIMIT), min(entry_count, ZIP32_ENTRY_LIMIT),
+            min(directory_size, ZIP32_LIMIT), min(directory_offset, ZIP32_LIMIT), 0,
+        )
+    else:
+        yield END_OF_CENTRAL_DIRECTORY.pack(
+            0x06054b50, 0, 0, entry_count, entry_count, directory_size, directory_offset, 0,
+        )
@@ -12,6 +12,9 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -123,8 +126,43 @@ CLOUDINARY_STORAGE = {
     'API_SECRET': 'Awmf2iz90wugM6fJOWqJXjOzTrU',
 }
 
-# Force Cloudinary for all media files
-DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
+# Media storage backend: 'cloudinary' (default) or 'local', a sharded
+# content-addressed tree under MEDIA_ROOT for offline use, CI and benchmarks
+MEDIA_STORAGE = os.environ.get('MEDIA_STORAGE', 'cloudinary')
+MEDIA_STORAGE_BACKENDS = {
+    'cloudinary': 'storageapp.storage.CloudinaryMediaStorage',
+    'local': 'storageapp.storage.ShardedFileSystemStorage',
+}
+if MEDIA_STORAGE not in MEDIA_STORAGE_BACKENDS:
+    raise ImproperlyConfigured(f"MEDIA_STORAGE must be one of {', '.join(MEDIA_STORAGE_BACKENDS)}, not {MEDIA_STORAGE!r}")
+if MEDIA_STORAGE == 'local':
+    MEDIA_URL = '/media/'
+    MEDIA_ROOT = os.environ.get('MEDIA_ROOT', MEDIA_ROOT)
+
+STORAGES = {
+    'default': {'BACKEND': MEDIA_STORAGE_BACKENDS[MEDIA_STORAGE]},
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage' if DEBUG
+        else 'whitenoise.storage.CompressedManifestStaticFilesStorage',
+    },
+}
+
+# Optional local disk cache of media read back from the storage backend
+# (exports, derivative generation); MEDIA_CACHE_MAX_BYTES bounds its size
+MEDIA_CACHE_DIR = os.environ.get('MEDIA_CACHE_DIR')
+if MEDIA_CACHE_DIR:
+    STORAGES['default'] = {
+        'BACKEND': 'storageapp.storage.ReadThroughCacheStorage',
+        'OPTIONS': {
+            'backend': MEDIA_STORAGE_BACKENDS[MEDIA_STORAGE],
+            'location': MEDIA_CACHE_DIR,
+            'max_bytes': int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 5 * 1024 ** 3)),
+            # Compare the cached size with the backend's (one HEAD for Cloudinary),
+            # at most once per file every MEDIA_CACHE_VALIDATE_TTL seconds
+            'validate': os.environ.get('MEDIA_CACHE_VALIDATE', 'True') == 'True',
+            'validate_ttl': int(os.environ.get('MEDIA_CACHE_VALIDATE_TTL', 300)),
+        },
+    }
 
 # Ensure Cloudinary is used for all file fields
 import cloudinary_storage.storage
@@ -136,6 +174,52 @@ CLOUDINARY_STORAGE.update({
     'INVALID_VIDEO_ERROR_MESSAGE': 'Please upload a valid video file.',
 })
 
+# Hash uploads while they stream so identical media is stored only once
+FILE_UPLOAD_HANDLERS = [
+    'storageapp.uploadhandlers.HashingMemoryFileUploadHandler',
+    'storageapp.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+
+# Resumable (chunked) video uploads: chunks are spooled here until finalized
+CHUNKED_UPLOAD_SPOOL_DIR = os.environ.get('CHUNKED_UPLOAD_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'storageapp_uploads'))
+CHUNKED_UPLOAD_CHUNK_SIZE = int(os.environ.get('CHUNKED_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))  # max bytes per chunk
+CHUNKED_UPLOAD_EXPIRY_HOURS = int(os.environ.get('CHUNKED_UPLOAD_EXPIRY_HOURS', 24))  # abandoned sessions are collected after this
+
+# Album content forms post one checkbox per selected item
+DATA_UPLOAD_MAX_NUMBER_FIELDS = int(os.environ.get('DATA_UPLOAD_MAX_NUMBER_FIELDS', 20000))
+
+# Cache: Redis when REDIS_URL is set, otherwise a database table shared by every worker
+# (created by `manage.py createcachetable`, which the build scripts run after migrating).
+# Production needs Redis: the version stamps behind ETags and versioned keys
+# (cache_versions) are read on every conditional request and written on every
+# change, which the table turns into database queries. The table is a fallback
+# for small installs; its MAX_ENTRIES must cover the whole key space (three
+# version scopes per user plus one per album, share links, dashboard summaries
+# and storage breakdowns), because past it every set culls a third of the
+# table, version stamps included, and every culled stamp resets its ETags.
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'storageapp_cache',
+            'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', 200_000))},
+        }
+    }
+
+# Seconds a resolved public share link is served from the cache
+SHARE_CACHE_TTL = int(os.environ.get('SHARE_CACHE_TTL', 300))
+
+# Days deleted media stays restorable in the trash before `purge_trash` removes it
+TRASH_RETENTION_DAYS = int(os.environ.get('TRASH_RETENTION_DAYS', 30))
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -145,7 +229,6 @@ LOGOUT_REDIRECT_URL = '/'
 
 # Vercel deployment settings
 if not DEBUG:
-    STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
     # Security settings for production
     SECURE_BROWSER_XSS_FILTER = True
     SECURE_CONTENT_TYPE_NOSNIFF = True
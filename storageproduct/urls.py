@@ -28,5 +28,6 @@ urlpatterns = [
 # Serve static files during development
 if settings.DEBUG:
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
-    # Don't serve media files locally when using Cloudinary
-    # urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    # Cloudinary serves its own media; the local backend needs it served here
+    if settings.MEDIA_STORAGE == 'local':
+        urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
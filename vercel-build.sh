@@ -15,5 +15,6 @@ python manage.py collectstatic --noinput
 # Run migrations
 echo "Running migrations..."
 python manage.py migrate
+python manage.py createcachetable
 
 echo "Vercel build completed!"